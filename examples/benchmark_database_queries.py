@@ -0,0 +1,83 @@
+"""Time the lookups of pycistem.database on a synthetic project with 50k images.
+
+"before" runs the lookups the way the helpers used to, a new connection and
+a formatted statement per call on a project without the lookup indexes,
+"after" calls the helpers.
+"""
+import contextlib
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from pycistem.database import get_image_info_from_db, get_num_already_processed_images, get_tm_info_from_db, project_connection, volume_asset_id
+from pycistem.pycore import Project
+
+num_images = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+num_lookups = 500
+
+
+def create_project(directory):
+    project = Project()
+    project.CreateNewProject(str(directory / "bench.db"), str(directory), "bench")
+    project.Close(True, True)
+    database = directory / "bench.db"
+    with contextlib.closing(sqlite3.connect(database)) as con:
+        for (name,) in con.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'PYCISTEM_%'").fetchall():
+            con.execute(f"DROP INDEX {name}")
+        ids = range(1, num_images + 1)
+        con.executemany("INSERT INTO MOVIE_ASSETS (MOVIE_ASSET_ID, NAME, FILENAME, PIXEL_SIZE, GAIN_FILENAME) VALUES (?, ?, ?, 1.0, 'gain.dm4')", ((i, f"movie_{i}", f"/data/movie_{i}.tif") for i in ids))
+        con.executemany("INSERT INTO IMAGE_ASSETS (IMAGE_ASSET_ID, NAME, FILENAME, PARENT_MOVIE_ID, ALIGNMENT_ID, CTF_ESTIMATION_ID, X_SIZE, Y_SIZE, PIXEL_SIZE, VOLTAGE, SPHERICAL_ABERRATION) VALUES (?, ?, ?, ?, ?, ?, 4096, 4096, 1.0, 300.0, 2.7)", ((i, f"image_{i}", f"/data/image_{i}.mrc", i, i, i) for i in ids))
+        con.executemany("INSERT INTO ESTIMATED_CTF_PARAMETERS (CTF_ESTIMATION_ID, IMAGE_ASSET_ID, DEFOCUS1, DEFOCUS2, DEFOCUS_ANGLE, SCORE, DETECTED_RING_RESOLUTION, AMPLITUDE_CONTRAST) VALUES (?, ?, 10000.0, 9000.0, 30.0, 0.1, 4.0, 0.07)", ((i, i) for i in ids))
+        con.executemany("INSERT INTO VOLUME_ASSETS (VOLUME_ASSET_ID, NAME, FILENAME, PIXEL_SIZE) VALUES (?, ?, ?, 1.0)", ((i, f"template_{i}", f"/data/template_{i}.mrc") for i in range(1, 1001)))
+        con.executemany("INSERT INTO TEMPLATE_MATCH_LIST (TEMPLATE_MATCH_ID, TEMPLATE_MATCH_JOB_ID, IMAGE_ASSET_ID, REFERENCE_VOLUME_ASSET_ID) VALUES (?, ?, ?, 1)", ((job * num_images + i, job + 1, i) for job in range(2) for i in ids))
+        con.commit()
+    return(database)
+
+
+def before(database, images, volumes):
+    for image in images:
+        with contextlib.closing(sqlite3.connect(database)) as con:
+            df1 = pd.read_sql_query(f"SELECT IMAGE_ASSET_ID,MOVIE_ASSET_ID,IMAGE_ASSETS.FILENAME, MOVIE_ASSETS.FILENAME as movie_filename, CTF_ESTIMATION_ID , ALIGNMENT_ID, IMAGE_ASSETS.PIXEL_SIZE as image_pixel_size, IMAGE_ASSETS.VOLTAGE, IMAGE_ASSETS.SPHERICAL_ABERRATION, MOVIE_ASSETS.PIXEL_SIZE as movie_pixel_size, IMAGE_ASSETS.X_SIZE, IMAGE_ASSETS.Y_SIZE FROM IMAGE_ASSETS LEFT OUTER JOIN MOVIE_ASSETS ON MOVIE_ASSETS.MOVIE_ASSET_ID == IMAGE_ASSETS.PARENT_MOVIE_ID WHERE IMAGE_ASSETS.IMAGE_ASSET_ID = {image} ", con)
+            df2 = pd.read_sql_query("SELECT CTF_ESTIMATION_ID,DEFOCUS1,DEFOCUS2,DEFOCUS_ANGLE,OUTPUT_DIAGNOSTIC_FILE,SCORE, DETECTED_RING_RESOLUTION, AMPLITUDE_CONTRAST FROM ESTIMATED_CTF_PARAMETERS", con)
+            pd.merge(df1, df2, on="CTF_ESTIMATION_ID")
+        with contextlib.closing(sqlite3.connect(database)) as con:
+            pd.read_sql_query(f"SELECT * FROM TEMPLATE_MATCH_LIST WHERE IMAGE_ASSET_ID={image} AND TEMPLATE_MATCH_JOB_ID=2", con)
+    for volume in volumes:
+        with contextlib.closing(sqlite3.connect(database)) as con:
+            pd.read_sql_query(f"SELECT * FROM VOLUME_ASSETS WHERE FILENAME='{volume}'", con)
+    with contextlib.closing(sqlite3.connect(database)) as con:
+        con.execute("SELECT COUNT(1) FROM TEMPLATE_MATCH_LIST WHERE TEMPLATE_MATCH_JOB_ID = 2").fetchone()
+
+
+def after(database, images, volumes):
+    for image in images:
+        get_image_info_from_db(database, image)
+        get_tm_info_from_db(database, image, 2)
+    with project_connection(database) as con:
+        for volume in volumes:
+            volume_asset_id(con, volume, 1.0)
+    get_num_already_processed_images(database, 2)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return(time.perf_counter() - start)
+
+
+with tempfile.TemporaryDirectory() as directory:
+    database = create_project(Path(directory))
+    random.seed(0)
+    images = random.sample(range(1, num_images + 1), num_lookups)
+    volumes = [f"/data/template_{random.randint(1, 1000)}.mrc" for _ in range(num_lookups)]
+    # "before" gets the first look at the file, so both run on a warm page cache
+    seconds_before = timed(before, database, images, volumes)
+    seconds_after = timed(after, database, images, volumes)
+    print(f"{num_images} images, {num_lookups} image, match and volume lookups")
+    print(f"before: {seconds_before:8.2f} s  {1000 * seconds_before / num_lookups:8.3f} ms per image")
+    print(f"after:  {seconds_after:8.2f} s  {1000 * seconds_after / num_lookups:8.3f} ms per image")
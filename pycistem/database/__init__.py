@@ -1,15 +1,18 @@
-import contextlib
-import sqlite3
 from pathlib import Path
 from selectors import EpollSelector
 from datetime import datetime
 
 import mrcfile
 import pandas as pd
-import starfile
 import mdocfile
 
 from pycistem.pycore import Project
+from pycistem.database import _export, _peaks
+from pycistem.database import _queries as queries
+from pycistem.database._connection import configure, connect, project_connection, retry_when_locked
+from pycistem.database._peaks import add_peaks
+from pycistem.database._queries import ensure_indexes
+from pycistem.database._writer import DatabaseWriter, database_writer, insert_rows, run_in_transaction
 
 from typing import Union, List, Optional
 
@@ -109,15 +112,20 @@ def import_movies(project_path: Union[str, Path], movies: Union[str, Path, List[
 
 
 
+@retry_when_locked
 def get_image_info_from_db(project,image_asset=None, get_ctf=True):
-    with contextlib.closing(sqlite3.connect(project)) as con:
+    with project_connection(project) as con:
         if image_asset is None:
-            df1 = pd.read_sql_query("SELECT IMAGE_ASSET_ID,MOVIE_ASSET_ID,IMAGE_ASSETS.FILENAME, MOVIE_ASSETS.FILENAME as movie_filename, MOVIE_ASSETS.GAIN_FILENAME, CTF_ESTIMATION_ID , ALIGNMENT_ID, IMAGE_ASSETS.PIXEL_SIZE as image_pixel_size, IMAGE_ASSETS.VOLTAGE, IMAGE_ASSETS.SPHERICAL_ABERRATION, MOVIE_ASSETS.PIXEL_SIZE as movie_pixel_size, IMAGE_ASSETS.X_SIZE, IMAGE_ASSETS.Y_SIZE FROM IMAGE_ASSETS LEFT OUTER JOIN MOVIE_ASSETS ON MOVIE_ASSETS.MOVIE_ASSET_ID == IMAGE_ASSETS.PARENT_MOVIE_ID", con)
+            df1 = pd.read_sql_query(queries.IMAGES, con)
         else:
-            df1 = pd.read_sql_query(f"SELECT IMAGE_ASSET_ID,MOVIE_ASSET_ID,IMAGE_ASSETS.FILENAME, MOVIE_ASSETS.FILENAME as movie_filename, CTF_ESTIMATION_ID , ALIGNMENT_ID, IMAGE_ASSETS.PIXEL_SIZE as image_pixel_size, IMAGE_ASSETS.VOLTAGE, IMAGE_ASSETS.SPHERICAL_ABERRATION, MOVIE_ASSETS.PIXEL_SIZE as movie_pixel_size, IMAGE_ASSETS.X_SIZE, IMAGE_ASSETS.Y_SIZE FROM IMAGE_ASSETS LEFT OUTER JOIN MOVIE_ASSETS ON MOVIE_ASSETS.MOVIE_ASSET_ID == IMAGE_ASSETS.PARENT_MOVIE_ID WHERE IMAGE_ASSETS.IMAGE_ASSET_ID = {image_asset} ", con)
+            df1 = pd.read_sql_query(queries.IMAGE, con, params=(int(image_asset),))
         if not get_ctf:
             return(df1)
-        df2 = pd.read_sql_query("SELECT CTF_ESTIMATION_ID,DEFOCUS1,DEFOCUS2,DEFOCUS_ANGLE,OUTPUT_DIAGNOSTIC_FILE,SCORE, DETECTED_RING_RESOLUTION, AMPLITUDE_CONTRAST FROM ESTIMATED_CTF_PARAMETERS",con)
+        if image_asset is None:
+            df2 = pd.read_sql_query(queries.CTF_ESTIMATES, con)
+        else:
+            ctf_ids = df1["CTF_ESTIMATION_ID"].dropna()
+            df2 = pd.read_sql_query(queries.CTF_ESTIMATE, con, params=(int(ctf_ids.iloc[0]) if len(ctf_ids) > 0 else None,))
         selected_micrographs = pd.merge(df1,df2,on="CTF_ESTIMATION_ID")
     if image_asset is None:
         return(selected_micrographs)
@@ -127,19 +135,21 @@ def get_image_info_from_db(project,image_asset=None, get_ctf=True):
         else:
             return(None)
 
+@retry_when_locked
 def get_movie_info_from_db(project):
-    with contextlib.closing(sqlite3.connect(project)) as con:
-        df1 = pd.read_sql_query("SELECT * FROM MOVIE_ASSETS", con)
+    with project_connection(project) as con:
+        df1 = pd.read_sql_query(queries.MOVIES, con)
 
     return(df1)
 
 
+@retry_when_locked
 def get_tm_info_from_db(project,image_asset,tm_id=None):
-    with contextlib.closing(sqlite3.connect(project)) as con:
+    with project_connection(project) as con:
         if tm_id is None:
-            df1 = pd.read_sql_query(f"SELECT * FROM TEMPLATE_MATCH_LIST WHERE IMAGE_ASSET_ID={image_asset}",con)
+            df1 = pd.read_sql_query(queries.MATCHES_OF_IMAGE,con,params=(int(image_asset),))
         else:
-            df1 = pd.read_sql_query(f"SELECT * FROM TEMPLATE_MATCH_LIST WHERE IMAGE_ASSET_ID={image_asset} AND TEMPLATE_MATCH_JOB_ID={tm_id}",con)
+            df1 = pd.read_sql_query(queries.MATCH_OF_IMAGE,con,params=(int(tm_id),int(image_asset)))
 
     if tm_id is None:
         return(df1)
@@ -151,91 +161,51 @@ def get_tm_info_from_db(project,image_asset,tm_id=None):
 
 
 
+@retry_when_locked
 def ensure_template_is_a_volume_asset(project: str, template_filename: str, pixel_size: float) -> int:
-    with contextlib.closing(sqlite3.connect(project)) as con:
-        df1 = pd.read_sql_query(f"SELECT * FROM VOLUME_ASSETS WHERE FILENAME='{template_filename}'",con)
-        if df1.shape[0] > 0:
-            return(df1.iloc[0]["VOLUME_ASSET_ID"])
+    with project_connection(project) as con:
+        vol_id = volume_asset_id(con, template_filename, pixel_size)
+        con.commit()
+        return(vol_id)
+
+
+def volume_asset_id(con, template_filename: str, pixel_size: float) -> int:
+    # ensure_template_is_a_volume_asset on an open connection, without committing
+    template_filename = str(template_filename)
+    df1 = pd.read_sql_query(queries.VOLUME_BY_FILENAME,con,params=(template_filename,))
+    if df1.shape[0] > 0:
+        return(df1.iloc[0]["VOLUME_ASSET_ID"])
+    else:
+        # Open using mrcfile and get dimensions
+        with mrcfile.open(template_filename) as mrc:
+            x_size = mrc.header.nx
+            y_size = mrc.header.ny
+            z_size = mrc.header.nz
+        #Get highest VOLUME_ASSET_ID
+        df2 = pd.read_sql_query(queries.MAX_VOLUME_ID,con)
+        max_id = df2.iloc[0]["max_id"]
+        if max_id is None or pd.isna(max_id):
+            vol_id = 1
         else:
-            # Open using mrcfile and get dimensions
-            with mrcfile.open(template_filename) as mrc:
-                x_size = mrc.header.nx
-                y_size = mrc.header.ny
-                z_size = mrc.header.nz
-            #Get highest VOLUME_ASSET_ID
-            df2 = pd.read_sql_query("SELECT MAX(VOLUME_ASSET_ID) as max_id FROM VOLUME_ASSETS",con)
-            max_id = df2.iloc[0]["max_id"]
-            if max_id is None:
-                vol_id = 1
-            else:
-                vol_id = max_id + 1
-            con.execute(f"INSERT INTO VOLUME_ASSETS (VOLUME_ASSET_ID,NAME,FILENAME,PIXEL_SIZE,X_SIZE,Y_SIZE,Z_SIZE) VALUES ('{vol_id}','{Path(template_filename).stem}','{template_filename}','{pixel_size}','{x_size}','{y_size}','{z_size}')")
-            con.commit()
-            return(vol_id)
+            vol_id = int(max_id) + 1
+        con.execute(queries.INSERT_VOLUME, (vol_id, Path(template_filename).stem, template_filename, float(pixel_size), int(x_size), int(y_size), int(z_size)))
+        return(vol_id)
 
 
+@retry_when_locked
 def insert_tmpackage_into_db(project, name, path):
-    with contextlib.closing(sqlite3.connect(project)) as con:
-        con.execute(f"INSERT INTO TEMPLATE_MATCHES_PACKAGE_ASSETS (NAME,STARFILE_FILENAME) VALUES ('{name}','{path}')")
+    with project_connection(project) as con:
+        con.execute(queries.INSERT_TEMPLATE_MATCHES_PACKAGE, (str(name), str(path)))
         con.commit()
 
-def write_match_template_to_starfile(project, match_template_job_id, filename,overwrite=True, switch_phi_psi=False):
-
-    result_peaks = pd.DataFrame({
-        "cisTEMOriginalImageFilename": pd.Series(dtype="object"),
-        "cisTEMReference3DFilename": pd.Series(dtype="object"),
-        "cisTEMMicroscopeVoltagekV": pd.Series(dtype="float"),
-        "cisTEMMicroscopeCsMM": pd.Series(dtype="float"),
-        "cisTEMAmplitudeContrast": pd.Series(dtype="float"),
-        "cisTEMPhaseShift": pd.Series(dtype="float"),
-        "cisTEMDefocus1": pd.Series(dtype="float"),
-        "cisTEMDefocus2": pd.Series(dtype="float"),
-        "cisTEMDefocusAngle": pd.Series(dtype="float"),
-        "cisTEMPositionInStack": pd.Series(dtype="int"),
-        "cisTEMOriginalXPosition": pd.Series(dtype="float"),
-        "cisTEMOriginalYPosition": pd.Series(dtype="float"),
-        "cisTEMAnglePsi": pd.Series(dtype="float"),
-        "cisTEMAngleTheta": pd.Series(dtype="float"),
-        "cisTEMAnglePhi": pd.Series(dtype="float"),
-        "cisTEMPixelSize": pd.Series(dtype="float"),
-        "cisTEMScore": pd.Series(dtype="float"),
-        })
-
-    with contextlib.closing(sqlite3.connect(project)) as con:
-        df1 = pd.read_sql_query(f"SELECT * FROM TEMPLATE_MATCH_LIST WHERE TEMPLATE_MATCH_JOB_ID={match_template_job_id}",con)
-        for _i, tmres in df1.iterrows():
-            image =  pd.read_sql_query(f"SELECT FILENAME FROM IMAGE_ASSETS WHERE IMAGE_ASSET_ID = {tmres['IMAGE_ASSET_ID']}",con)
-            volume = pd.read_sql_query(f"SELECT FILENAME FROM VOLUME_ASSETS WHERE VOLUME_ASSET_ID = {tmres['REFERENCE_VOLUME_ASSET_ID']}",con)
-            df2 = pd.read_sql_query(f"SELECT * FROM TEMPLATE_MATCH_PEAK_LIST_{tmres['TEMPLATE_MATCH_ID']}",con)
-            for _j, peakres in df2.iterrows():
-                new_peak_series = pd.Series([
-                    "'"+image["FILENAME"].iloc[0]+"'",
-                    "'"+volume["FILENAME"].iloc[0]+"'",
-                    tmres["USED_VOLTAGE"],
-                    tmres["USED_SPHERICAL_ABERRATION"],
-                    tmres["USED_AMPLITUDE_CONTRAST"],
-                    tmres["USED_PHASE_SHIFT"],
-                    tmres["USED_DEFOCUS1"] + peakres["DEFOCUS"],
-                    tmres["USED_DEFOCUS2"] + peakres["DEFOCUS"],
-                    tmres["USED_DEFOCUS_ANGLE"],
-                    peakres["PEAK_NUMBER"],
-                    peakres["X_POSITION"],
-                    peakres["Y_POSITION"],
-                    peakres["PSI"],
-                    peakres["THETA"],
-                    peakres["PHI"],
-                    tmres["USED_PIXEL_SIZE"],
-                    peakres["PEAK_HEIGHT"]
-                    ], index = result_peaks.columns)
-                result_peaks.loc[len(result_peaks.index)] = new_peak_series
-
-    # Due to a bug in cisTEM in earlier matches phi and psi are switched in the
-    # database
-    if(switch_phi_psi):
-        temp = result_peaks["cisTEMAnglePhi"]
-        result_peaks["cisTEMAnglePhi"] = result_peaks["cisTEMAnglePsi"]
-        result_peaks["cisTEMAnglePsi"] = temp
-    starfile.write(result_peaks, filename=filename, overwrite=overwrite)
+def write_match_template_to_starfile(project, match_template_job_id, filename,overwrite=True, switch_phi_psi=False, chunk_size=100000):
+    # Streamed, only chunk_size peaks are in memory at a time. Not retried
+    # when locked, as that would start the whole export over.
+    return(_export.export_job(project, match_template_job_id, filename, overwrite=overwrite, switch_phi_psi=switch_phi_psi, chunk_size=chunk_size))
+
+def write_match_template_jobs_to_starfiles(project, jobs, processes=1, overwrite=True, switch_phi_psi=False, chunk_size=100000):
+    """Export several template match jobs, given as ``{job id: filename}``, in up to ``processes`` processes."""
+    return(_export.export_jobs(project, jobs, processes=processes, overwrite=overwrite, switch_phi_psi=switch_phi_psi, chunk_size=chunk_size))
 
 
 def datetime_to_msdos(now):
@@ -246,55 +216,94 @@ def datetime_to_msdos(now):
 
     return msdos_datetime
 
-def create_peak_lists(con, id: int):
+def create_peak_lists(con, id: int, commit=True):
     cur = con.cursor()
     cur.execute(f"CREATE TABLE TEMPLATE_MATCH_PEAK_LIST_{id} (PEAK_NUMBER INTEGER PRIMARY KEY AUTOINCREMENT, X_POSITION REAL, Y_POSITION REAL, PSI REAL, THETA REAL, PHI REAL, DEFOCUS REAL, PIXEL_SIZE REAL, PEAK_HEIGHT REAL)")
-    con.commit()
+    if commit:
+        con.commit()
     cur.execute(f"CREATE TABLE TEMPLATE_MATCH_PEAK_CHANGE_LIST_{id} (PEAK_NUMBER INTEGER PRIMARY KEY AUTOINCREMENT, X_POSITION REAL, Y_POSITION REAL, PSI REAL, THETA REAL, PHI REAL, DEFOCUS REAL, PIXEL_SIZE REAL, PEAK_HEIGHT REAL, ORIGINAL_PEAK_NUMBER REAL, NEW_PEAK_NUMBER REAL)")
-    con.commit()
+    if commit:
+        con.commit()
 
+@retry_when_locked
 def get_max_match_template_job_id(database):
-    with contextlib.closing(sqlite3.connect(database)) as con:
+    with project_connection(database) as con:
         cur = con.cursor()
-        cur.execute("SELECT MAX(TEMPLATE_MATCH_JOB_ID) FROM TEMPLATE_MATCH_LIST")
+        cur.execute(queries.MAX_MATCH_JOB_ID)
         max_match_template_job_id = cur.fetchone()[0]
     return(max_match_template_job_id)
 
+@retry_when_locked
 def get_already_processed_images(database, match_template_job_id):
-    with contextlib.closing(sqlite3.connect(database)) as con:
-        already_processed_images = pd.read_sql_query(f"SELECT IMAGE_ASSET_ID FROM TEMPLATE_MATCH_LIST WHERE TEMPLATE_MATCH_JOB_ID = {match_template_job_id}",con)
+    with project_connection(database) as con:
+        already_processed_images = pd.read_sql_query(queries.IMAGES_OF_JOB,con,params=(int(match_template_job_id),))
     return(already_processed_images)
 
+@retry_when_locked
 def get_num_already_processed_images(database, match_template_job_id):
-    with contextlib.closing(sqlite3.connect(database)) as con:
+    with project_connection(database) as con:
         cur = con.cursor()
-        cur.execute(f"SELECT COUNT(1) FROM TEMPLATE_MATCH_LIST WHERE TEMPLATE_MATCH_JOB_ID = {match_template_job_id}")
+        cur.execute(queries.NUM_IMAGES_OF_JOB, (int(match_template_job_id),))
         num_already_processed_images = cur.fetchone()[0]
     return(num_already_processed_images)
 
+@retry_when_locked
 def get_num_matches(database, match_template_job_id):
-    with contextlib.closing(sqlite3.connect(database)) as con:
+    with project_connection(database) as con:
+        if _peaks.has_peak_table(con):
+            return(_peaks.job_summary(con, int(match_template_job_id))[1])
         cur = con.cursor()
-        cur.execute(f"SELECT TEMPLATE_MATCH_ID FROM TEMPLATE_MATCH_LIST WHERE TEMPLATE_MATCH_JOB_ID = {match_template_job_id}")
+        cur.execute(queries.MATCH_IDS_OF_JOB, (int(match_template_job_id),))
         match_template_ids = cur.fetchall()
         total = 0
         for mti in match_template_ids:
-            cur.execute(f"SELECT MAX(RowId) FROM TEMPLATE_MATCH_PEAK_LIST_{mti[0]}")
+            cur.execute(queries.MAX_PEAK_NUMBER.format(table=int(mti[0])))
             num_matches = cur.fetchone()[0]
             if num_matches is not None:
                 total += num_matches
     return(total)
 
+@retry_when_locked
+def build_peak_table(database):
+    """Collect the peaks of all template matches of the project in one indexed table.
+
+    From then on the result writers keep it up to date, and
+    :func:`get_num_matches` and :func:`select_peaks` use it.
+    """
+    with project_connection(database) as con:
+        _peaks.create_peak_table(con)
+
+@retry_when_locked
+def select_peaks(database, match_template_job_id, min_height=None):
+    """The peaks of a template match job at least ``min_height`` high, with the
+    template match and image of each."""
+    with project_connection(database) as con:
+        if _peaks.has_peak_table(con):
+            return(_peaks.select_peaks(con, int(match_template_job_id), min_height))
+        matches = pd.read_sql_query(queries.MATCHES_OF_JOB,con,params=(int(match_template_job_id),))
+        peak_lists = []
+        for tmres in matches.itertuples():
+            peak_list = pd.read_sql_query(queries.PEAKS.format(table=int(tmres.TEMPLATE_MATCH_ID)),con)
+            peak_lists.append(peak_list.assign(TEMPLATE_MATCH_ID=tmres.TEMPLATE_MATCH_ID, TEMPLATE_MATCH_JOB_ID=tmres.TEMPLATE_MATCH_JOB_ID, IMAGE_ASSET_ID=tmres.IMAGE_ASSET_ID))
+    if len(peak_lists) == 0:
+        return(pd.DataFrame(columns=["TEMPLATE_MATCH_ID", "TEMPLATE_MATCH_JOB_ID", "IMAGE_ASSET_ID", *_peaks.PEAK_COLUMNS]))
+    result = pd.concat(peak_lists, ignore_index=True)
+    if min_height is not None:
+        result = result[result["PEAK_HEIGHT"] >= min_height]
+    return(result[["TEMPLATE_MATCH_ID", "TEMPLATE_MATCH_JOB_ID", "IMAGE_ASSET_ID", *_peaks.PEAK_COLUMNS]].sort_values("PEAK_HEIGHT", ascending=False, ignore_index=True))
+
+@retry_when_locked
 def get_num_images(database):
-    with contextlib.closing(sqlite3.connect(database)) as con:
+    with project_connection(database) as con:
         cur = con.cursor()
-        cur.execute("SELECT COUNT(1) FROM IMAGE_ASSETS WHERE CTF_ESTIMATION_ID IS NOT -1")
+        cur.execute(queries.NUM_IMAGES_WITH_CTF)
         num_images = cur.fetchone()[0]
     return(num_images)
 
+@retry_when_locked
 def get_num_movies(database):
-    with contextlib.closing(sqlite3.connect(database)) as con:
+    with project_connection(database) as con:
         cur = con.cursor()
-        cur.execute("SELECT COUNT(1) FROM MOVIE_ASSETS")
+        cur.execute(queries.NUM_MOVIES)
         num_movies = cur.fetchone()[0]
     return(num_movies)
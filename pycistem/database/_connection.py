@@ -0,0 +1,169 @@
+"""Connections to project databases, shared per thread and set up for concurrent use.
+
+Every connection opened here has a busy timeout and, by default, uses WAL
+journaling, so that readers don't block the writer and two pipelines
+writing to the same project wait for each other instead of failing with
+"database is locked". WAL needs all processes on one host; for projects
+on network file systems, ``configure(journal_mode="DELETE")``.
+"""
+import contextlib
+import functools
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, replace
+
+from pycistem.database._queries import ensure_indexes
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ConnectionSettings:
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    # Negative sizes are in KiB
+    cache_size: int = -65536
+    mmap_size: int = 268435456
+    # Seconds sqlite waits for a lock before giving up
+    busy_timeout: float = 30.0
+    # Times a whole operation is retried when sqlite still reports a lock
+    retries: int = 5
+    retry_delay: float = 0.5
+    # Prepared statements each connection keeps for reuse
+    cached_statements: int = 256
+
+
+settings = ConnectionSettings()
+_local = threading.local()
+
+
+def configure(**changes):
+    """Change the :class:`ConnectionSettings` of connections opened from now on."""
+    global settings
+    settings = replace(settings, **changes)
+    return settings
+
+
+def connect(database, isolation_level="", **kwargs):
+    """A new connection to ``database`` with the busy timeout and pragmas of :data:`settings`."""
+    kwargs.setdefault("cached_statements", settings.cached_statements)
+    con = sqlite3.connect(str(database), timeout=settings.busy_timeout, isolation_level=isolation_level, **kwargs)
+    try:
+        con.execute(f"PRAGMA journal_mode={settings.journal_mode}")
+        con.execute(f"PRAGMA synchronous={settings.synchronous}")
+        con.execute(f"PRAGMA cache_size={int(settings.cache_size)}")
+        con.execute(f"PRAGMA mmap_size={int(settings.mmap_size)}")
+    except sqlite3.OperationalError:
+        # Switching the journal mode needs a moment without other
+        # connections, the database works in its current mode meanwhile
+        log.debug(f"Could not set up {database} for concurrent use", exc_info=True)
+    return con
+
+
+def _key(database):
+    return os.path.realpath(database)
+
+
+def thread_connection(database):
+    """The connection of the calling thread to ``database``, opened on first use.
+
+    Opening it creates the indexes of :mod:`pycistem.database._queries`
+    the project doesn't have yet.
+    """
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    key = _key(database)
+    if key not in connections:
+        connections[key] = connect(database)
+        ensure_indexes(connections[key])
+    return connections[key]
+
+
+def close_thread_connections():
+    """Close the connections the calling thread opened with :func:`thread_connection`."""
+    for con in getattr(_local, "connections", {}).values():
+        con.close()
+    _local.connections = {}
+
+
+@contextlib.contextmanager
+def project_connection(database):
+    """The thread's connection to ``database``, committed on leaving and rolled back on errors."""
+    con = thread_connection(database)
+    try:
+        yield con
+    except BaseException:
+        if con.in_transaction:
+            con.rollback()
+        raise
+    if con.in_transaction:
+        con.commit()
+
+
+def is_locked_error(error):
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error))
+
+
+def retry_when_locked(function):
+    """Run ``function`` again, with increasing delays, while the database stays locked beyond the busy timeout."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        for attempt in range(settings.retries + 1):
+            try:
+                return function(*args, **kwargs)
+            except sqlite3.OperationalError as error:
+                if not is_locked_error(error) or attempt == settings.retries:
+                    raise
+                delay = settings.retry_delay * 2**attempt
+                log.warning(f"{function.__name__}: {error}, retrying in {delay:.1f} s")
+                time.sleep(delay)
+
+    return wrapper
+
+
+def process_lock_holder(con):
+    """``(process id, host)`` recorded in PROCESS_LOCK, or ``None`` if the project isn't locked."""
+    try:
+        row = con.execute("SELECT ACTIVE_PROCESS, ACTIVE_HOST FROM PROCESS_LOCK").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    if row is None or not row[0]:
+        return None
+    return int(row[0]), row[1]
+
+
+def _process_is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def acquire_process_lock(con):
+    """Record this process in PROCESS_LOCK, as cisTEM does when it opens a project.
+
+    A lock of a process that no longer runs on this host is taken over.
+    Returns ``False``, leaving the lock alone, if another process holds it.
+    """
+    holder = process_lock_holder(con)
+    me = (os.getpid(), socket.gethostname())
+    if holder is not None and holder != me:
+        pid, host = holder
+        if host != me[1] or _process_is_running(pid):
+            return False
+    con.execute("CREATE TABLE IF NOT EXISTS PROCESS_LOCK(NUMBER INTEGER PRIMARY KEY, ACTIVE_PROCESS INTEGER, ACTIVE_HOST TEXT )")
+    con.execute("DELETE FROM PROCESS_LOCK")
+    con.execute("INSERT INTO PROCESS_LOCK (NUMBER, ACTIVE_PROCESS, ACTIVE_HOST) VALUES (1, ?, ?)", me)
+    if con.in_transaction:
+        con.commit()
+    return True
+
@@ -0,0 +1,117 @@
+"""Export of template match jobs to STAR files, one chunk of peaks at a time.
+
+Each chunk of peaks comes from one query joining the peaks to their
+template match, image and reference volume. The peaks come from the peak
+table of :mod:`pycistem.database._peaks` when the project has it, otherwise
+from a ``UNION ALL`` over the peak lists of a group of matches.
+"""
+import concurrent.futures
+import multiprocessing
+
+import pandas as pd
+
+from pycistem.database import _peaks
+from pycistem.database._connection import project_connection
+from pycistem.star import StarFileWriter
+
+STAR_COLUMNS = [
+    "cisTEMOriginalImageFilename",
+    "cisTEMReference3DFilename",
+    "cisTEMMicroscopeVoltagekV",
+    "cisTEMMicroscopeCsMM",
+    "cisTEMAmplitudeContrast",
+    "cisTEMPhaseShift",
+    "cisTEMDefocus1",
+    "cisTEMDefocus2",
+    "cisTEMDefocusAngle",
+    "cisTEMPositionInStack",
+    "cisTEMOriginalXPosition",
+    "cisTEMOriginalYPosition",
+    "cisTEMAnglePsi",
+    "cisTEMAngleTheta",
+    "cisTEMAnglePhi",
+    "cisTEMPixelSize",
+    "cisTEMScore",
+]
+
+# sqlite allows at most 500 SELECTs in one compound statement
+MATCHES_PER_QUERY = 200
+
+_COLUMNS = (
+    "PEAKS.TEMPLATE_MATCH_ID, IMAGE_ASSETS.FILENAME AS IMAGE_FILENAME, VOLUME_ASSETS.FILENAME AS VOLUME_FILENAME, "
+    "USED_VOLTAGE, USED_SPHERICAL_ABERRATION, USED_AMPLITUDE_CONTRAST, USED_PHASE_SHIFT, USED_DEFOCUS1, USED_DEFOCUS2, USED_DEFOCUS_ANGLE, USED_PIXEL_SIZE, "
+    "PEAKS.PEAK_NUMBER, PEAKS.X_POSITION, PEAKS.Y_POSITION, PEAKS.PSI, PEAKS.THETA, PEAKS.PHI, PEAKS.DEFOCUS, PEAKS.PEAK_HEIGHT"
+)
+_JOINS = (
+    "JOIN TEMPLATE_MATCH_LIST ON TEMPLATE_MATCH_LIST.TEMPLATE_MATCH_ID = PEAKS.TEMPLATE_MATCH_ID "
+    "LEFT OUTER JOIN IMAGE_ASSETS ON IMAGE_ASSETS.IMAGE_ASSET_ID = TEMPLATE_MATCH_LIST.IMAGE_ASSET_ID "
+    "LEFT OUTER JOIN VOLUME_ASSETS ON VOLUME_ASSETS.VOLUME_ASSET_ID = TEMPLATE_MATCH_LIST.REFERENCE_VOLUME_ASSET_ID"
+)
+_ORDER = "ORDER BY PEAKS.TEMPLATE_MATCH_ID, PEAKS.PEAK_NUMBER"
+_FROM_PEAK_TABLE = f"SELECT {_COLUMNS} FROM {_peaks.PEAK_TABLE} AS PEAKS {_JOINS} WHERE PEAKS.TEMPLATE_MATCH_JOB_ID = ? {_ORDER}"
+_PEAK_LIST = "SELECT {table} AS TEMPLATE_MATCH_ID, PEAK_NUMBER, X_POSITION, Y_POSITION, PSI, THETA, PHI, DEFOCUS, PEAK_HEIGHT FROM TEMPLATE_MATCH_PEAK_LIST_{table}"
+
+
+def _from_peak_lists(template_match_ids):
+    peak_lists = " UNION ALL ".join(_PEAK_LIST.format(table=int(template_match_id)) for template_match_id in template_match_ids)
+    return(f"SELECT {_COLUMNS} FROM ({peak_lists}) AS PEAKS {_JOINS} {_ORDER}")
+
+
+def peak_chunks(con, match_template_job_id, chunk_size=100000):
+    """The peaks of a job with their match, image and volume, as DataFrames of at most ``chunk_size`` rows."""
+    if _peaks.has_peak_table(con):
+        _peaks.sync_job(con, match_template_job_id)
+        yield from pd.read_sql_query(_FROM_PEAK_TABLE, con, params=(match_template_job_id,), chunksize=chunk_size)
+        return
+    tables = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'TEMPLATE_MATCH_PEAK_LIST_%'")}
+    template_match_ids = [
+        row[0] for row in con.execute("SELECT TEMPLATE_MATCH_ID FROM TEMPLATE_MATCH_LIST WHERE TEMPLATE_MATCH_JOB_ID = ? ORDER BY TEMPLATE_MATCH_ID", (match_template_job_id,))
+        if f"TEMPLATE_MATCH_PEAK_LIST_{row[0]}" in tables
+    ]
+    for start in range(0, len(template_match_ids), MATCHES_PER_QUERY):
+        yield from pd.read_sql_query(_from_peak_lists(template_match_ids[start:start + MATCHES_PER_QUERY]), con, chunksize=chunk_size)
+
+
+def star_rows(peaks, switch_phi_psi=False):
+    """The STAR file rows of a chunk from :func:`peak_chunks`."""
+    # Due to a bug in cisTEM in earlier matches phi and psi are switched in
+    # the database
+    psi, phi = ("PHI", "PSI") if switch_phi_psi else ("PSI", "PHI")
+    return(pd.DataFrame({
+        "cisTEMOriginalImageFilename": "'" + peaks["IMAGE_FILENAME"] + "'",
+        "cisTEMReference3DFilename": "'" + peaks["VOLUME_FILENAME"] + "'",
+        "cisTEMMicroscopeVoltagekV": peaks["USED_VOLTAGE"].astype(float),
+        "cisTEMMicroscopeCsMM": peaks["USED_SPHERICAL_ABERRATION"].astype(float),
+        "cisTEMAmplitudeContrast": peaks["USED_AMPLITUDE_CONTRAST"].astype(float),
+        "cisTEMPhaseShift": peaks["USED_PHASE_SHIFT"].astype(float),
+        "cisTEMDefocus1": (peaks["USED_DEFOCUS1"] + peaks["DEFOCUS"]).astype(float),
+        "cisTEMDefocus2": (peaks["USED_DEFOCUS2"] + peaks["DEFOCUS"]).astype(float),
+        "cisTEMDefocusAngle": peaks["USED_DEFOCUS_ANGLE"].astype(float),
+        "cisTEMPositionInStack": peaks["PEAK_NUMBER"].astype(int),
+        "cisTEMOriginalXPosition": peaks["X_POSITION"].astype(float),
+        "cisTEMOriginalYPosition": peaks["Y_POSITION"].astype(float),
+        "cisTEMAnglePsi": peaks[psi].astype(float),
+        "cisTEMAngleTheta": peaks["THETA"].astype(float),
+        "cisTEMAnglePhi": peaks[phi].astype(float),
+        "cisTEMPixelSize": peaks["USED_PIXEL_SIZE"].astype(float),
+        "cisTEMScore": peaks["PEAK_HEIGHT"].astype(float),
+    }))
+
+
+def export_job(database, match_template_job_id, filename, overwrite=True, switch_phi_psi=False, chunk_size=100000):
+    """Write the peaks of a template match job to a STAR file. Returns the number of peaks."""
+    with project_connection(database) as con, StarFileWriter(filename, STAR_COLUMNS, overwrite=overwrite) as star:
+        for peaks in peak_chunks(con, int(match_template_job_id), chunk_size):
+            star.write(star_rows(peaks, switch_phi_psi))
+    return(star.rows)
+
+
+def export_jobs(database, jobs, processes=1, **kwargs):
+    """:func:`export_job` for each ``{job id: filename}`` of ``jobs``, in up to ``processes`` processes."""
+    if processes <= 1 or len(jobs) <= 1:
+        return({job_id: export_job(database, job_id, filename, **kwargs) for job_id, filename in jobs.items()})
+    # Spawned, so that the workers don't inherit the connections of this process
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(min(processes, len(jobs)), mp_context=context) as executor:
+        futures = {job_id: executor.submit(export_job, str(database), job_id, str(filename), **kwargs) for job_id, filename in jobs.items()}
+        return({job_id: future.result() for job_id, future in futures.items()})
@@ -0,0 +1,103 @@
+"""One table with the peaks of all template matches of a project.
+
+cisTEM keeps the peaks of each template match in a table of its own,
+``TEMPLATE_MATCH_PEAK_LIST_{TEMPLATE_MATCH_ID}``. Once
+:func:`create_peak_table` has copied them into :data:`PEAK_TABLE`, the
+result writers of pycistem add new peaks to both, and :data:`SUMMARY_TABLE`
+counts the matches and peaks of each job. Peak lists changed by cisTEM
+aren't seen until the job is refreshed, which the lookups do when the
+number of matches of a job in the summary is off.
+"""
+import logging
+
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+PEAK_TABLE = "PYCISTEM_TEMPLATE_MATCH_PEAKS"
+SUMMARY_TABLE = "PYCISTEM_TEMPLATE_MATCH_JOB_SUMMARY"
+PEAK_COLUMNS = ("PEAK_NUMBER", "X_POSITION", "Y_POSITION", "PSI", "THETA", "PHI", "DEFOCUS", "PIXEL_SIZE", "PEAK_HEIGHT")
+
+_CREATE = [
+    f"CREATE TABLE IF NOT EXISTS {PEAK_TABLE} (TEMPLATE_MATCH_ID INTEGER, TEMPLATE_MATCH_JOB_ID INTEGER, IMAGE_ASSET_ID INTEGER, PEAK_NUMBER INTEGER, X_POSITION REAL, Y_POSITION REAL, PSI REAL, THETA REAL, PHI REAL, DEFOCUS REAL, PIXEL_SIZE REAL, PEAK_HEIGHT REAL, PRIMARY KEY (TEMPLATE_MATCH_ID, PEAK_NUMBER))",
+    f"CREATE INDEX IF NOT EXISTS {PEAK_TABLE}_JOB_HEIGHT ON {PEAK_TABLE} (TEMPLATE_MATCH_JOB_ID, PEAK_HEIGHT)",
+    f"CREATE INDEX IF NOT EXISTS {PEAK_TABLE}_HEIGHT ON {PEAK_TABLE} (PEAK_HEIGHT)",
+    f"CREATE TABLE IF NOT EXISTS {SUMMARY_TABLE} (TEMPLATE_MATCH_JOB_ID INTEGER PRIMARY KEY, NUMBER_OF_MATCHES INTEGER, NUMBER_OF_PEAKS INTEGER, MAX_PEAK_HEIGHT REAL)",
+]
+_COPY = f"INSERT INTO {PEAK_TABLE} (TEMPLATE_MATCH_ID, TEMPLATE_MATCH_JOB_ID, IMAGE_ASSET_ID, {', '.join(PEAK_COLUMNS)}) SELECT ?, ?, ?, {', '.join(PEAK_COLUMNS)} FROM TEMPLATE_MATCH_PEAK_LIST_{{table}}"
+_INSERT = f"INSERT INTO {PEAK_TABLE} (TEMPLATE_MATCH_ID, TEMPLATE_MATCH_JOB_ID, IMAGE_ASSET_ID, {', '.join(PEAK_COLUMNS)}) VALUES ({', '.join('?' * (3 + len(PEAK_COLUMNS)))})"
+_ADD_TO_SUMMARY = (
+    f"INSERT INTO {SUMMARY_TABLE} (TEMPLATE_MATCH_JOB_ID, NUMBER_OF_MATCHES, NUMBER_OF_PEAKS, MAX_PEAK_HEIGHT) VALUES (?, 1, ?, ?) "
+    "ON CONFLICT (TEMPLATE_MATCH_JOB_ID) DO UPDATE SET NUMBER_OF_MATCHES = NUMBER_OF_MATCHES + 1, NUMBER_OF_PEAKS = NUMBER_OF_PEAKS + excluded.NUMBER_OF_PEAKS, "
+    "MAX_PEAK_HEIGHT = COALESCE(MAX(MAX_PEAK_HEIGHT, excluded.MAX_PEAK_HEIGHT), MAX_PEAK_HEIGHT, excluded.MAX_PEAK_HEIGHT)"
+)
+_SUMMARIZE = (
+    f"INSERT OR REPLACE INTO {SUMMARY_TABLE} (TEMPLATE_MATCH_JOB_ID, NUMBER_OF_MATCHES, NUMBER_OF_PEAKS, MAX_PEAK_HEIGHT) "
+    f"SELECT TEMPLATE_MATCH_LIST.TEMPLATE_MATCH_JOB_ID, COUNT(DISTINCT TEMPLATE_MATCH_LIST.TEMPLATE_MATCH_ID), COUNT({PEAK_TABLE}.PEAK_NUMBER), MAX({PEAK_TABLE}.PEAK_HEIGHT) "
+    f"FROM TEMPLATE_MATCH_LIST LEFT OUTER JOIN {PEAK_TABLE} ON {PEAK_TABLE}.TEMPLATE_MATCH_ID = TEMPLATE_MATCH_LIST.TEMPLATE_MATCH_ID "
+    "WHERE TEMPLATE_MATCH_LIST.TEMPLATE_MATCH_JOB_ID = ? GROUP BY TEMPLATE_MATCH_LIST.TEMPLATE_MATCH_JOB_ID"
+)
+_JOB_SUMMARY = f"SELECT NUMBER_OF_MATCHES, NUMBER_OF_PEAKS, MAX_PEAK_HEIGHT FROM {SUMMARY_TABLE} WHERE TEMPLATE_MATCH_JOB_ID = ?"
+_NUM_MATCHES_OF_JOB = "SELECT COUNT(1) FROM TEMPLATE_MATCH_LIST WHERE TEMPLATE_MATCH_JOB_ID = ?"
+_SELECT_PEAKS = f"SELECT * FROM {PEAK_TABLE} WHERE TEMPLATE_MATCH_JOB_ID = ? AND PEAK_HEIGHT >= ? ORDER BY PEAK_HEIGHT DESC"
+
+
+def has_peak_table(con):
+    return(con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (SUMMARY_TABLE,)).fetchone() is not None)
+
+
+def create_peak_table(con):
+    """Create :data:`PEAK_TABLE` and :data:`SUMMARY_TABLE` and fill them with the peaks of all jobs."""
+    for statement in _CREATE:
+        con.execute(statement)
+    jobs = [row[0] for row in con.execute("SELECT DISTINCT TEMPLATE_MATCH_JOB_ID FROM TEMPLATE_MATCH_LIST")]
+    for job_id in jobs:
+        refresh_job(con, job_id)
+    log.info(f"Collected the peaks of {len(jobs)} template match jobs in {PEAK_TABLE}")
+
+
+def refresh_job(con, job_id):
+    """Copy the peak lists of job ``job_id`` into :data:`PEAK_TABLE` again."""
+    con.execute(f"DELETE FROM {PEAK_TABLE} WHERE TEMPLATE_MATCH_JOB_ID = ?", (job_id,))
+    con.execute(f"DELETE FROM {SUMMARY_TABLE} WHERE TEMPLATE_MATCH_JOB_ID = ?", (job_id,))
+    tables = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'TEMPLATE_MATCH_PEAK_LIST_%'")}
+    matches = con.execute("SELECT TEMPLATE_MATCH_ID, IMAGE_ASSET_ID FROM TEMPLATE_MATCH_LIST WHERE TEMPLATE_MATCH_JOB_ID = ?", (job_id,)).fetchall()
+    for template_match_id, image_asset_id in matches:
+        if f"TEMPLATE_MATCH_PEAK_LIST_{template_match_id}" in tables:
+            con.execute(_COPY.format(table=int(template_match_id)), (template_match_id, job_id, image_asset_id))
+    con.execute(_SUMMARIZE, (job_id,))
+
+
+def add_peaks(con, template_match_id, job_id, image_asset_id, peaks):
+    """Add the peaks of a new template match, numbered like its peak list, if the project has the peak table."""
+    if not has_peak_table(con):
+        return
+    values = zip(*(peaks[column].tolist() if column in peaks.columns else [None] * len(peaks) for column in PEAK_COLUMNS[1:]))
+    con.executemany(_INSERT, ((template_match_id, job_id, image_asset_id, number, *row) for number, row in enumerate(values, start=1)))
+    max_height = float(peaks["PEAK_HEIGHT"].max()) if len(peaks) > 0 else None
+    con.execute(_ADD_TO_SUMMARY, (job_id, len(peaks), max_height))
+
+
+def sync_job(con, job_id):
+    """Collect the peaks of job ``job_id`` again if matches were added or removed behind our back."""
+    summary = con.execute(_JOB_SUMMARY, (job_id,)).fetchone()
+    num_matches = con.execute(_NUM_MATCHES_OF_JOB, (job_id,)).fetchone()[0]
+    if (summary[0] if summary is not None else 0) != num_matches:
+        log.info(f"Peaks of template match job {job_id} changed, collecting them again")
+        refresh_job(con, job_id)
+        summary = con.execute(_JOB_SUMMARY, (job_id,)).fetchone()
+    return(summary)
+
+
+def job_summary(con, job_id):
+    """``(matches, peaks, highest peak)`` of job ``job_id``, from :data:`SUMMARY_TABLE`."""
+    summary = sync_job(con, job_id)
+    if summary is None:
+        return(0, 0, None)
+    return(tuple(summary))
+
+
+def select_peaks(con, job_id, min_height=None):
+    """The peaks of job ``job_id`` at least ``min_height`` high, highest first."""
+    sync_job(con, job_id)
+    return(pd.read_sql_query(_SELECT_PEAKS, con, params=(job_id, float("-inf") if min_height is None else float(min_height))))
@@ -0,0 +1,83 @@
+"""SQL of the pycistem.database helpers, with bound parameters.
+
+The statements are constant strings, so that the statement cache of the
+per-thread connections prepares each of them once, and the indexes below
+turn their lookups into index searches instead of full table scans. Table
+names can't be bound, the ``{table}`` statements are formatted with the
+integer id of a peak list.
+"""
+import logging
+import sqlite3
+
+log = logging.getLogger(__name__)
+
+# Index name -> (table, columns). Not part of the cisTEM schema, cisTEM
+# ignores them and sqlite keeps them up to date on every write.
+INDEXES = {
+    "PYCISTEM_TEMPLATE_MATCH_LIST_JOB_IMAGE": ("TEMPLATE_MATCH_LIST", ("TEMPLATE_MATCH_JOB_ID", "IMAGE_ASSET_ID")),
+    "PYCISTEM_IMAGE_ASSETS_CTF_ESTIMATION": ("IMAGE_ASSETS", ("CTF_ESTIMATION_ID",)),
+    "PYCISTEM_IMAGE_ASSETS_PARENT_MOVIE": ("IMAGE_ASSETS", ("PARENT_MOVIE_ID",)),
+    "PYCISTEM_VOLUME_ASSETS_FILENAME": ("VOLUME_ASSETS", ("FILENAME",)),
+    "PYCISTEM_MOVIE_ASSETS_FILENAME": ("MOVIE_ASSETS", ("FILENAME",)),
+}
+
+_IMAGE_COLUMNS = (
+    "IMAGE_ASSET_ID,MOVIE_ASSET_ID,IMAGE_ASSETS.FILENAME, MOVIE_ASSETS.FILENAME as movie_filename, MOVIE_ASSETS.GAIN_FILENAME, CTF_ESTIMATION_ID , ALIGNMENT_ID, "
+    "IMAGE_ASSETS.PIXEL_SIZE as image_pixel_size, IMAGE_ASSETS.VOLTAGE, IMAGE_ASSETS.SPHERICAL_ABERRATION, MOVIE_ASSETS.PIXEL_SIZE as movie_pixel_size, IMAGE_ASSETS.X_SIZE, IMAGE_ASSETS.Y_SIZE"
+)
+IMAGES = f"SELECT {_IMAGE_COLUMNS} FROM IMAGE_ASSETS LEFT OUTER JOIN MOVIE_ASSETS ON MOVIE_ASSETS.MOVIE_ASSET_ID == IMAGE_ASSETS.PARENT_MOVIE_ID"
+IMAGE = f"{IMAGES} WHERE IMAGE_ASSETS.IMAGE_ASSET_ID = ?"
+IMAGE_FILENAME = "SELECT FILENAME FROM IMAGE_ASSETS WHERE IMAGE_ASSET_ID = ?"
+
+_CTF_COLUMNS = "CTF_ESTIMATION_ID,DEFOCUS1,DEFOCUS2,DEFOCUS_ANGLE,OUTPUT_DIAGNOSTIC_FILE,SCORE, DETECTED_RING_RESOLUTION, AMPLITUDE_CONTRAST"
+CTF_ESTIMATES = f"SELECT {_CTF_COLUMNS} FROM ESTIMATED_CTF_PARAMETERS"
+CTF_ESTIMATE = f"{CTF_ESTIMATES} WHERE CTF_ESTIMATION_ID = ?"
+
+MOVIES = "SELECT * FROM MOVIE_ASSETS"
+
+MATCHES_OF_IMAGE = "SELECT * FROM TEMPLATE_MATCH_LIST WHERE IMAGE_ASSET_ID = ?"
+MATCH_OF_IMAGE = "SELECT * FROM TEMPLATE_MATCH_LIST WHERE TEMPLATE_MATCH_JOB_ID = ? AND IMAGE_ASSET_ID = ?"
+MATCHES_OF_JOB = "SELECT * FROM TEMPLATE_MATCH_LIST WHERE TEMPLATE_MATCH_JOB_ID = ?"
+IMAGES_OF_JOB = "SELECT IMAGE_ASSET_ID FROM TEMPLATE_MATCH_LIST WHERE TEMPLATE_MATCH_JOB_ID = ?"
+MATCH_IDS_OF_JOB = "SELECT TEMPLATE_MATCH_ID FROM TEMPLATE_MATCH_LIST WHERE TEMPLATE_MATCH_JOB_ID = ?"
+NUM_IMAGES_OF_JOB = "SELECT COUNT(1) FROM TEMPLATE_MATCH_LIST WHERE TEMPLATE_MATCH_JOB_ID = ?"
+MAX_MATCH_JOB_ID = "SELECT MAX(TEMPLATE_MATCH_JOB_ID) FROM TEMPLATE_MATCH_LIST"
+
+PEAKS = "SELECT * FROM TEMPLATE_MATCH_PEAK_LIST_{table}"
+MAX_PEAK_NUMBER = "SELECT MAX(RowId) FROM TEMPLATE_MATCH_PEAK_LIST_{table}"
+
+VOLUME_BY_FILENAME = "SELECT * FROM VOLUME_ASSETS WHERE FILENAME = ?"
+VOLUME_FILENAME = "SELECT FILENAME FROM VOLUME_ASSETS WHERE VOLUME_ASSET_ID = ?"
+MAX_VOLUME_ID = "SELECT MAX(VOLUME_ASSET_ID) as max_id FROM VOLUME_ASSETS"
+INSERT_VOLUME = "INSERT INTO VOLUME_ASSETS (VOLUME_ASSET_ID,NAME,FILENAME,PIXEL_SIZE,X_SIZE,Y_SIZE,Z_SIZE) VALUES (?,?,?,?,?,?,?)"
+
+INSERT_TEMPLATE_MATCHES_PACKAGE = "INSERT INTO TEMPLATE_MATCHES_PACKAGE_ASSETS (NAME,STARFILE_FILENAME) VALUES (?,?)"
+
+NUM_IMAGES_WITH_CTF = "SELECT COUNT(1) FROM IMAGE_ASSETS WHERE CTF_ESTIMATION_ID IS NOT -1"
+NUM_MOVIES = "SELECT COUNT(1) FROM MOVIE_ASSETS"
+
+
+def ensure_indexes(con):
+    """Create the :data:`INDEXES` missing from the database of ``con``.
+
+    Indexes of tables the database doesn't have are left out. Returns the
+    names of the indexes created.
+    """
+    existing = {name: kind for name, kind in con.execute("SELECT name, type FROM sqlite_master WHERE type IN ('table', 'index')")}
+    missing = {name: index for name, index in INDEXES.items() if name not in existing and existing.get(index[0]) == "table"}
+    if len(missing) == 0:
+        return([])
+    try:
+        for name, (table, columns) in missing.items():
+            con.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+        # Let the query planner know about the new indexes
+        con.execute("PRAGMA optimize")
+        if con.in_transaction:
+            con.commit()
+    except sqlite3.OperationalError:
+        # Read-only or busy, the queries work without the indexes
+        log.debug("Could not create indexes", exc_info=True)
+        if con.in_transaction:
+            con.rollback()
+        return([])
+    return(list(missing))
@@ -0,0 +1,211 @@
+import atexit
+import contextlib
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from pycistem.database._connection import connect, retry_when_locked
+
+log = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def _sql_value(value):
+    # sqlite3 can't bind numpy scalars
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def insert_rows(con, table, rows):
+    """Insert a DataFrame or a list of dicts with the same keys into ``table`` with one ``executemany``."""
+    if isinstance(rows, pd.DataFrame):
+        columns = list(rows.columns)
+        values = list(zip(*(rows[column].tolist() for column in columns)))
+    else:
+        if len(rows) == 0:
+            return
+        columns = list(rows[0])
+        values = [tuple(_sql_value(row[column]) for column in columns) for row in rows]
+    con.executemany(f"INSERT INTO {table} ({','.join(columns)}) VALUES ({','.join('?' * len(columns))})", values)
+
+
+def run_in_transaction(database, function, writer=None):
+    """Call ``function`` with a connection to ``database`` inside one transaction.
+
+    With a :class:`DatabaseWriter` the call is queued on its thread instead
+    and this returns right away.
+    """
+    if writer is not None:
+        writer.call(database, function)
+        return
+    with contextlib.closing(connect(database, isolation_level=None)) as con:
+        retry_when_locked(_transaction)(con, function)
+
+
+def _transaction(con, function):
+    # IMMEDIATE takes the write lock up front, so that waiting for another
+    # writer happens in the busy timeout instead of failing halfway through
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        function(con)
+    except BaseException:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
+    con.execute("COMMIT")
+
+
+class DatabaseWriter:
+    """Writes to sqlite databases on a background thread, many writes per transaction.
+
+    :meth:`execute` queues rows for one statement, which are written with
+    ``executemany`` together with the rows of the same statement queued
+    right before or after. :meth:`call` queues a function of the
+    connection, for writes that have to read the database first, e.g. for
+    the next free id. As all writes go through the thread, such a function
+    sees everything queued before it.
+
+    Queued writes are committed once ``max_rows`` rows are pending,
+    ``max_delay`` seconds after the oldest pending write, on :meth:`flush`
+    and on :meth:`close`. If a batch fails, its writes are retried one
+    transaction each, and the first error is raised by the next
+    :meth:`flush` or :meth:`close`.
+    """
+
+    def __init__(self, max_rows=10000, max_delay=1.0):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._connections = {}
+        self._error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="DatabaseWriter", daemon=True)
+                self._thread.start()
+
+    def execute(self, database, sql, rows):
+        self._start()
+        self._queue.put((str(database), sql, list(rows)))
+
+    def call(self, database, function):
+        self._start()
+        self._queue.put((str(database), function, None))
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far is committed."""
+        if self._thread is not None and self._thread.is_alive():
+            done = threading.Event()
+            self._queue.put(done)
+            if not done.wait(timeout):
+                msg = f"Database writes not committed within {timeout} s"
+                raise TimeoutError(msg)
+        self._raise_error()
+
+    def close(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _run(self):
+        pending = []
+        rows = 0
+        deadline = None
+        while True:
+            try:
+                item = self._queue.get(timeout=None if deadline is None else max(deadline - time.monotonic(), 0.0))
+            except queue.Empty:
+                item = None
+            if item is _STOP or isinstance(item, threading.Event) or item is None:
+                self._commit(pending)
+                pending, rows, deadline = [], 0, None
+                if item is _STOP:
+                    for con in self._connections.values():
+                        con.close()
+                    self._connections = {}
+                    return
+                if item is not None:
+                    item.set()
+                continue
+            pending.append(item)
+            rows += 1 if item[2] is None else len(item[2])
+            if deadline is None:
+                deadline = time.monotonic() + self.max_delay
+            if rows >= self.max_rows:
+                self._commit(pending)
+                pending, rows, deadline = [], 0, None
+
+    def _connection(self, database):
+        if database not in self._connections:
+            self._connections[database] = connect(database, isolation_level=None)
+        return self._connections[database]
+
+    def _commit(self, pending):
+        by_database = {}
+        for item in pending:
+            by_database.setdefault(item[0], []).append(item)
+        for database, items in by_database.items():
+            try:
+                self._transaction(database, items)
+            except Exception:
+                log.exception(f"Batch of {len(items)} writes to {database} failed, retrying them one by one")
+                for item in items:
+                    try:
+                        self._transaction(database, [item])
+                    except Exception as error:
+                        log.exception(f"Write to {database} failed")
+                        if self._error is None:
+                            self._error = error
+
+    @retry_when_locked
+    def _transaction(self, database, items):
+        _transaction(self._connection(database), lambda con: self._write(con, items))
+
+    @staticmethod
+    def _write(con, items):
+        index = 0
+        while index < len(items):
+            _database, statement, rows = items[index]
+            index += 1
+            if rows is None:
+                statement(con)
+                continue
+            rows = list(rows)
+            # Rows of the same statement queued in a row go in one executemany
+            while index < len(items) and items[index][1] == statement and items[index][2] is not None:
+                rows.extend(items[index][2])
+                index += 1
+            con.executemany(statement, rows)
+
+
+_shared_writer = None
+_shared_writer_lock = threading.Lock()
+
+
+def database_writer():
+    """The :class:`DatabaseWriter` shared by all result writers of this process."""
+    global _shared_writer
+    with _shared_writer_lock:
+        if _shared_writer is None:
+            _shared_writer = DatabaseWriter()
+            atexit.register(_shared_writer.close)
+        return _shared_writer
@@ -0,0 +1,130 @@
+import struct
+from dataclasses import MISSING, fields
+from operator import attrgetter
+
+import numpy as np
+
+# cisTEM's RunArgument types: type tag, struct format and numpy dtype
+_STRING_TAG = b"\x01"
+_FIXED_TYPES = {
+    int: (2, "i", "<i4"),
+    float: (3, "f", "<f4"),
+    bool: (4, "?", "?"),
+}
+_TYPE_NAMES = {"str": str, "int": int, "float": float, "bool": bool}
+
+
+class ParameterCodec:
+    """Encodes instances of one parameter dataclass into cisTEM job buffers.
+
+    The layout is worked out once per class: runs of numeric and boolean
+    fields are packed with a single precompiled :class:`struct.Struct` and
+    only strings are encoded field by field. Use :func:`codec_for` to get the
+    codec of a class.
+    """
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.fields = fields(cls)
+        self.header = (1).to_bytes(4, "little") + len(self.fields).to_bytes(4, "little")
+        # Each segment is either the index of a string field or a run of
+        # fixed size fields as (Struct, argument template, field indices)
+        self.segments = []
+        run = []
+        for i, field in enumerate(self.fields):
+            field_type = _TYPE_NAMES.get(field.type, field.type)
+            if field_type is str:
+                self._close_run(run)
+                run = []
+                self.segments.append(i)
+            elif field_type in _FIXED_TYPES:
+                run.append(i)
+            else:
+                msg = f"{cls.__name__}.{field.name} has type {field.type}, which cisTEM can't receive"
+                raise TypeError(msg)
+        self._close_run(run)
+        self._values = attrgetter(*(field.name for field in self.fields)) if self.fields else lambda parameters: ()
+
+    def _field_type(self, i):
+        field_type = self.fields[i].type
+        return _TYPE_NAMES.get(field_type, field_type)
+
+    def _close_run(self, run):
+        if not run:
+            return
+        tags = [_FIXED_TYPES[self._field_type(i)] for i in run]
+        layout = struct.Struct("<" + "".join("B" + code for _tag, code, _dtype in tags))
+        template = []
+        for tag, _code, _dtype in tags:
+            template += [tag, None]
+        self.segments.append((layout, template, run))
+
+    def encode(self, parameters):
+        values = self._values(parameters)
+        if len(self.fields) == 1:
+            values = (values,)
+        parts = [self.header]
+        for segment in self.segments:
+            if isinstance(segment, int):
+                encoded = values[segment].encode("utf-8")
+                parts.append(_STRING_TAG + len(encoded).to_bytes(4, "little") + encoded)
+            else:
+                layout, template, run = segment
+                arguments = template.copy()
+                arguments[1::2] = [values[i] for i in run]
+                parts.append(layout.pack(*arguments))
+        return b"".join(parts)
+
+    def encode_columns(self, columns, length=None):
+        """Encode a table of parameters, e.g. a :class:`pandas.DataFrame`.
+
+        ``columns`` maps field names to equally long sequences. Fields
+        without a column take their default value. Returns one buffer per
+        row.
+        """
+        if length is None:
+            length = len(next(iter(columns.values()))) if isinstance(columns, dict) else len(columns)
+        names = set(columns.keys())
+
+        def column(i):
+            field = self.fields[i]
+            if field.name in names:
+                return columns[field.name]
+            if field.default is not MISSING:
+                return [field.default] * length
+            if field.default_factory is not MISSING:
+                return [field.default_factory()] * length
+            msg = f"No column for {field.name}, which has no default"
+            raise KeyError(msg)
+
+        per_segment = []
+        for segment in self.segments:
+            if isinstance(segment, int):
+                per_segment.append([
+                    _STRING_TAG + len(encoded).to_bytes(4, "little") + encoded
+                    for encoded in (str(value).encode("utf-8") for value in column(segment))
+                ])
+            else:
+                _layout, _template, run = segment
+                dtype = []
+                for i in run:
+                    dtype += [(f"t{i}", "u1"), (f"v{i}", _FIXED_TYPES[self._field_type(i)][2])]
+                table = np.empty(length, dtype=dtype)
+                for i in run:
+                    table[f"t{i}"] = _FIXED_TYPES[self._field_type(i)][0]
+                    table[f"v{i}"] = np.asarray(column(i))
+                data = table.tobytes()
+                size = table.dtype.itemsize
+                per_segment.append([data[row * size:(row + 1) * size] for row in range(length)])
+        return [self.header + b"".join(parts) for parts in zip(*per_segment)] if per_segment else [self.header] * length
+
+
+_codecs = {}
+
+
+def codec_for(cls):
+    """The :class:`ParameterCodec` of a parameter dataclass, compiled on first use."""
+    codec = _codecs.get(cls)
+    if codec is None:
+        codec = _codecs[cls] = ParameterCodec(cls)
+    return codec
@@ -0,0 +1,59 @@
+import hashlib
+import logging
+import pickle
+import sqlite3
+
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS RESULTS (
+    PARAMETER_INDEX INTEGER PRIMARY KEY,
+    PARAMETERS_DIGEST TEXT NOT NULL,
+    RESULT BLOB NOT NULL
+)
+"""
+
+
+def parameters_digest(buffer):
+    return hashlib.sha1(buffer).hexdigest()
+
+
+class RunJournal:
+    """Results of a run, written to a sqlite file as soon as each one arrives.
+
+    Each result is stored with a digest of the job buffer it was computed
+    from, so that when the run is resumed only results of identical
+    parameter sets are replayed. Results are pickled, so only resume from
+    journals you wrote yourself.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(str(path))
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+
+    def completed(self, digests):
+        """Stored ``(parameter_index, result)`` for indices whose digest matches ``digests[index]``."""
+        completed = []
+        stale = 0
+        for parameter_index, digest, result in self._conn.execute("SELECT PARAMETER_INDEX, PARAMETERS_DIGEST, RESULT FROM RESULTS ORDER BY PARAMETER_INDEX"):
+            if parameter_index < len(digests) and digests[parameter_index] == digest:
+                completed.append((parameter_index, pickle.loads(result)))
+            else:
+                stale += 1
+        if stale:
+            log.warning(f"Ignoring {stale} results in {self.path} that belong to other parameters")
+        return completed
+
+    def record(self, parameter_index, digest, result):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO RESULTS (PARAMETER_INDEX, PARAMETERS_DIGEST, RESULT) VALUES (?, ?, ?)",
+            (parameter_index, digest, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)),
+        )
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
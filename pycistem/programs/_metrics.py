@@ -0,0 +1,217 @@
+import asyncio
+import bisect
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# Upper bounds in seconds, spanning a quick ctffind job to a full-size
+# match_template search
+LATENCY_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+HANDLER_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observed values."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {"buckets": cumulative, "sum": self.sum, "count": self.count}
+
+
+class _WorkerStats:
+
+    def __init__(self, now):
+        self.connected_at = now
+        self.disconnected_at = None
+        self.busy_seconds = 0.0
+        self.busy_since = None
+        self.jobs = 0
+
+    def busy(self, now):
+        if self.busy_since is None:
+            return self.busy_seconds
+        return self.busy_seconds + now - self.busy_since
+
+    def utilization(self, now):
+        elapsed = (self.disconnected_at or now) - self.connected_at
+        if elapsed <= 0:
+            return 0.0
+        return self.busy(now) / elapsed
+
+
+class DispatcherMetrics:
+    """Counters and histograms kept by the leader of a :class:`WorkerPool`.
+
+    ``snapshot()`` returns the current values as a dict and
+    ``to_prometheus()`` renders them in the Prometheus text format, which is
+    what :meth:`serve` answers with on every HTTP request.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.jobs_dispatched = 0
+        self.jobs_completed = 0
+        self.jobs_failed = 0
+        self.jobs_requeued = 0
+        self.result_bytes = 0
+        self.job_latency = Histogram(LATENCY_BUCKETS)
+        self.handler_time = Histogram(HANDLER_BUCKETS)
+        self.processing_time = Histogram(LATENCY_BUCKETS)
+        self.results_processing = 0
+        self.workers = {}
+        self._queued = lambda: 0
+
+    def set_queue_depth(self, function):
+        # The number of queued jobs is read from the pool when asked for
+        self._queued = function
+
+    def worker_connected(self, worker):
+        self.workers[worker] = _WorkerStats(self.clock())
+
+    def worker_disconnected(self, worker):
+        stats = self.workers.get(worker)
+        if stats is not None and stats.disconnected_at is None:
+            now = self.clock()
+            self.job_finished(worker, now)
+            stats.disconnected_at = now
+
+    def job_dispatched(self, worker):
+        self.jobs_dispatched += 1
+        stats = self.workers.get(worker)
+        if stats is not None:
+            stats.busy_since = self.clock()
+
+    def job_finished(self, worker, now=None):
+        # Stops the busy clock of the worker and returns how long the job took
+        stats = self.workers.get(worker)
+        if stats is None or stats.busy_since is None:
+            return None
+        now = self.clock() if now is None else now
+        elapsed = now - stats.busy_since
+        stats.busy_seconds += elapsed
+        stats.busy_since = None
+        return elapsed
+
+    def job_completed(self, worker):
+        self.jobs_completed += 1
+        elapsed = self.job_finished(worker)
+        if elapsed is not None:
+            self.job_latency.observe(elapsed)
+            self.workers[worker].jobs += 1
+
+    def job_failed(self, worker, requeued):
+        self.job_finished(worker)
+        if requeued:
+            self.jobs_requeued += 1
+        else:
+            self.jobs_failed += 1
+
+    def handler_finished(self, seconds, nbytes):
+        self.handler_time.observe(seconds)
+        self.result_bytes += nbytes
+
+    def processing_started(self):
+        self.results_processing += 1
+
+    def processing_finished(self, seconds):
+        self.results_processing -= 1
+        self.processing_time.observe(seconds)
+
+    def snapshot(self):
+        now = self.clock()
+        return {
+            "jobs_queued": self._queued(),
+            "jobs_dispatched": self.jobs_dispatched,
+            "jobs_completed": self.jobs_completed,
+            "jobs_failed": self.jobs_failed,
+            "jobs_requeued": self.jobs_requeued,
+            "result_bytes": self.result_bytes,
+            "job_latency_seconds": self.job_latency.snapshot(),
+            "handler_seconds": self.handler_time.snapshot(),
+            "results_processing": self.results_processing,
+            "processing_seconds": self.processing_time.snapshot(),
+            "workers": {
+                worker: {
+                    "connected": stats.disconnected_at is None,
+                    "busy": stats.busy_since is not None,
+                    "busy_seconds": stats.busy(now),
+                    "utilization": stats.utilization(now),
+                    "jobs": stats.jobs,
+                }
+                for worker, stats in self.workers.items()
+            },
+        }
+
+    def to_prometheus(self, prefix="pycistem"):
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for suffix, labels, value in samples:
+                label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+                label_text = f"{{{label_text}}}" if label_text else ""
+                lines.append(f"{prefix}_{name}{suffix}{label_text} {value}")
+
+        def histogram(name, help_text, values):
+            samples = [("_bucket", {"le": "+Inf" if bound == float("inf") else repr(bound)}, count) for bound, count in values["buckets"]]
+            samples += [("_sum", {}, values["sum"]), ("_count", {}, values["count"])]
+            metric(name, "histogram", help_text, samples)
+
+        metric("jobs_queued", "gauge", "Jobs waiting for a worker.", [("", {}, snapshot["jobs_queued"])])
+        for name in ("dispatched", "completed", "failed", "requeued"):
+            metric(f"jobs_{name}_total", "counter", f"Jobs {name}.", [("", {}, snapshot[f"jobs_{name}"])])
+        metric("result_bytes_total", "counter", "Bytes of results read from workers.", [("", {}, snapshot["result_bytes"])])
+        histogram("job_latency_seconds", "Time from dispatching a job until the worker asked for the next one.", snapshot["job_latency_seconds"])
+        histogram("handler_seconds", "Time spent in result handlers.", snapshot["handler_seconds"])
+        metric("results_processing", "gauge", "Results being processed in the executor.", [("", {}, snapshot["results_processing"])])
+        histogram("processing_seconds", "Time spent processing results in the executor.", snapshot["processing_seconds"])
+        workers = snapshot["workers"]
+        metric("worker_connected", "gauge", "Whether the worker is connected.", [("", {"worker": w}, int(s["connected"])) for w, s in workers.items()])
+        metric("worker_busy", "gauge", "Whether the worker is running a job.", [("", {"worker": w}, int(s["busy"])) for w, s in workers.items()])
+        metric("worker_busy_seconds_total", "counter", "Time the worker spent running jobs.", [("", {"worker": w}, s["busy_seconds"]) for w, s in workers.items()])
+        metric("worker_utilization", "gauge", "Fraction of its connected time the worker was busy.", [("", {"worker": w}, s["utilization"]) for w, s in workers.items()])
+        return "\n".join(lines) + "\n"
+
+    async def _handle_http(self, reader, writer):
+        try:
+            # The request itself doesn't matter, every path gets the metrics
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            body = self.to_prometheus().encode("utf-8")
+            writer.write(b"HTTP/1.1 200 OK\r\n")
+            writer.write(b"Content-Type: text/plain; version=0.0.4\r\n")
+            writer.write(f"Content-Length: {len(body)}\r\n".encode())
+            writer.write(b"Connection: close\r\n\r\n")
+            writer.write(body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port, host="127.0.0.1"):
+        """Start answering HTTP requests on ``host:port`` with the metrics.
+
+        Returns the :class:`asyncio.Server`; close it to stop serving.
+        """
+        server = await asyncio.start_server(self._handle_http, host, port)
+        log.info(f"Serving metrics on http://{host}:{server.sockets[0].getsockname()[1]}/metrics")
+        return server
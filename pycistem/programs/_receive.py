@@ -0,0 +1,77 @@
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+# Upper limit for a single read, so that the stream's own buffer stays small
+# while a large result is copied into the destination
+_CHUNK_SIZE = 1 << 20
+
+
+async def readinto(reader, buffer):
+    """Fill ``buffer`` (anything supporting the buffer protocol) from ``reader``.
+
+    Unlike ``readexactly``, the data is never assembled into one ``bytes``
+    object: it goes from the stream straight into ``buffer`` in chunks.
+    """
+    view = memoryview(buffer).cast("B")
+    filled = 0
+    while filled < len(view):
+        chunk = await reader.read(min(len(view) - filled, _CHUNK_SIZE))
+        if not chunk:
+            raise EOFError(f"Connection closed after {filled} of {len(view)} bytes")
+        view[filled:filled + len(chunk)] = chunk
+        filled += len(chunk)
+    return buffer
+
+
+class BufferPool:
+    """Reusable receive buffers for large results.
+
+    A buffer borrowed with :meth:`borrow` goes back to the pool when the
+    ``with`` block ends, so anything that has to outlive the block must be
+    copied out of it. With ``directory`` set, buffers are memory-mapped
+    temporary files there instead of anonymous memory.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._free = []
+        self._lock = threading.Lock()
+
+    def _allocate(self, nbytes):
+        if self.directory is None:
+            return np.empty(nbytes, dtype=np.uint8)
+        with tempfile.TemporaryFile(dir=self.directory) as fp:
+            fp.truncate(nbytes)
+            return np.memmap(fp, dtype=np.uint8, mode="r+", shape=(nbytes,))
+
+    def acquire(self, nbytes):
+        with self._lock:
+            # Smallest free buffer that is large enough
+            fitting = [buffer for buffer in self._free if buffer.nbytes >= nbytes]
+            if fitting:
+                buffer = min(fitting, key=lambda buffer: buffer.nbytes)
+                self._free.remove(buffer)
+                return buffer
+            if self._free:
+                # Replace the largest buffer that is too small
+                self._free.remove(max(self._free, key=lambda buffer: buffer.nbytes))
+        return self._allocate(nbytes)
+
+    def release(self, buffer):
+        with self._lock:
+            self._free.append(buffer)
+
+    @contextmanager
+    def borrow(self, nbytes):
+        buffer = self.acquire(nbytes)
+        try:
+            yield buffer[:nbytes]
+        finally:
+            self.release(buffer)
+
+    def clear(self):
+        with self._lock:
+            self._free = []
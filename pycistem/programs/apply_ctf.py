@@ -48,12 +48,12 @@ def run(parameters: Union[ApplyCtfParameters,list[ApplyCtfParameters]],**kwargs)
         parameters = [parameters]
 
 
-    asyncio.run(cistem_program.run("applyctf",parameters,**kwargs))
+    return(asyncio.run(cistem_program.run("applyctf",parameters,**kwargs)))
 
 async def run_async(parameters: Union[ApplyCtfParameters,list[ApplyCtfParameters]],**kwargs):
     if not isinstance(parameters, list):
         parameters = [parameters]
 
 
-    await cistem_program.run("applyctf",parameters,**kwargs)
+    return(await cistem_program.run("applyctf",parameters,**kwargs))
 
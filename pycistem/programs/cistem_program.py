@@ -1,15 +1,20 @@
 import asyncio
+import bisect
+import concurrent.futures
+import contextlib
 import logging
+import logging.handlers
+import os
 import secrets
 import socket
 import string
-import struct
 import subprocess
 import time
-from dataclasses import astuple, fields
+from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
-from time import sleep
 
+import mrcfile
 import psutil
 
 
@@ -26,36 +31,333 @@ from pycistem.config import config
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
+# Output of worker processes that isn't saved or sent to a sink goes here
+worker_log = logging.getLogger(f"{__name__}.worker")
 
 
 from pycistem.programs._cistem_constants import *
+from pycistem.programs._codecs import codec_for
+from pycistem.programs._journal import RunJournal, parameters_digest
+from pycistem.programs._metrics import DispatcherMetrics
+from pycistem.programs.run_profile import Cluster
 
 
 def _encode_parameters(parameters):
     # creates a cisTEM compatible buffer from the parameters class
-    buffer = b""
-    buffer += int(1).to_bytes(4,"little")
-    buffer += len(fields(parameters)).to_bytes(4,"little")
-    parameterstuple = astuple(parameters)
-    for i,argument in enumerate(fields(parameters)):
-        if argument.type == float:
-            buffer += int(3).to_bytes(1,"little")
-            buffer += struct.pack("<f", parameterstuple[i])
-        if argument.type == bool:
-            buffer += int(4).to_bytes(1,"little")
-            buffer += parameterstuple[i].to_bytes(1,"little")
-        if argument.type == str:
-            buffer += int(1).to_bytes(1,"little")
-            bb = parameterstuple[i].encode("utf-8")
-            buffer += len(bb).to_bytes(4,"little")
-            buffer += bb
-        if argument.type == int:
-            buffer += int(2).to_bytes(1,"little")
-            buffer += struct.pack("<i", parameterstuple[i])
-    return buffer
-
-
-async def handle_manager(reader, writer, identity, port):
+    return codec_for(type(parameters)).encode(parameters)
+
+
+# Parameter fields that name the image a job works on, in order of preference
+_IMAGE_FILENAME_FIELDS = (
+    "input_search_images_filename",
+    "input_search_image",
+    "input_filename",
+    "input_particle_images",
+    "input_particle_stack",
+)
+
+
+def _image_size(filename):
+    # Number of voxels according to the MRC header. Formats mrcfile can't
+    # read (e.g. tif movies) fall back to the size of the file on disk.
+    try:
+        with mrcfile.open(filename, header_only=True, permissive=True) as mrc:
+            return int(mrc.header.nx) * int(mrc.header.ny) * max(int(mrc.header.nz), 1)
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 1
+
+
+def _search_steps(search_range, step):
+    # cisTEM searches from -range to +range around the starting value
+    if step <= 0 or search_range <= 0:
+        return 1
+    return 2 * int(search_range / step) + 1
+
+
+def default_job_cost(parameters) -> float:
+    """Estimate the relative cost of a job from its parameter dataclass.
+
+    Multiplies the size of the input image, the number of search positions
+    and the number of defocus and pixel size search steps, using whichever of
+    these fields the parameter class has.
+    """
+    cost = 1.0
+    for name in _IMAGE_FILENAME_FIELDS:
+        filename = getattr(parameters, name, None)
+        if filename:
+            cost *= _image_size(filename)
+            break
+    first_search_position = getattr(parameters, "first_search_position", None)
+    last_search_position = getattr(parameters, "last_search_position", None)
+    if first_search_position is not None and last_search_position is not None:
+        cost *= max(last_search_position - first_search_position + 1, 1)
+    defocus_step = getattr(parameters, "defocus_step", getattr(parameters, "defocus_search_step", 0.0))
+    cost *= _search_steps(getattr(parameters, "defocus_search_range", 0.0), defocus_step)
+    cost *= _search_steps(getattr(parameters, "pixel_size_search_range", 0.0), getattr(parameters, "pixel_size_step", 0.0))
+    return cost
+
+
+class JobScheduler:
+    """Priority queue that hands out the most expensive pending job first.
+
+    ``cost_function`` maps a parameter dataclass to a relative cost. Jobs of
+    equal cost are handed out in submission order, so ``cost_function=None``
+    gives plain FIFO scheduling. Jobs submitted without a buffer are encoded
+    from their parameters when they are handed out.
+
+    ``memory_function`` gives the memory (in GB) a job needs. Slots of a
+    :class:`Cluster` only get jobs that fit their memory, and slower slots
+    get the most expensive job they can finish in the time the fastest slot
+    needs for the most expensive one.
+    """
+
+    def __init__(self, cost_function=default_job_cost, memory_function=None):
+        self.cost_function = cost_function
+        self.memory_function = memory_function
+        # One queue per memory requirement, so that finding the jobs that
+        # fit a slot doesn't mean looking at every job. Each holds
+        # (cost, -parameter_index, buffer), sorted before jobs are handed
+        # out, so that the next job is at the end.
+        self._queues = {}
+        self._sorted = True
+        self._length = 0
+        self._costs = {}
+        self._memory = {}
+
+    def submit(self, parameter_index, parameters, buffer=None):
+        cost = 0.0 if self.cost_function is None else self.cost_function(parameters)
+        self._costs[parameter_index] = cost
+        if self.memory_function is not None:
+            self._memory[parameter_index] = self.memory_function(parameters)
+        self._queue(parameter_index).append((cost, -parameter_index, buffer))
+        self._length += 1
+        self._sorted = False
+
+    def requeue(self, parameter_index, buffer):
+        # Put a job that was handed out back, keeping its original priority
+        self._sort()
+        bisect.insort(self._queue(parameter_index), (self._costs.get(parameter_index, 0.0), -parameter_index, buffer))
+        self._length += 1
+
+    def _queue(self, parameter_index):
+        return self._queues.setdefault(self._memory.get(parameter_index, 0.0), [])
+
+    def _sort(self):
+        if not self._sorted:
+            for queue in self._queues.values():
+                queue.sort()
+            self._sorted = True
+
+    def _fitting(self, memory):
+        return [queue for needed, queue in self._queues.items() if len(queue) > 0 and (memory is None or needed <= memory)]
+
+    def has_job(self, memory=None):
+        return len(self._fitting(memory)) > 0
+
+    def pop(self, speed=1.0, memory=None):
+        """Take the next job for a slot of relative ``speed`` and ``memory``."""
+        self._sort()
+        fitting = self._fitting(memory)
+        if len(fitting) == 0:
+            msg = "No job fits"
+            raise IndexError(msg)
+        chosen = max(fitting, key=lambda queue: queue[-1][:2])
+        position = len(chosen) - 1
+        if speed < 1.0:
+            # The most expensive job that costs at most threshold, or else
+            # the cheapest one
+            threshold = speed * chosen[-1][0]
+            candidates = [(queue, bisect.bisect_right(queue, (threshold, float("inf"))) - 1) for queue in fitting]
+            candidates = [(queue, i) for queue, i in candidates if i >= 0]
+            if len(candidates) > 0:
+                chosen, position = max(candidates, key=lambda candidate: candidate[0][candidate[1]][:2])
+            else:
+                chosen, position = min(fitting, key=lambda queue: queue[0][:2]), 0
+        _cost, negative_index, buffer = chosen.pop(position)
+        self._length -= 1
+        return -negative_index, buffer
+
+    def remove_larger_than(self, memory):
+        # Takes out the jobs that need more than memory and returns their indices
+        too_large = [needed for needed in self._queues if needed > memory]
+        removed = sorted(-negative_index for needed in too_large for _cost, negative_index, _buffer in self._queues.pop(needed))
+        self._length -= len(removed)
+        return removed
+
+    def __len__(self):
+        return self._length
+
+
+@dataclass
+class JobFailure:
+    parameter_index: int
+    attempts: int
+    reason: str
+
+
+class RunResults(list):
+    """The ``(parameter_index, result)`` tuples collected by :func:`run`.
+
+    Jobs that could not be completed within their retry budget are reported
+    in ``failures`` instead of being dropped from the list silently.
+    ``startup_latency`` is the time in seconds it took all workers to connect.
+    """
+
+    def __init__(self, results=(), failures=(), startup_latency=None):
+        super().__init__(results)
+        self.failures = list(failures)
+        self.startup_latency = startup_latency
+
+    def with_results(self, results):
+        """Other ``results``, e.g. the decoded ones, with the failures and startup latency of these."""
+        return RunResults(results, self.failures, self.startup_latency)
+
+    def attach_to(self, df):
+        """Put the failures and startup latency in the ``attrs`` of ``df``, for wrappers returning a DataFrame."""
+        df.attrs["failures"] = self.failures
+        df.attrs["startup_latency"] = self.startup_latency
+        return df
+
+
+@dataclass
+class SplitHandler:
+    """A signal handler split into receiving and processing the result.
+
+    ``receive(reader, writer, logger)`` is awaited on the event loop and
+    should only read the result off the socket. Its return value is passed
+    to ``process``, which runs in the executor of the :class:`WorkerPool`
+    while the worker already gets its next job. ``process`` must be
+    picklable if the executor is a :class:`~concurrent.futures.ProcessPoolExecutor`.
+    """
+    receive: object
+    process: object
+
+
+class _ProtocolError(Exception):
+    # A worker sent something the leader can't make sense of, after which
+    # the connection can't be trusted to be in step any more
+    pass
+
+
+# Ways a worker can disappear while the leader is talking to it
+_WORKER_LOST = (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, _ProtocolError)
+
+
+class _Batch:
+    # Book-keeping for the jobs of one submission: which are queued, which
+    # are held by a worker and how often each has been tried. Only touched
+    # by the WorkerPool while it holds its condition.
+
+    def __init__(self, scheduler, signal_handlers, max_retries=2, job_timeout=None, stream=False, parameters=()):
+        self.scheduler = scheduler
+        # Jobs submitted without a buffer are encoded when they are handed out
+        self.parameters = parameters
+        self.signal_handlers = signal_handlers
+        self.max_retries = max_retries
+        self.job_timeout = job_timeout
+        self.results = []
+        self.failures = []
+        self.attempts = {}
+        self.held = {}
+        self.finished = asyncio.Event()
+        # When streaming, results are handed to the consumer through this
+        # queue instead of being collected, followed by None once finished
+        self.queue = asyncio.Queue() if stream else None
+        self._completed = set()
+        # Jobs whose result was received and is being processed
+        self.processing = set()
+        # Set when results are journaled, with a digest of each job buffer
+        self.journal = None
+        self.digests = None
+
+    def pop(self, speed=1.0, memory=None):
+        parameter_index, buffer = self.scheduler.pop(speed, memory)
+        if buffer is None:
+            buffer = _encode_parameters(self.parameters[parameter_index])
+        self.attempts[parameter_index] = self.attempts.get(parameter_index, 0) + 1
+        self.held[parameter_index] = buffer
+        return parameter_index, buffer
+
+    def add_result(self, parameter_index, result, journaled=False):
+        if self.journal is not None and not journaled:
+            self.journal.record(parameter_index, self.digests[parameter_index], result)
+        if self.queue is not None:
+            self.queue.put_nowait((parameter_index, result))
+        else:
+            self.results.append((parameter_index, result))
+        self._completed.add(parameter_index)
+
+    def job_done(self, parameter_index):
+        self._completed.add(parameter_index)
+        self.held.pop(parameter_index, None)
+        self._check_finished()
+
+    def job_failed(self, parameter_index, reason, requeue=True):
+        if parameter_index not in self.held:
+            # Already given up on by fail_held()
+            return
+        buffer = self.held.pop(parameter_index)
+        if parameter_index in self._completed:
+            # The result already arrived, only the next job request was lost
+            pass
+        elif requeue and self.attempts[parameter_index] <= self.max_retries:
+            log.warning(f"Requeueing parameter set {parameter_index} after attempt {self.attempts[parameter_index]}: {reason}")
+            self.scheduler.requeue(parameter_index, buffer)
+        else:
+            self.failures.append(JobFailure(parameter_index, self.attempts[parameter_index], reason))
+        self._check_finished()
+
+    def fail_remaining(self, reason):
+        while len(self.scheduler) > 0:
+            parameter_index, _buffer = self.scheduler.pop()
+            self.failures.append(JobFailure(parameter_index, self.attempts.get(parameter_index, 0), reason))
+        self._check_finished()
+
+    def result_received(self, parameter_index):
+        # The job is done as far as the worker is concerned, but the batch
+        # isn't finished before its result is processed
+        self._completed.add(parameter_index)
+        self.processing.add(parameter_index)
+
+    def result_processed(self, parameter_index, result):
+        self.processing.discard(parameter_index)
+        self.add_result(parameter_index, result)
+        self._check_finished()
+
+    def processing_failed(self, parameter_index, reason):
+        self.processing.discard(parameter_index)
+        self.failures.append(JobFailure(parameter_index, self.attempts.get(parameter_index, 0), reason))
+        self._check_finished()
+
+    def fail_unplaceable(self, memory):
+        for parameter_index in self.scheduler.remove_larger_than(memory):
+            self.failures.append(JobFailure(parameter_index, 0, f"needs more memory than the {memory} GB of the largest slot"))
+        self._check_finished()
+
+    def fail_held(self, reason):
+        for parameter_index in list(self.held):
+            self.job_failed(parameter_index, reason, requeue=False)
+
+    def _check_finished(self):
+        if len(self.scheduler) == 0 and len(self.held) == 0 and len(self.processing) == 0 and not self.finished.is_set():
+            self.finished.set()
+            if self.queue is not None:
+                self.queue.put_nowait(None)
+
+
+async def _read_signal(reader, timeout):
+    # Every message from a worker starts with a 16 byte signal. A worker that
+    # stays silent for longer than timeout is considered dead.
+    if timeout is None:
+        return await reader.readexactly(16)
+    return await asyncio.wait_for(reader.readexactly(16), timeout)
+
+
+async def handle_manager(reader, writer, dispatcher):
     # Handles initial connection from the executable and directs them to the leader
     addr = writer.get_extra_info("peername")
     #logger.info(f"{addr} connected to manager")
@@ -68,210 +370,704 @@ async def handle_manager(reader, writer, identity, port):
         return
     data = await reader.readexactly(16)
     message= data.decode()
-    if message != identity:
-        log.error(f"{addr!r} {message} is not {identity}: wrong process connected")
+    registered = dispatcher.identities.get(message)
+    if registered is None:
+        log.error(f"{addr!r} {message} is not a known identity: wrong process connected")
         writer.close()
         return
-    writer.write(socket_you_are_a_worker)
-    host = HOST.encode("utf-8")
-    writer.write(len(host).to_bytes(4,"little"))
-    writer.write(host)
-    port = str(port).encode("utf-8")
-    writer.write(len(port).to_bytes(4,"little"))
-    writer.write(port)
-    await writer.drain()
-    time.sleep(1)
+    async with dispatcher._handing_over(addr[0], registered):
+        writer.write(socket_you_are_a_worker)
+        host = HOST.encode("utf-8")
+        writer.write(len(host).to_bytes(4,"little"))
+        writer.write(host)
+        port = str(dispatcher.port_leader).encode("utf-8")
+        writer.write(len(port).to_bytes(4,"little"))
+        writer.write(port)
+        await writer.drain()
+    # Give the worker time to read the leader address before hanging up,
+    # without holding up the handshakes of other workers
+    await asyncio.sleep(1)
     #logger.info(f"{addr} connected")
     writer.close()
 
-async def handle_leader(reader, writer, buffers, signal_handlers,results):
-    log_str = ""
+class _CountingReader:
+    # Passed to the signal handlers so that the bytes they read are counted
+
+    def __init__(self, reader):
+        self._reader = reader
+        self.nbytes = 0
+
+    async def read(self, n=-1):
+        data = await self._reader.read(n)
+        self.nbytes += len(data)
+        return data
+
+    async def readexactly(self, n):
+        data = await self._reader.readexactly(n)
+        self.nbytes += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._reader, name)
+
+
+async def _call_handler(handler, reader, writer, metrics):
+    counting_reader = _CountingReader(reader)
+    start = time.monotonic()
+    result = await handler(counting_reader, writer, log)
+    metrics.handler_finished(time.monotonic() - start, counting_reader.nbytes)
+    return result
+
+
+async def _receive_result(handler, reader, writer, pool, batch, parameter_index):
+    if isinstance(handler, SplitHandler):
+        payload = await _call_handler(handler.receive, reader, writer, pool.metrics)
+        batch.result_received(parameter_index)
+        pool._start_processing(batch, parameter_index, handler.process, payload)
+    else:
+        batch.add_result(parameter_index, await _call_handler(handler, reader, writer, pool.metrics))
+
+
+async def _run_job(reader, writer, pool, batch, parameter_index, buffer):
+    signal_handlers = batch.signal_handlers
+    heartbeat_timeout = pool.heartbeat_timeout
+    metrics = pool.metrics
+    writer.write(socket_ready_to_send_single_job)
+    writer.write(len(buffer).to_bytes(8,"little"))
+    writer.write(buffer)
+    await writer.drain()
+
+    if len(signal_handlers) > 0:
+        while True:
+            data = await _read_signal(reader, heartbeat_timeout)
+            if data == socket_job_result_queue or data == socket_i_have_info:
+                await _call_handler(signal_handlers[data], reader, writer, metrics)
+                continue
+            if data not in signal_handlers:
+                msg = f"unexpected signal {data}"
+                raise _ProtocolError(msg)
+            await _receive_result(signal_handlers[data], reader, writer, pool, batch, parameter_index)
+            break
+    if socket_send_next_job not in signal_handlers:
+        while True:
+            data = await _read_signal(reader, heartbeat_timeout)
+            if data == socket_job_result_queue:
+                await _call_handler(signal_handlers[data], reader, writer, metrics)
+                continue
+            if data != socket_send_next_job:
+                msg = f"unexpected signal {data} instead of a request for the next job"
+                raise _ProtocolError(msg)
+            await reader.readexactly(8)
+            break
+
+
+async def handle_leader(reader, writer, pool, slot=None):
     # Handles connections from the executable asking for work
 
     addr = writer.get_extra_info("peername")
+    worker = f"{addr[0]}:{addr[1]}"
 
-    writer.write(socket_you_are_connected)
-    await writer.drain()
-    data = await reader.readexactly(16)
-    if data != socket_send_next_job:
-        log.error(f"{addr!r} did not request next job, instead sent {data}")
+    try:
+        writer.write(socket_you_are_connected)
+        await writer.drain()
+        data = await _read_signal(reader, pool.heartbeat_timeout)
+        if data != socket_send_next_job:
+            log.error(f"{addr!r} did not request next job, instead sent {data}")
+            writer.close()
+            return
+        data = await reader.readexactly(8)
+    except _WORKER_LOST as ex:
+        log.error(f"{addr!r} disconnected before requesting a job: {ex!r}")
         writer.close()
         return
-    data = await reader.readexactly(8)
-    #logger.info(f"{addr} sent {data} as dummy result")
-    while len(buffers) > 0:
-        parameter_index, buffer = buffers.pop(0)
-        log.debug(f"Working on parameter set {parameter_index}")
-        writer.write(socket_ready_to_send_single_job)
-        writer.write(len(buffer).to_bytes(8,"little"))
-        writer.write(buffer)
-        await writer.drain()
+    if pool._launch_time is not None:
+        pool.worker_connected()
+    if slot is not None:
+        worker = slot.name
+    pool.metrics.worker_connected(worker)
 
-        # check length of signal_handlers
-        if len(signal_handlers) > 0:
-            cont = True
-            while cont:
-                data = await reader.readexactly(16)
-                # log.debug(f"In no sig {addr} sent {data}")
-                result = None
-                if data != socket_job_result_queue and data != socket_i_have_info:
-                    cont = False
-                else:
-                    await signal_handlers[data](reader,writer,log)
-                    log_str += "J"
-                    continue
-                if data in signal_handlers:
-                    #logger.info(f"{addr} sent {data} and I know what to do with it")
-                    result = await signal_handlers[data](reader,writer,log)
-                    results.append((parameter_index,result))
-                    log_str += "R"
-                else:
-                    log.error(f"{addr} sent {data} and I don't know what to do with it, really {log_str}")
-
-                    #logger.error(f"{buffer}")
-                    break
-        cont = True
-        while cont:
-            if socket_send_next_job not in signal_handlers:
-                data = await reader.readexactly(16)
-                # log.debug(f"In cont {addr} sent {data}")
-                if data != socket_send_next_job:
-                    if data == socket_job_result_queue:
-                        res = await signal_handlers[data](reader,writer,log)
-                        log_str += "j"
-                        continue
-                    else:
-                        log.error(f"{addr!r} did not request next job, instead sent {data}")
-                data = await reader.readexactly(8)
-                log_str += "N"
-                cont = False
-                #logger.info(f"{addr} sent {data} after requesting next results")
+    while True:
+        job = await pool.next_job(slot)
+        if job is None:
+            break
+        batch, parameter_index, buffer = job
+        log.debug(f"Working on parameter set {parameter_index}")
+        pool.metrics.job_dispatched(worker)
+        try:
+            await asyncio.wait_for(
+                _run_job(reader, writer, pool, batch, parameter_index, buffer), batch.job_timeout
+            )
+        except _WORKER_LOST as ex:
+            if isinstance(ex, asyncio.TimeoutError):
+                reason = "timed out"
+            elif isinstance(ex, _ProtocolError):
+                reason = str(ex)
             else:
-                cont = False
+                reason = f"worker disconnected ({ex!r})"
+            log.error(f"{addr!r} lost while working on parameter set {parameter_index}: {reason}")
+            await pool.job_failed(batch, parameter_index, reason, worker=worker)
+            pool.metrics.worker_disconnected(worker)
+            writer.close()
+            return
+        await pool.job_done(batch, parameter_index, worker=worker)
+    pool.metrics.worker_disconnected(worker)
+
     log.debug(f"{addr} finished, sending time to die")
-    writer.write(socket_time_to_die)
-    await writer.drain()
-    data = await reader.read(16)
-    #logger.info(f"{addr} sent {data}")
-    data = await reader.read(16)
-    #logger.info(f"{addr} sent {data}")
-    data = await reader.read(16)
-    #logger.info(f"{addr} sent {data}")
-    
+    try:
+        writer.write(socket_time_to_die)
+        await writer.drain()
+        for _i in range(3):
+            await reader.read(16)
+    except ConnectionError:
+        pass
     writer.close()
 
 
-async def run(executable: str,parameters,signal_handlers={},num_procs=1,num_threads=1, cmd_prefix="", cmd_suffix="", save_output=False, save_output_path="",sleep_time=0.1):
-    results = []
-    buffers = []
-    # Set HOST to curretn ip address
-    #'127.0.0.1'  # Standard loopback interface address (localhost)
-
-    # Create secret to identify workers
-    alphabet = string.ascii_letters + string.digits
-    identity = "".join(secrets.choice(alphabet) for i in range(16))
-    buffers = [(i,_encode_parameters(parameter)) for i, parameter in enumerate(parameters)]
-    log.debug(f"Secret is {identity}")
-
-    # Start the leader
-    start_port = 3000
-    leader_started = False
-    while not leader_started:
+async def _start_server(callback, start_port):
+    # Binds to the first free port at or above start_port
+    while True:
         try:
-            server_leader = await asyncio.start_server(
-                lambda r,w : handle_leader(r,w, buffers,signal_handlers,results), "", start_port, family=socket.AF_INET)
-            leader_started = True
-            start_port += 1
+            return await asyncio.start_server(callback, "", start_port, family=socket.AF_INET)
         except OSError:
             log.debug(f"Port {start_port} already in use, trying next port")
             start_port += 1
             if start_port > 4000:
                 msg = "No ports available"
-                raise OSError(msg)
-    port_leader = server_leader.sockets[0].getsockname()[1]
-    addrs = ", ".join(str(sock.getsockname()) for sock in server_leader.sockets)
-    log.debug(f"Serving leader on {addrs}")
-
-    # Start the manager
-    manager_started = False
-    while not manager_started:
-        try:
-            server_manager = await asyncio.start_server(
-                lambda r,w : handle_manager(r,w,identity,port_leader), "",start_port, family=socket.AF_INET)
-            manager_started = True
-        except OSError:
-            log.debug(f"Port {start_port} already in use, trying next port")
-            start_port += 1
-            if start_port > 4000:
-                msg = "No ports available"
-                raise OSError(msg)
-    port_manager = server_manager.sockets[0].getsockname()[1]
-    addrs = ", ".join(str(sock.getsockname()) for sock in server_manager.sockets)
-    log.debug(f"Serving manager on {addrs}")
+                raise OSError(msg) from None
+
+
+class Dispatcher:
+    """The leader and manager servers that workers connect to.
+
+    Every :class:`WorkerPool` starts its own unless it is given one, so that
+    pools of several executables can share one pair of ports and one event
+    loop, e.g. to overlap CPU-bound ctffind with GPU-bound match_template::
+
+        async with Dispatcher() as dispatcher:
+            ctf_pool = WorkerPool("ctffind", 16, dispatcher=dispatcher)
+            mt_pool = WorkerPool("match_template_gpu", 8, dispatcher=dispatcher)
+            async with ctf_pool, mt_pool:
+                await asyncio.gather(
+                    ctffind.run_async(ctf_parameters, pool=ctf_pool),
+                    match_template.run_async(mt_parameters, pool=mt_pool),
+                )
+    """
+
+    def __init__(self):
+        self.port_leader = None
+        self.port_manager = None
+        # Identity a worker presents to the manager -> (pool, slot)
+        self.identities = {}
+        self.pools = []
+        # Set by WorkerPools that start their own dispatcher
+        self.private = False
+        self._servers = []
+        self._host_locks = {}
+        self._pending = {}
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def start(self):
+        server_leader = await _start_server(self._handle_leader, 3000)
+        self.port_leader = server_leader.sockets[0].getsockname()[1]
+        addrs = ", ".join(str(sock.getsockname()) for sock in server_leader.sockets)
+        log.debug(f"Serving leader on {addrs}")
+
+        server_manager = await _start_server(lambda r,w : handle_manager(r,w,self), self.port_leader + 1)
+        self.port_manager = server_manager.sockets[0].getsockname()[1]
+        addrs = ", ".join(str(sock.getsockname()) for sock in server_manager.sockets)
+        log.debug(f"Serving manager on {addrs}")
+        self._servers = [server_leader, server_manager]
+
+    def register(self, identity, pool, slot=None):
+        self.identities[identity] = (pool, slot)
+        if pool not in self.pools:
+            self.pools.append(pool)
+
+    def unregister(self, pool):
+        self.identities = {identity: registered for identity, registered in self.identities.items() if registered[0] is not pool}
+        if pool in self.pools:
+            self.pools.remove(pool)
+
+    @contextlib.asynccontextmanager
+    async def _handing_over(self, host, registered):
+        # Only one worker per host is between the manager handshake and
+        # connecting to the leader at a time, so the next connection from
+        # that host belongs to the same pool and slot. The leader address is
+        # sent inside this block, so the claim is in place before the worker
+        # can connect. Not needed if there is only one pool and no slots to
+        # tell apart.
+        pool, slot = registered
+        if self.private and slot is None:
+            yield
+            return
+        lock = self._host_locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            claimed = asyncio.get_running_loop().create_future()
+            self._pending[host] = (registered, claimed)
+            try:
+                yield
+                await asyncio.wait_for(claimed, 30)
+            except asyncio.TimeoutError:
+                name = pool.executable if slot is None else f"{pool.executable} on slot {slot.name}"
+                log.warning(f"Worker of {name} did not connect to the leader")
+            finally:
+                self._pending.pop(host, None)
+
+    def _claim(self, host):
+        pending = self._pending.pop(host, None)
+        if pending is None:
+            return None
+        registered, claimed = pending
+        if not claimed.done():
+            claimed.set_result(None)
+        return registered
+
+    async def _handle_leader(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        registered = self._claim(addr[0])
+        if registered is None:
+            if len(self.pools) != 1:
+                log.error(f"{addr!r} connected to the leader without identifying to the manager first")
+                writer.close()
+                return
+            registered = (self.pools[0], None)
+        pool, slot = registered
+        await handle_leader(reader, writer, pool, slot)
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+        self._servers = []
+
+
+class WorkerPool:
+    """A set of running workers of one cisTEM executable.
+
+    The workers stay connected between calls to :meth:`run`, so repeated
+    small submissions don't pay for process startup and the handshake every
+    time. A pool lives on the event loop it was started on::
 
+        async with WorkerPool("ctffind", num_procs=8) as pool:
+            first = await ctffind.run_async(parameters, pool=pool)
+            second = await ctffind.run_async(more_parameters, pool=pool)
 
-    # Starting workers
-    cmd = str(Path(config["CISTEM_PATH"]) / executable)
-    cmd += f" {HOST} {port_manager} {identity} {num_threads}"
+    Queue depth, job latencies and worker utilization are kept in
+    ``metrics`` (see :class:`DispatcherMetrics`) and, if ``metrics_port`` is
+    given, served in the Prometheus text format on that local port. Pass a
+    started :class:`Dispatcher` to share its ports with other pools.
+    """
 
-    # Test if cmd_prefix is iterable
-    if type(num_procs) == int and type(cmd_prefix) == str:
-        cmd_prefix = [cmd_prefix for i in range(num_procs)]
+    def __init__(self, executable: str, num_procs=1, num_threads=1, cmd_prefix="", cmd_suffix="", save_output=False, save_output_path="", sleep_time=0.1, heartbeat_timeout=None, output_sink=None, max_log_bytes=10_000_000, log_backup_count=3, metrics_port=None, executor=None, max_pending_results=None, dispatcher=None):
+        self.executable = executable
+        self.num_procs = num_procs
+        self.num_threads = num_threads
+        self.cmd_prefix = cmd_prefix
+        self.cmd_suffix = cmd_suffix
+        self.save_output = save_output
+        self.save_output_path = save_output_path
+        self.sleep_time = sleep_time
+        self.heartbeat_timeout = heartbeat_timeout
+        self.output_sink = output_sink
+        self.max_log_bytes = max_log_bytes
+        self.log_backup_count = log_backup_count
+        self.identity = None
+        # Each slot of a Cluster identifies with its own secret, so that the
+        # leader knows which slot a connection belongs to
+        self.slot_identities = {}
+        self.cluster = None
+        self.dispatcher = dispatcher
+        self._own_dispatcher = dispatcher is None
+        self.port_leader = None
+        self.port_manager = None
+        self.processes = []
+        self._batches = []
+        self._closing = False
+        self._changed = None
+        self._live_processes = None
+        self._loop = None
+        self._servers = []
+        self._watchers = []
+        self._launch_time = None
+        self._connect_times = []
+        self.metrics_port = metrics_port
+        self.metrics = DispatcherMetrics()
+        self.metrics.set_queue_depth(lambda: sum(len(batch.scheduler) for batch in self._batches))
+        # Results of SplitHandlers are processed in executor. Once
+        # max_pending_results are waiting for it, workers don't get new jobs.
+        self.executor = executor
+        self._own_executor = executor is None
+        workers = getattr(executor, "_max_workers", None) or os.cpu_count() or 1
+        self.max_pending_results = max_pending_results if max_pending_results is not None else 2 * workers
+        self._pending_results = 0
+        self._processing_tasks = set()
 
-    if type(num_procs) == int and type(cmd_suffix) == str:
-        cmd_suffix = [cmd_suffix for i in range(num_procs)]
+    async def __aenter__(self):
+        await self.start()
+        return self
 
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
 
+    async def start(self):
+        await self.start_servers()
+        await self.launch_workers()
 
-    launch_futures = []
-    if type(num_procs) == int:
-        tasks = [cmd_prefix[i] + cmd +cmd_suffix[i] for i in range(num_procs)]
-    elif type(num_procs) == RunProfile:
+    async def start_servers(self):
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Condition()
+
+        # Create secret to identify workers
+        alphabet = string.ascii_letters + string.digits
+        self.identity = "".join(secrets.choice(alphabet) for i in range(16))
+        log.debug(f"Secret is {self.identity}")
+
+        if self._own_dispatcher:
+            self.dispatcher = Dispatcher()
+            self.dispatcher.private = True
+            await self.dispatcher.start()
+        self.dispatcher.register(self.identity, self)
+        self.port_leader = self.dispatcher.port_leader
+        self.port_manager = self.dispatcher.port_manager
+        if self.metrics_port is not None:
+            self._servers.append(await self.metrics.serve(self.metrics_port))
+
+    def _worker_commands(self):
+        # Returns (command, delay in seconds before launching the next one)
+        # for every worker process to start
+        num_procs = self.num_procs
+        cmd_prefix = self.cmd_prefix
+        cmd_suffix = self.cmd_suffix
+        executable_path = str(Path(config["CISTEM_PATH"]) / self.executable)
+
+        if isinstance(num_procs, int):
+            cmd = executable_path + f" {HOST} {self.port_manager} {self.identity} {self.num_threads}"
+            # Test if cmd_prefix is iterable
+            if isinstance(cmd_prefix, str):
+                cmd_prefix = [cmd_prefix for i in range(num_procs)]
+            if isinstance(cmd_suffix, str):
+                cmd_suffix = [cmd_suffix for i in range(num_procs)]
+            return [(cmd_prefix[i] + cmd + cmd_suffix[i], self.sleep_time) for i in range(num_procs)]
+
+        # A Cluster or a RunProfile: $command stands for the executable and
+        # its arguments, as in cisTEM's own job control. The profile itself
+        # is left untouched so that it can be used again.
+        self.cluster = num_procs if isinstance(num_procs, Cluster) else Cluster.from_run_profile(num_procs)
+        alphabet = string.ascii_letters + string.digits
         tasks = []
-        num_procs.SubstituteExecutableName(executable)
-        for rc in num_procs.run_commands:
-            for _i in range(rc.number_of_copies):
-                tasks.append(rc.command_to_run)
+        for slot in self.cluster.slots:
+            identity = "".join(secrets.choice(alphabet) for i in range(16))
+            self.slot_identities[identity] = slot
+            cmd = executable_path + f" {HOST} {self.port_manager} {identity} {slot.threads}"
+            tasks.append((slot.command.replace("$command", cmd), slot.delay_time_in_ms / 1000.0))
+        return tasks
 
-    for task in tasks:
-        launch_futures.append(await asyncio.create_subprocess_shell(
-        task,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.STDOUT))
-        sleep(sleep_time)
+    async def _launch_worker(self, i, command, delay):
+        await asyncio.sleep(delay)
+        try:
+            process = await asyncio.create_subprocess_shell(
+                command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT)
+        except OSError as ex:
+            log.error(f"Could not launch worker {i}: {ex!r}")
+            await self._process_exited()
+            return
+        self.processes[i] = process
+        await self._watch_process(i, process)
 
-    logging.debug(f"Launched {num_procs} processes")
+    async def launch_workers(self):
+        # Processes are started concurrently, each one after the summed delays
+        # of the ones before it, and the handshakes of workers that are
+        # already up proceed while the remaining ones are still launching.
+        tasks = self._worker_commands()
+        for identity, slot in self.slot_identities.items():
+            self.dispatcher.register(identity, self, slot)
+        self.processes = [None] * len(tasks)
+        self._live_processes = len(tasks)
+        self._launch_time = time.monotonic()
+        self._connect_times = []
+        offset = 0.0
+        for i, (command, delay) in enumerate(tasks):
+            self._watchers.append(asyncio.ensure_future(self._launch_worker(i, command, offset)))
+            offset += delay
+        logging.debug(f"Launching {len(tasks)} processes")
 
+    def worker_connected(self):
+        self._connect_times.append(time.monotonic() - self._launch_time)
+        if len(self._connect_times) == len(self.processes):
+            log.info(f"All {len(self.processes)} workers connected {self.startup_latency:.2f} s after launch")
 
-    #if save_output:
-    #    while True:
-    #        for i, future in enumerate(launch_futures):
-    #            line = await future.stdout.readline()
-    #            if line:
-    #                print(f"Pro {i}:")
-    #                print(line)
+    @property
+    def startup_latency(self):
+        # Seconds from launching the workers until the last one connected to
+        # the leader, or None while some are still missing
+        if not self.processes or len(self._connect_times) < len(self.processes):
+            return None
+        return max(self._connect_times)
 
+    def _output_handler(self, i):
+        # Returns a callable taking one line of output of worker i, and the
+        # file handler behind it that needs closing, if any
+        if self.output_sink is not None:
+            return partial(self.output_sink, i), None
+        if self.save_output:
+            handler = logging.handlers.RotatingFileHandler(
+                self.save_output_path + f"_{i}.txt", maxBytes=self.max_log_bytes, backupCount=self.log_backup_count
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            return (lambda line: handler.emit(logging.makeLogRecord({"msg": line, "levelno": logging.INFO}))), handler
 
-    result_futures = [
-            future.communicate()
-            for future in launch_futures
-        ]
-    
+        def to_worker_log(line):
+            if worker_log.isEnabledFor(logging.DEBUG):
+                worker_log.debug(f"Worker {i}: {line}")
+        return to_worker_log, None
 
-    try:
-        proc_results = await asyncio.gather(*result_futures, return_exceptions=False)
-    except Exception as ex:
-        print("Caught error executing task", ex)
-        raise
-    finally:
-        if save_output:
-            for i, result in enumerate(proc_results):
-                with open(save_output_path + f"_{i}.txt", "w") as f:
-                    f.write(result[0].decode("utf-8"))
-                if result[1] and len(result[1]) > 0:
-                    with open(save_output_path + f"_{i}_error.txt", "w") as f:
-                        f.write(result[1].decode("utf-8"))
-    server_leader.close()
-    server_manager.close()
-    return(results)
+    async def _pump_output(self, i, process):
+        # stderr is merged into stdout, which is passed on line by line so
+        # that memory use doesn't grow with the amount of output
+        write, handler = self._output_handler(i)
+        try:
+            while True:
+                try:
+                    line = await process.stdout.readline()
+                except ValueError:
+                    log.warning(f"Dropped an overlong line of output from worker {i}")
+                    continue
+                if not line:
+                    break
+                write(line.decode("utf-8", errors="replace").rstrip("\n"))
+        finally:
+            if handler is not None:
+                handler.close()
+
+    async def _watch_process(self, i, process):
+        await self._pump_output(i, process)
+        await process.wait()
+        await self._process_exited()
+
+    async def _process_exited(self):
+        async with self._changed:
+            self._live_processes -= 1
+            if self._live_processes > 0 or self._closing:
+                return
+            log.error("All worker processes exited")
+            for batch in self._batches:
+                batch.fail_remaining("no worker left to run the job")
+        # Connections of workers that just exited might not have noticed yet
+        try:
+            await asyncio.wait_for(self._wait_batches_finished(), 10)
+        except asyncio.TimeoutError:
+            async with self._changed:
+                for batch in self._batches:
+                    batch.fail_held("worker process exited")
+
+    async def _wait_batches_finished(self):
+        await asyncio.gather(*(batch.finished.wait() for batch in list(self._batches)))
+
+    async def next_job(self, slot=None):
+        # Idle workers wait here until there is work they can take or the
+        # pool closes
+        speed = 1.0 if slot is None else slot.speed / self.cluster.max_speed
+        memory = None if slot is None else slot.memory
+        async with self._changed:
+            await self._changed.wait_for(
+                lambda: self._closing or (
+                    self._pending_results < self.max_pending_results
+                    and any(batch.scheduler.has_job(memory) for batch in self._batches)
+                )
+            )
+            for batch in self._batches:
+                if batch.scheduler.has_job(memory):
+                    parameter_index, buffer = batch.pop(speed, memory)
+                    return batch, parameter_index, buffer
+            return None
+
+    def _start_processing(self, batch, parameter_index, process, payload):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(self.max_pending_results // 2, 1))
+        self._pending_results += 1
+        task = asyncio.ensure_future(self._process_result(batch, parameter_index, process, payload))
+        self._processing_tasks.add(task)
+        task.add_done_callback(self._processing_tasks.discard)
+
+    async def _process_result(self, batch, parameter_index, process, payload):
+        self.metrics.processing_started()
+        start = time.monotonic()
+        try:
+            result = await self._loop.run_in_executor(self.executor, process, payload)
+        except Exception as ex:
+            log.error(f"Processing the result of parameter set {parameter_index} failed: {ex!r}")
+            async with self._changed:
+                batch.processing_failed(parameter_index, f"processing failed ({ex!r})")
+                self._pending_results -= 1
+                self._changed.notify_all()
+            return
+        finally:
+            self.metrics.processing_finished(time.monotonic() - start)
+        async with self._changed:
+            batch.result_processed(parameter_index, result)
+            self._pending_results -= 1
+            self._changed.notify_all()
+
+    async def job_done(self, batch, parameter_index, worker=None):
+        async with self._changed:
+            batch.job_done(parameter_index)
+            self.metrics.job_completed(worker)
+            self._changed.notify_all()
+
+    async def job_failed(self, batch, parameter_index, reason, worker=None):
+        async with self._changed:
+            failures = len(batch.failures)
+            batch.job_failed(parameter_index, reason, requeue=self._live_processes != 0)
+            self.metrics.job_failed(worker, requeued=len(batch.failures) == failures)
+            self._changed.notify_all()
+
+    async def _submit(self, parameters, stream, signal_handlers={}, scheduler=None, cost_function=default_job_cost, max_retries=2, job_timeout=None, buffers=None, journal=None, resume=None):
+        if self._loop is not asyncio.get_running_loop():
+            msg = "WorkerPool is not running on this event loop"
+            raise RuntimeError(msg)
+        if scheduler is None:
+            scheduler = JobScheduler(cost_function=cost_function)
+        if buffers is not None and len(buffers) != len(parameters):
+            msg = f"Got {len(buffers)} buffers for {len(parameters)} parameter sets"
+            raise ValueError(msg)
+        batch = _Batch(scheduler, signal_handlers, max_retries=max_retries, job_timeout=job_timeout, stream=stream, parameters=parameters)
+
+        replayed = ()
+        replayed_from_journal = False
+        if journal is not None or resume is not None:
+            # Journaled jobs are identified by their buffer, so these can't
+            # be encoded lazily
+            if buffers is None:
+                buffers = [_encode_parameters(parameter) for parameter in parameters]
+            batch.digests = [parameters_digest(buffer) for buffer in buffers]
+            batch.journal = RunJournal(journal if journal is not None else resume)
+            if resume is not None:
+                previous = batch.journal if journal is None or Path(journal) == Path(resume) else RunJournal(resume)
+                replayed = previous.completed(batch.digests)
+                replayed_from_journal = previous is batch.journal
+                if not replayed_from_journal:
+                    previous.close()
+                log.info(f"Replaying {len(replayed)} of {len(parameters)} results from {resume}")
+        for parameter_index, result in replayed:
+            batch.add_result(parameter_index, result, journaled=replayed_from_journal)
+        if buffers is None:
+            buffers = [None] * len(parameters)
+        for i, parameter in enumerate(parameters):
+            if i not in batch._completed:
+                scheduler.submit(i, parameter, buffers[i])
+        if self.cluster is not None and scheduler.memory_function is not None and self.cluster.max_memory is not None:
+            batch.fail_unplaceable(self.cluster.max_memory)
+        async with self._changed:
+            if self._live_processes == 0:
+                batch.fail_remaining("no worker left to run the job")
+            self._batches.append(batch)
+            batch._check_finished()
+            self._changed.notify_all()
+        return batch
+
+    async def _retire(self, batch):
+        async with self._changed:
+            self._batches.remove(batch)
+        if batch.journal is not None:
+            batch.journal.close()
+        for failure in batch.failures:
+            log.error(f"Parameter set {failure.parameter_index} failed after {failure.attempts} attempts: {failure.reason}")
+
+    async def run(self, parameters, signal_handlers={}, scheduler=None, cost_function=default_job_cost, max_retries=2, job_timeout=None, buffers=None, journal=None, resume=None):
+        """Run a job for every parameter set and return the :class:`RunResults`.
+
+        Buffers are encoded from the parameters as jobs are handed out,
+        unless they were encoded upfront and passed as ``buffers``, e.g. with
+        ``codec_for(cls).encode_columns(table)``. With ``journal`` set, every
+        result is also written to that file as soon as it arrives, and
+        ``resume`` replays the results of an earlier run from its journal
+        instead of running those jobs again (and keeps writing to it unless
+        ``journal`` names another file).
+        """
+        batch = await self._submit(parameters, stream=False, signal_handlers=signal_handlers, scheduler=scheduler, cost_function=cost_function, max_retries=max_retries, job_timeout=job_timeout, buffers=buffers, journal=journal, resume=resume)
+        try:
+            await batch.finished.wait()
+        finally:
+            await self._retire(batch)
+        return(RunResults(batch.results, batch.failures, self.startup_latency))
+
+    async def run_iter(self, parameters, signal_handlers={}, scheduler=None, cost_function=default_job_cost, max_retries=2, job_timeout=None, failures=None, buffers=None, journal=None, resume=None):
+        # Yields (parameter_index, result) as each job completes. Results are
+        # not kept, and jobs that failed are appended to failures if given.
+        batch = await self._submit(parameters, stream=True, signal_handlers=signal_handlers, scheduler=scheduler, cost_function=cost_function, max_retries=max_retries, job_timeout=job_timeout, buffers=buffers, journal=journal, resume=resume)
+        try:
+            while True:
+                item = await batch.queue.get()
+                if item is None:
+                    break
+                yield item
+        finally:
+            await self._retire(batch)
+            if failures is not None:
+                failures.extend(batch.failures)
+
+    async def close(self):
+        # Idle workers are sent time to die and the processes are waited for
+        if self._changed is not None:
+            async with self._changed:
+                self._closing = True
+                for batch in self._batches:
+                    batch.fail_remaining("worker pool closed")
+                self._changed.notify_all()
+        try:
+            await asyncio.gather(*self._watchers)
+            await asyncio.gather(*self._processing_tasks)
+        except Exception as ex:
+            print("Caught error executing task", ex)
+            raise
+        finally:
+            for server in self._servers:
+                server.close()
+            if self.dispatcher is not None:
+                self.dispatcher.unregister(self)
+                if self._own_dispatcher:
+                    await self.dispatcher.close()
+            if self._own_executor and self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+
+
+async def run(executable: str,parameters,signal_handlers={},num_procs=1,num_threads=1, cmd_prefix="", cmd_suffix="", save_output=False, save_output_path="",sleep_time=0.1, scheduler=None, cost_function=default_job_cost, max_retries=2, job_timeout=None, heartbeat_timeout=None, pool=None, output_sink=None, max_log_bytes=10_000_000, log_backup_count=3, metrics_port=None, buffers=None, journal=None, resume=None, dispatcher=None):
+    batch_kwargs = {"signal_handlers": signal_handlers, "scheduler": scheduler, "cost_function": cost_function, "max_retries": max_retries, "job_timeout": job_timeout, "buffers": buffers, "journal": journal, "resume": resume}
+    if pool is not None:
+        if pool.executable != executable:
+            msg = f"WorkerPool runs {pool.executable}, not {executable}"
+            raise ValueError(msg)
+        return await pool.run(parameters, **batch_kwargs)
+
+    async with WorkerPool(executable, num_procs=num_procs, num_threads=num_threads, cmd_prefix=cmd_prefix, cmd_suffix=cmd_suffix, save_output=save_output, save_output_path=save_output_path, sleep_time=sleep_time, heartbeat_timeout=heartbeat_timeout, output_sink=output_sink, max_log_bytes=max_log_bytes, log_backup_count=log_backup_count, metrics_port=metrics_port, dispatcher=dispatcher) as pool:
+        return await pool.run(parameters, **batch_kwargs)
+
+
+async def run_iter(executable: str, parameters, signal_handlers={}, pool=None, scheduler=None, cost_function=default_job_cost, max_retries=2, job_timeout=None, failures=None, buffers=None, journal=None, resume=None, **pool_kwargs):
+    """Like :func:`run`, but yields ``(parameter_index, result)`` as soon as each job completes.
+
+    Use with ``async for``. Other keyword arguments (``num_procs``,
+    ``cmd_prefix``, ...) are passed on to :class:`WorkerPool` unless an
+    existing ``pool`` is given. Jobs that failed are appended to
+    ``failures`` if a list is passed.
+    """
+    batch_kwargs = {"signal_handlers": signal_handlers, "scheduler": scheduler, "cost_function": cost_function, "max_retries": max_retries, "job_timeout": job_timeout, "failures": failures, "buffers": buffers, "journal": journal, "resume": resume}
+    if pool is not None:
+        if pool.executable != executable:
+            msg = f"WorkerPool runs {pool.executable}, not {executable}"
+            raise ValueError(msg)
+        async for item in pool.run_iter(parameters, **batch_kwargs):
+            yield item
+        return
 
+    async with WorkerPool(executable, **pool_kwargs) as pool:
+        async for item in pool.run_iter(parameters, **batch_kwargs):
+            yield item
@@ -1,15 +1,13 @@
 import asyncio
 import datetime
-import sqlite3
 import struct
 from dataclasses import dataclass
 from pathlib import Path
 from typing import List, Union
 
 import mrcfile
-import pandas as pd
 
-from pycistem.database import datetime_to_msdos, get_image_info_from_db
+from pycistem.database import datetime_to_msdos, get_image_info_from_db, insert_rows, run_in_transaction
 from pycistem.programs import cistem_program
 from pycistem.programs._cistem_constants import socket_send_next_job
 
@@ -79,26 +77,21 @@ def parameters_from_database(database, decolace=False, **kwargs):
     return((par, image_info))
 
 
-def write_results_to_database(database,  parameters: list[CtffindParameters], results, image_info):
-    conn = sqlite3.connect(database, isolation_level=None)
-    cur = conn.cursor()
+def write_results_to_database(database,  parameters: list[CtffindParameters], results, image_info, writer=None):
+    """Add the results as a new CTF estimation job and make them the current estimates of their images.
+
+    With a :class:`~pycistem.database.DatabaseWriter` as ``writer`` the
+    rows are queued on its thread instead of written before returning.
+    """
     results = sorted(results, key=lambda x: x["parameter_index"])
     ESTIMATED_CTF_PARAMETERS_LIST = []
 
-    max_ctf_estimation_id= cur.execute("SELECT MAX(CTF_ESTIMATION_ID) FROM ESTIMATED_CTF_PARAMETERS").fetchone()[0]
-    if max_ctf_estimation_id is None:
-        max_ctf_estimation_id = 0
-    ctf_estimation_job_id= cur.execute("SELECT MAX(CTF_ESTIMATION_JOB_ID) FROM ESTIMATED_CTF_PARAMETERS").fetchone()[0]
-    if ctf_estimation_job_id is None:
-        ctf_estimation_job_id = 1
-    else:
-        ctf_estimation_job_id += 1
-
     for result in results:
 
         ESTIMATED_CTF_PARAMETERS_LIST.append({
-            "CTF_ESTIMATION_ID": max_ctf_estimation_id + 1,
-            "CTF_ESTIMATION_JOB_ID": ctf_estimation_job_id,
+            # Both ids are assigned when the rows are written
+            "CTF_ESTIMATION_ID": None,
+            "CTF_ESTIMATION_JOB_ID": None,
             "DATETIME_OF_RUN": datetime_to_msdos(datetime.datetime.now()),
             "IMAGE_ASSET_ID": image_info.loc[result["parameter_index"]]["IMAGE_ASSET_ID"],
             "ESTIMATED_ON_MOVIE_FRAMES": True,
@@ -144,22 +137,29 @@ def write_results_to_database(database,  parameters: list[CtffindParameters], re
              "RESAMPLE_IF_NESCESSARY": parameters[result["parameter_index"]].resample_if_pixel_too_small,
              "TARGET_PIXEL_SIZE": parameters[result["parameter_index"]].target_pixel_size_after_resampling
         })
-        #print("UPDATE IMAGE_ASSETS SET CTF_ESTIMATION_ID = ? WHERE IMAGE_ASSET_ID = ?",  (max_ctf_estimation_id + 1, image_info.loc[result["parameter_index"]]["IMAGE_ASSET_ID"]))
-        #cur.execute("UPDATE IMAGE_ASSETS SET CTF_ESTIMATION_ID = ? WHERE IMAGE_ASSET_ID = ?",  (max_ctf_estimation_id + 1, image_info.loc[result["parameter_index"]]["IMAGE_ASSET_ID"]))
-        max_ctf_estimation_id += 1
-
-    ESTIMATED_CTF_PARAMETERS_LIST = pd.DataFrame(ESTIMATED_CTF_PARAMETERS_LIST)
-    ESTIMATED_CTF_PARAMETERS_LIST.to_sql("ESTIMATED_CTF_PARAMETERS", conn, if_exists="append", index=False)
-    
-    cur = conn.cursor()
-    cur.executemany("UPDATE IMAGE_ASSETS SET CTF_ESTIMATION_ID = ? WHERE IMAGE_ASSET_ID = ?",[
-        (row["CTF_ESTIMATION_ID"], row["IMAGE_ASSET_ID"])
-        for i, row in ESTIMATED_CTF_PARAMETERS_LIST.iterrows()
-    ])
-    conn.commit()
-    # Update CTF_ESTIMATION_ID in IMAGE_ASSETS table
-
-    conn.close()
+
+    def write(conn):
+        cur = conn.cursor()
+        max_ctf_estimation_id= cur.execute("SELECT MAX(CTF_ESTIMATION_ID) FROM ESTIMATED_CTF_PARAMETERS").fetchone()[0]
+        if max_ctf_estimation_id is None:
+            max_ctf_estimation_id = 0
+        ctf_estimation_job_id= cur.execute("SELECT MAX(CTF_ESTIMATION_JOB_ID) FROM ESTIMATED_CTF_PARAMETERS").fetchone()[0]
+        if ctf_estimation_job_id is None:
+            ctf_estimation_job_id = 1
+        else:
+            ctf_estimation_job_id += 1
+        for row in ESTIMATED_CTF_PARAMETERS_LIST:
+            max_ctf_estimation_id += 1
+            row["CTF_ESTIMATION_ID"] = max_ctf_estimation_id
+            row["CTF_ESTIMATION_JOB_ID"] = ctf_estimation_job_id
+        insert_rows(conn, "ESTIMATED_CTF_PARAMETERS", ESTIMATED_CTF_PARAMETERS_LIST)
+        # Update CTF_ESTIMATION_ID in IMAGE_ASSETS table
+        cur.executemany("UPDATE IMAGE_ASSETS SET CTF_ESTIMATION_ID = ? WHERE IMAGE_ASSET_ID = ?",[
+            (row["CTF_ESTIMATION_ID"], int(row["IMAGE_ASSET_ID"]))
+            for row in ESTIMATED_CTF_PARAMETERS_LIST
+        ])
+
+    run_in_transaction(database, write, writer)
 
 async def handle_results(reader, writer, logger):
     #logger.info("Handling results")
@@ -175,44 +175,42 @@ signal_handlers = {
     socket_send_next_job : handle_results
 }
 
+def _decode_result(parameter_index, byte_result):
+    defocus1 = struct.unpack("<f",byte_result[0:4])[0]
+    defocus2 = struct.unpack("<f",byte_result[4:8])[0]
+    astigmatism_angle = struct.unpack("<f",byte_result[8:12])[0]
+    phase_shift = struct.unpack("<f",byte_result[12:16])[0]
+    score = struct.unpack("<f",byte_result[16:20])[0]
+    fit_resolution = struct.unpack("<f",byte_result[20:24])[0]
+    aliasing_resolution = struct.unpack("<f",byte_result[24:28])[0]
+    iciness = struct.unpack("<f",byte_result[28:32])[0]
+    tilt_angle = struct.unpack("<f",byte_result[32:36])[0]
+    tilt_axis = struct.unpack("<f",byte_result[36:40])[0]
+    sample_thickness = struct.unpack("<f",byte_result[40:44])[0]
+
+    return({
+        "parameter_index" : parameter_index,
+        "defocus1" : defocus1,
+        "defocus2" : defocus2,
+        "astigmatism_angle" : astigmatism_angle,
+        "phase_shift" : phase_shift,
+        "score" : score,
+        "fit_resolution" : fit_resolution,
+        "aliasing_resolution" : aliasing_resolution,
+        "iciness" : iciness,
+        "tilt_angle" : tilt_angle,
+        "tilt_axis" : tilt_axis,
+        "sample_thickness" : sample_thickness
+    })
+
 def run(parameters: Union[CtffindParameters,list[CtffindParameters]],**kwargs):
 
     if not isinstance(parameters, list):
         parameters = [parameters]
 
     byte_results = asyncio.run(cistem_program.run("ctffind", parameters, signal_handlers=signal_handlers,**kwargs))
-    result_ctf = []
-
-    for parameter_index,byte_result in byte_results:
-        defocus1 = struct.unpack("<f",byte_result[0:4])[0]
-        defocus2 = struct.unpack("<f",byte_result[4:8])[0]
-        astigmatism_angle = struct.unpack("<f",byte_result[8:12])[0]
-        phase_shift = struct.unpack("<f",byte_result[12:16])[0]
-        score = struct.unpack("<f",byte_result[16:20])[0]
-        fit_resolution = struct.unpack("<f",byte_result[20:24])[0]
-        aliasing_resolution = struct.unpack("<f",byte_result[24:28])[0]
-        iciness = struct.unpack("<f",byte_result[28:32])[0]
-        tilt_angle = struct.unpack("<f",byte_result[32:36])[0]
-        tilt_axis = struct.unpack("<f",byte_result[36:40])[0]
-        sample_thickness = struct.unpack("<f",byte_result[40:44])[0]
-
-        result_ctf.append({
-            "parameter_index" : parameter_index,
-            "defocus1" : defocus1,
-            "defocus2" : defocus2,
-            "astigmatism_angle" : astigmatism_angle,
-            "phase_shift" : phase_shift,
-            "score" : score,
-            "fit_resolution" : fit_resolution,
-            "aliasing_resolution" : aliasing_resolution,
-            "iciness" : iciness,
-            "tilt_angle" : tilt_angle,
-            "tilt_axis" : tilt_axis,
-            "sample_thickness" : sample_thickness
-        })
-
 
-    return(result_ctf)
+    return(byte_results.with_results([_decode_result(parameter_index, byte_result) for parameter_index, byte_result in byte_results]))
 
 async def run_async(parameters: Union[CtffindParameters,list[CtffindParameters]],**kwargs):
 
@@ -220,35 +218,13 @@ async def run_async(parameters: Union[CtffindParameters,list[CtffindParameters]]
         parameters = [parameters]
 
     byte_results = await cistem_program.run("ctffind", parameters, signal_handlers=signal_handlers,**kwargs)
-    result_ctf = []
-
-    for parameter_index,byte_result in byte_results:
-        defocus1 = struct.unpack("<f",byte_result[0:4])[0]
-        defocus2 = struct.unpack("<f",byte_result[4:8])[0]
-        astigmatism_angle = struct.unpack("<f",byte_result[8:12])[0]
-        phase_shift = struct.unpack("<f",byte_result[12:16])[0]
-        score = struct.unpack("<f",byte_result[16:20])[0]
-        fit_resolution = struct.unpack("<f",byte_result[20:24])[0]
-        aliasing_resolution = struct.unpack("<f",byte_result[24:28])[0]
-        iciness = struct.unpack("<f",byte_result[28:32])[0]
-        tilt_angle = struct.unpack("<f",byte_result[32:36])[0]
-        tilt_axis = struct.unpack("<f",byte_result[36:40])[0]
-        sample_thickness = struct.unpack("<f",byte_result[40:44])[0]
-
-        result_ctf.append({
-            "parameter_index" : parameter_index,
-            "defocus1" : defocus1,
-            "defocus2" : defocus2,
-            "astigmatism_angle" : astigmatism_angle,
-            "phase_shift" : phase_shift,
-            "score" : score,
-            "fit_resolution" : fit_resolution,
-            "aliasing_resolution" : aliasing_resolution,
-            "iciness" : iciness,
-            "tilt_angle" : tilt_angle,
-            "tilt_axis" : tilt_axis,
-            "sample_thickness" : sample_thickness
-        })
 
+    return(byte_results.with_results([_decode_result(parameter_index, byte_result) for parameter_index, byte_result in byte_results]))
+
+async def run_iter(parameters: Union[CtffindParameters,list[CtffindParameters]],**kwargs):
+
+    if not isinstance(parameters, list):
+        parameters = [parameters]
 
-    return(result_ctf)
\ No newline at end of file
+    async for parameter_index, byte_result in cistem_program.run_iter("ctffind", parameters, signal_handlers=signal_handlers,**kwargs):
+        yield parameter_index, _decode_result(parameter_index, byte_result)
@@ -43,6 +43,10 @@ async def handle_job_result_queue(reader, writer, logger):
 
 def run(parameters: Union[EstimateBeamtiltParameters,list[EstimateBeamtiltParameters]],**kwargs) -> pd.DataFrame:
 
+    return(asyncio.run(run_async(parameters, **kwargs)))
+
+async def run_async(parameters: Union[EstimateBeamtiltParameters,list[EstimateBeamtiltParameters]],**kwargs) -> pd.DataFrame:
+
     if not isinstance(parameters, list):
         parameters = [parameters]
     signal_handlers = {
@@ -50,11 +54,11 @@ def run(parameters: Union[EstimateBeamtiltParameters,list[EstimateBeamtiltParame
         socket_job_result_queue : handle_job_result_queue,
 
     }   
-    result = asyncio.run(cistem_program.run("estimate_beamtilt", parameters, signal_handlers=signal_handlers,**kwargs))
-    result = pd.DataFrame([a[1] for a in result],
-                            index = [a[0] for a in result],
+    results = await cistem_program.run("estimate_beamtilt", parameters, signal_handlers=signal_handlers,**kwargs)
+    result = pd.DataFrame([a[1] for a in results],
+                            index = [a[0] for a in results],
                             columns=["score","beam_tilt_x","beam_tilt_y","particle_shift_x","particle_shift_y"])
-    return(result)
+    return(results.attach_to(result))
         
         
         
\ No newline at end of file
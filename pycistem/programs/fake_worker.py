@@ -0,0 +1,229 @@
+"""A stand-in for a cisTEM executable that speaks the worker side of the socket protocol.
+
+It lets the dispatcher in :mod:`pycistem.programs.cistem_program` be tested
+and benchmarked without cisTEM. Use it through ``cmd_prefix``, which puts it
+in front of the executable path and the arguments the leader passes::
+
+    cistem_program.run("ctffind", parameters, num_procs=8,
+        cmd_prefix="python -m pycistem.programs.fake_worker --duration 0.01 ")
+
+or run :class:`FakeWorker` on the event loop of the test itself.
+"""
+import argparse
+import asyncio
+import logging
+import random
+import struct
+
+from pycistem.programs._cistem_constants import (
+    socket_i_have_info,
+    socket_job_result_queue,
+    socket_please_identify,
+    socket_program_defined_result,
+    socket_ready_to_send_single_job,
+    socket_send_next_job,
+    socket_sending_identification,
+    socket_time_to_die,
+    socket_you_are_a_worker,
+    socket_you_are_connected,
+)
+
+log = logging.getLogger(__name__)
+
+
+def decode_arguments(buffer):
+    # Inverse of cistem_program._encode_parameters
+    number_of_arguments = int.from_bytes(buffer[4:8], "little")
+    arguments = []
+    offset = 8
+    for _i in range(number_of_arguments):
+        kind = buffer[offset]
+        offset += 1
+        if kind == 1:
+            length = int.from_bytes(buffer[offset:offset + 4], "little")
+            arguments.append(buffer[offset + 4:offset + 4 + length].decode("utf-8"))
+            offset += 4 + length
+        elif kind == 2:
+            arguments.append(struct.unpack_from("<i", buffer, offset)[0])
+            offset += 4
+        elif kind == 3:
+            arguments.append(struct.unpack_from("<f", buffer, offset)[0])
+            offset += 4
+        elif kind == 4:
+            arguments.append(bool(buffer[offset]))
+            offset += 1
+        else:
+            msg = f"Unknown argument type {kind}"
+            raise ValueError(msg)
+    return arguments
+
+
+class FakeWorker:
+    """Simulated worker process.
+
+    Each job takes ``duration`` seconds (plus up to ``jitter`` seconds),
+    multiplied by the job argument at ``duration_argument`` if given and
+    divided by ``speed`` to simulate slower or faster hosts. It then answers
+    with ``payload_floats`` floats, either as the data that follows
+    ``socket_send_next_job`` (like ctffind and unblur) or, with
+    ``result_signal="program_defined"``, as a ``socket_program_defined_result``
+    (like match_template) whose result number is the argument at
+    ``result_number_argument``. ``queue_results`` and ``send_info`` add a
+    ``socket_job_result_queue`` and ``socket_i_have_info`` message to every
+    job. With probability ``fail_rate``, or once ``crash_after`` jobs are
+    done, the worker drops its connection in the middle of a job; with
+    ``hang_rate`` it stops answering instead.
+    """
+
+    def __init__(self, duration=0.0, jitter=0.0, speed=1.0, duration_argument=None, payload_floats=0, result_signal="next_job", result_number_argument=None, queue_results=False, send_info=False, fail_rate=0.0, hang_rate=0.0, crash_after=None, seed=None):
+        self.duration = duration
+        self.jitter = jitter
+        self.speed = speed
+        self.duration_argument = duration_argument
+        self.payload_floats = payload_floats
+        self.result_signal = result_signal
+        self.result_number_argument = result_number_argument
+        self.queue_results = queue_results
+        self.send_info = send_info
+        self.fail_rate = fail_rate
+        self.hang_rate = hang_rate
+        self.crash_after = crash_after
+        self.jobs_done = 0
+        self._random = random.Random(seed)
+        self._payload = struct.pack(f"<{payload_floats}f", *range(payload_floats))
+
+    async def run(self, host, port, identity):
+        """Identify to the manager on ``port``, then work for the leader it names."""
+        leader_hosts, leader_port = await self.identify(host, port, identity)
+        await self.work(leader_hosts, leader_port)
+
+    async def identify(self, host, port, identity):
+        reader, writer = await _open_connection(host, port)
+        if await reader.readexactly(16) != socket_please_identify:
+            msg = "Manager did not ask for identification"
+            raise ConnectionError(msg)
+        writer.write(socket_sending_identification + identity.encode("utf-8"))
+        await writer.drain()
+        if await reader.readexactly(16) != socket_you_are_a_worker:
+            msg = "Manager did not accept this worker"
+            raise ConnectionError(msg)
+        length = int.from_bytes(await reader.readexactly(4), "little")
+        leader_hosts = (await reader.readexactly(length)).decode("utf-8")
+        length = int.from_bytes(await reader.readexactly(4), "little")
+        leader_port = int((await reader.readexactly(length)).decode("utf-8"))
+        writer.close()
+        return leader_hosts, leader_port
+
+    async def work(self, host, port):
+        reader, writer = await _open_connection(host, port)
+        if await reader.readexactly(16) != socket_you_are_connected:
+            msg = "Leader did not accept the connection"
+            raise ConnectionError(msg)
+        writer.write(socket_send_next_job + bytes(8))
+        await writer.drain()
+        try:
+            while True:
+                signal = await reader.readexactly(16)
+                if signal == socket_time_to_die:
+                    break
+                if signal != socket_ready_to_send_single_job:
+                    log.warning(f"Unexpected signal {signal}")
+                    continue
+                length = int.from_bytes(await reader.readexactly(8), "little")
+                buffer = await reader.readexactly(length)
+                if not await self._run_job(writer, buffer):
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            log.debug("Leader went away")
+        writer.close()
+
+    async def _run_job(self, writer, buffer):
+        # Returns False if the worker should stop
+        delay = self.duration
+        if self.duration_argument is not None:
+            delay *= float(decode_arguments(buffer)[self.duration_argument])
+        if self.jitter:
+            delay += self._random.uniform(0, self.jitter)
+        delay /= self.speed
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if (self.crash_after is not None and self.jobs_done >= self.crash_after) or self._random.random() < self.fail_rate:
+            return False
+        if self._random.random() < self.hang_rate:
+            await asyncio.Event().wait()
+
+        if self.send_info:
+            message = f"Job {self.jobs_done} done".encode("utf-8")
+            writer.write(socket_i_have_info + len(message).to_bytes(4, "little") + message)
+        if self.queue_results:
+            queue = (1).to_bytes(4, "little") + self.jobs_done.to_bytes(4, "little")
+            writer.write(socket_job_result_queue + len(queue).to_bytes(4, "little") + queue)
+        if self.result_signal == "program_defined":
+            result_number = 0
+            if self.result_number_argument is not None:
+                result_number = int(decode_arguments(buffer)[self.result_number_argument])
+            writer.write(socket_program_defined_result)
+            writer.write(struct.pack("<iii", self.payload_floats, result_number, 1))
+            writer.write(self._payload)
+            writer.write(socket_send_next_job + bytes(8))
+        else:
+            writer.write(socket_send_next_job + self.jobs_done.to_bytes(4, "little"))
+            writer.write(self.payload_floats.to_bytes(4, "little") + self._payload)
+        await writer.drain()
+        self.jobs_done += 1
+        return True
+
+
+async def _open_connection(hosts, port):
+    # The leader passes a comma separated list of its addresses
+    error = None
+    for host in hosts.split(","):
+        try:
+            return await asyncio.open_connection(host, port)
+        except OSError as ex:
+            error = ex
+    raise ConnectionError(f"Could not connect to any of {hosts} on port {port}") from error
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("executable", help="Path of the executable this worker stands in for (ignored)")
+    parser.add_argument("host", help="Comma separated addresses of the manager")
+    parser.add_argument("port", type=int)
+    parser.add_argument("identity")
+    parser.add_argument("threads", type=int, nargs="?", default=1, help="Ignored")
+    parser.add_argument("--duration", type=float, default=0.0, help="Seconds each job takes")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many seconds are added to each job")
+    parser.add_argument("--speed", type=float, default=1.0, help="Relative speed, jobs take 1/speed times as long")
+    parser.add_argument("--duration-argument", type=int, default=None, help="Job argument the duration is multiplied with")
+    parser.add_argument("--payload-floats", type=int, default=0, help="Number of floats in each result")
+    parser.add_argument("--result-signal", choices=["next_job", "program_defined"], default="next_job")
+    parser.add_argument("--result-number-argument", type=int, default=None, help="Job argument used as result number")
+    parser.add_argument("--queue-results", action="store_true", help="Send a job result queue message with every job")
+    parser.add_argument("--send-info", action="store_true", help="Send an info message with every job")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Probability to disconnect during a job")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="Probability to stop answering during a job")
+    parser.add_argument("--crash-after", type=int, default=None, help="Disconnect after this many jobs")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    worker = FakeWorker(
+        duration=args.duration,
+        jitter=args.jitter,
+        speed=args.speed,
+        duration_argument=args.duration_argument,
+        payload_floats=args.payload_floats,
+        result_signal=args.result_signal,
+        result_number_argument=args.result_number_argument,
+        queue_results=args.queue_results,
+        send_info=args.send_info,
+        fail_rate=args.fail_rate,
+        hang_rate=args.hang_rate,
+        crash_after=args.crash_after,
+        seed=args.seed,
+    )
+    asyncio.run(worker.run(args.host, args.port, args.identity))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 import asyncio
-import sqlite3
 import struct
-from dataclasses import dataclass
+import threading
+from dataclasses import dataclass, replace
 from functools import partial
 from pathlib import Path
 from typing import List, Tuple, Union, Optional
@@ -9,13 +9,15 @@ from typing import List, Tuple, Union, Optional
 import mrcfile
 import numpy as np
 import pandas as pd
-from skimage.feature import peak_local_max
 import datetime
 
-from pycistem.database import datetime_to_msdos, ensure_template_is_a_volume_asset, get_image_info_from_db, create_peak_lists, get_max_match_template_job_id
+from pycistem.database import add_peaks, datetime_to_msdos, get_image_info_from_db, create_peak_lists, get_max_match_template_job_id, database_writer, insert_rows, run_in_transaction, volume_asset_id
 from pycistem.programs import cistem_program
+from pycistem.programs import match_template_statistics as statistics
 from pycistem.programs._cistem_constants import socket_job_result_queue, socket_program_defined_result, socket_i_have_info
-from pycistem.pycore import EulerSearch, ParameterMap
+from pycistem.programs._receive import BufferPool, readinto
+from pycistem.programs.results_store import PLANES, ResultsStore, write_results
+from pycistem.pycore import search_grid
 
 
 @dataclass
@@ -73,12 +75,21 @@ async def handle_socket_i_have_info(reader, writer, logger):
     data = await reader.readexactly(length)
     print(f"Info: {data.decode('utf-8')}")
 
+# Receive buffers for results, reused from one result to the next
+result_buffers = BufferPool()
+
 def get_np_arrays(bytes,o,i,x,y,numpix):
     array = np.frombuffer(bytes,offset=o+i*numpix*4, count=numpix,dtype=np.float32).copy()
     array = array.reshape((y,-1))
     array = array[:,:x]
     return array
 
+def estimate_job_cost(par: MatchTemplateParameters) -> float:
+    # The GPU search computes one cross-correlation per orientation, in-plane
+    # rotation and defocus/pixel size step, each over the whole image
+    in_plane_rotations = max(int(360.0 / par.in_plane_angular_step), 1) if par.in_plane_angular_step > 0 else 1
+    return cistem_program.default_job_cost(par) * in_plane_rotations
+
 def parameters_from_database(database, template_filename: str, match_template_job_id: Optional[int] = None,**kwargs) :
     image_info = get_image_info_from_db(database,get_ctf=True)
     if image_info is None:
@@ -103,29 +114,17 @@ def parameters_from_database(database, template_filename: str, match_template_jo
     image_info["THRESHOLD"] = 0.0
     return(image_info)
 
-def write_results_to_database(database,  parameters: list[MatchTemplateParameters], results: list[tuple[int, pd.DataFrame]], image_info):
-    # Ensure Volume assets
-    template_vol_ids = {}
-    for par in parameters:
-        template_vol_ids[par.input_reconstruction_filename] = -1
-    for template in template_vol_ids.keys():
-        template_vol_ids[template] = ensure_template_is_a_volume_asset(database, template, parameters[0].pixel_size)
+def write_results_to_database(database,  parameters: list[MatchTemplateParameters], results: list[tuple[int, pd.DataFrame]], image_info, writer=None):
+    """Add the peaks of each result as a new template match.
 
-    conn = sqlite3.connect(database, isolation_level=None)
-    cur = conn.cursor()
+    With a :class:`~pycistem.database.DatabaseWriter` as ``writer`` the
+    rows are queued on its thread instead of written before returning.
+    """
+    templates = {par.input_reconstruction_filename: parameters[0].pixel_size for par in parameters}
     results = sorted(results, key=lambda x: x[0])
     # Add results to TEMPLATE_MATCH_LIST
     template_match_result_list = []
-
-    max_template_match_id = cur.execute("SELECT MAX(TEMPLATE_MATCH_ID) FROM TEMPLATE_MATCH_LIST").fetchone()[0]
-    if max_template_match_id is None:
-        max_template_match_id = 0
-    template_match_id = max_template_match_id + 1
-    #template_match_job_id = cur.execute("SELECT MAX(TEMPLATE_MATCH_JOB_ID) FROM TEMPLATE_MATCH_LIST").fetchone()[0]
-    #if template_match_job_id is None:
-    #    template_match_job_id = 1
-    #else:
-    #    template_match_job_id += 1
+    peak_lists = []
 
     for result in results:
         template_match_job_id = image_info.iloc[result[0]]["MATCH_TEMPLATE_JOB_ID"]
@@ -135,14 +134,15 @@ def write_results_to_database(database,  parameters: list[MatchTemplateParameter
         else:
             threshold = 7.0
         template_match_result_list.append({
-            "TEMPLATE_MATCH_ID": template_match_id,
+            # The ids are assigned when the rows are written
+            "TEMPLATE_MATCH_ID": None,
             "JOB_NAME": f"auto_{template_match_job_id}_{Path(parameters[result[0]].input_reconstruction_filename).stem}",
             "DATETIME_OF_RUN": datetime_to_msdos(datetime.datetime.now()),
             "TEMPLATE_MATCH_JOB_ID": template_match_job_id,
             "JOB_TYPE_CODE": 0,
             "INPUT_TEMPLATE_MATCH_ID": 0,
             "IMAGE_ASSET_ID": image_info.iloc[result[0]]["IMAGE_ASSET_ID"],
-            "REFERENCE_VOLUME_ASSET_ID": template_vol_ids[parameters[result[0]].input_reconstruction_filename],
+            "REFERENCE_VOLUME_ASSET_ID": None,
             "IS_ACTIVE": 1,
             "USED_SYMMETRY": parameters[result[0]].my_symmetry,
             "USED_PIXEL_SIZE": parameters[result[0]].pixel_size,
@@ -180,22 +180,29 @@ def write_results_to_database(database,  parameters: list[MatchTemplateParameter
             "HISTOGRAM_OUTPUT_FILE": parameters[result[0]].output_histogram_file,
             "PROJECTION_RESULT_OUTPUT_FILE": parameters[result[0]].scaled_mip_output_file,
         })
-        create_peak_lists(conn, template_match_id)
-        result[1].to_sql(f"TEMPLATE_MATCH_PEAK_LIST_{template_match_id}", conn, if_exists="append", index=False)
-        conn.commit()
-        result[1]['ORIGINAL_PEAK_NUMBER'] = 0
-        result[1]['NEW_PEAK_NUMBER'] = 0
-        print(result[1])
-        result[1].to_sql(f"TEMPLATE_MATCH_PEAK_CHANGE_LIST_{template_match_id}", conn, if_exists="append", index=False)
-        template_match_id += 1
-    template_match_result_list = pd.DataFrame(template_match_result_list)
-    template_match_result_list.to_sql("TEMPLATE_MATCH_LIST", conn, if_exists="append", index=False)
-
- 
-    conn.close()
-
-
-async def handle_results(reader, writer, logger, parameters, write_directly_to_db, image_info):
+        peak_lists.append(result[1].copy())
+
+    def write(conn):
+        # Ensure Volume assets
+        template_vol_ids = {template: volume_asset_id(conn, template, pixel_size) for template, pixel_size in templates.items()}
+        max_template_match_id = conn.execute("SELECT MAX(TEMPLATE_MATCH_ID) FROM TEMPLATE_MATCH_LIST").fetchone()[0]
+        if max_template_match_id is None:
+            max_template_match_id = 0
+        template_match_id = max_template_match_id + 1
+        for result, row, peaks in zip(results, template_match_result_list, peak_lists):
+            row["TEMPLATE_MATCH_ID"] = template_match_id
+            row["REFERENCE_VOLUME_ASSET_ID"] = template_vol_ids[parameters[result[0]].input_reconstruction_filename]
+            create_peak_lists(conn, template_match_id, commit=False)
+            insert_rows(conn, f"TEMPLATE_MATCH_PEAK_LIST_{template_match_id}", peaks)
+            insert_rows(conn, f"TEMPLATE_MATCH_PEAK_CHANGE_LIST_{template_match_id}", peaks.assign(ORIGINAL_PEAK_NUMBER=0, NEW_PEAK_NUMBER=0))
+            add_peaks(conn, template_match_id, int(row["TEMPLATE_MATCH_JOB_ID"]), int(row["IMAGE_ASSET_ID"]), peaks)
+            template_match_id += 1
+        insert_rows(conn, "TEMPLATE_MATCH_LIST", template_match_result_list)
+
+    run_in_transaction(database, write, writer)
+
+
+async def handle_results(reader, writer, logger, parameters, write_directly_to_db, image_info, results_store=None):
     logger.debug("Handling results")
     size_of_array= await reader.readexactly(4)
     result_number= await reader.readexactly(4)
@@ -203,82 +210,137 @@ async def handle_results(reader, writer, logger, parameters, write_directly_to_d
     number_of_floats = int.from_bytes(size_of_array, byteorder="little")
     result_number = int.from_bytes(result_number, byteorder="little")
     number_of_expected_results = int.from_bytes(number_of_expected_results, byteorder="little")
-    results = await reader.readexactly(number_of_floats*4)
-    x_dim = int(struct.unpack("<f",results[0:4])[0])
-    y_dim = int(struct.unpack("<f",results[4:8])[0])
-    num_pixels = int(struct.unpack("<f",results[8:12])[0])
-    num_histogram_points = int(struct.unpack("<f",results[16:20])[0])
-    print(f"Got number of histogram points: {num_histogram_points}, but replacing with hardcoded 512")
-    num_histogram_points = 512
-    num_ccs = struct.unpack("<f",results[12:16])[0]
-    struct.unpack("<f",results[20:24])[0]
-    struct.unpack("<f",results[24:28])[0]
+    # The result is read straight into a reused buffer and the planes below
+    # are views into it, so nothing in it may be returned without a copy
+    with result_buffers.borrow(number_of_floats*4) as results:
+        await readinto(reader, results)
+        return _process_results(results, result_number, number_of_expected_results, number_of_floats, parameters, write_directly_to_db, image_info, results_store)
+
+
+async def receive_results(reader, writer, logger):
+    # Receiving half of handle_results, the buffer goes back to the pool in
+    # process_results once the result has been processed
+    logger.debug("Receiving results")
+    number_of_floats, result_number, number_of_expected_results = struct.unpack("<iii", await reader.readexactly(12))
+    buffer = result_buffers.acquire(number_of_floats*4)
+    try:
+        await readinto(reader, buffer[:number_of_floats*4])
+    except BaseException:
+        result_buffers.release(buffer)
+        raise
+    return buffer, number_of_floats, result_number, number_of_expected_results
+
+
+def process_results(received, parameters, write_directly_to_db, image_info, results_store=None, shards=None):
+    buffer, number_of_floats, result_number, number_of_expected_results = received
+    try:
+        return _process_results(buffer[:number_of_floats*4], result_number, number_of_expected_results, number_of_floats, parameters, write_directly_to_db, image_info, results_store, shards)
+    finally:
+        result_buffers.release(buffer)
+
+
+class _SearchShards:
+    """Partial results of images whose search is split over several jobs."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._images = {}
+
+    def add(self, result_number, number_of_expected_results, planes, histogram, num_ccs):
+        # Returns the merged planes, histogram and number of ccs once all
+        # parts of the image are in, otherwise None. planes and histogram
+        # are only read, as they are views of a receive buffer.
+        with self._lock:
+            image = self._images.setdefault(result_number, {"lock": threading.Lock(), "planes": None, "received": 0})
+        with image["lock"]:
+            if image["planes"] is None:
+                image["planes"] = np.array(planes)
+                image["histogram"] = np.array(histogram)
+                image["num_ccs"] = num_ccs
+            else:
+                statistics.merge_search_results(image["planes"], planes)
+                image["histogram"] += histogram
+                image["num_ccs"] += num_ccs
+            image["received"] += 1
+            if image["received"] < number_of_expected_results:
+                return None
+        with self._lock:
+            del self._images[result_number]
+        return image["planes"], image["histogram"], image["num_ccs"]
+
+    def discard(self, result_number):
+        # Drops the partial results of an image that can't be completed
+        with self._lock:
+            self._images.pop(result_number, None)
+
+
+def _process_results(results, result_number, number_of_expected_results, number_of_floats, parameters, write_directly_to_db, image_info, results_store=None, shards=None):
+    header = results[:28].view(np.float32)
+    x_dim = int(header[0])
+    y_dim = int(header[1])
+    num_pixels = int(header[2])
+    num_ccs = float(header[3])
+    # The histogram (int64 counts) is whatever follows the eight planes
+    num_histogram_points = (number_of_floats - 7 - 8*num_pixels) // 2
     print(f"Result number: {result_number} Number of expected results: {number_of_expected_results} Number of pixels: {num_pixels} X dim: {x_dim} Y dim: {y_dim} Num histogram points: {num_histogram_points} Num ccs: {num_ccs} Num float {number_of_floats}")
-    mip = get_np_arrays(results,28,0,x_dim,y_dim,num_pixels)
-    psi = get_np_arrays(results,28,1,x_dim,y_dim,num_pixels)
-    theta = get_np_arrays(results,28,2,x_dim,y_dim,num_pixels)
-    phi = get_np_arrays(results,28,3,x_dim,y_dim,num_pixels)
-    defocus = get_np_arrays(results,28,4,x_dim,y_dim,num_pixels)
-    get_np_arrays(results,28,5,x_dim,y_dim,num_pixels)
-    sum = get_np_arrays(results,28,6,x_dim,y_dim,num_pixels)
-
-    sum = sum / num_ccs
-    sum_squares = get_np_arrays(results,28,7,x_dim,y_dim,num_pixels)
-    sum_squares = np.sqrt(sum_squares/num_ccs - sum**2)
-    scaled_mip = np.divide(mip - sum, sum_squares, out=np.zeros_like(mip), where=sum_squares!=0)
+    planes = results[28:28+8*num_pixels*4].view(np.float32).reshape((8, y_dim, -1))[:, :, :x_dim]
+    histogram = np.frombuffer(results,offset=28+8*num_pixels*4, count=num_histogram_points,dtype=np.int64)
+    if shards is not None and number_of_expected_results > 1:
+        merged = shards.add(result_number, number_of_expected_results, planes, histogram, num_ccs)
+        if merged is None:
+            return None
+        planes, histogram, num_ccs = merged
+    mip, psi, theta, phi, defocus, _pixel_size, sum, sum_squares = planes
+
+    scaled_mip = statistics.scale_mip(mip, sum, sum_squares, num_ccs)
     par = parameters[result_number]
-    histogram = np.frombuffer(results,offset=28+8*num_pixels*4, count=num_histogram_points,dtype=np.int64).copy()
-    survival_histogram = np.zeros(num_histogram_points, dtype=np.float32)
-    survival_histogram[-1] = histogram[-1]
-    for line_counter in range(num_histogram_points - 2, -1, -1):
-        survival_histogram[line_counter] = survival_histogram[line_counter + 1] + histogram[line_counter]
-    
-   
-    # Calculate expected threshold
-    from scipy.special import erfcinv,erfc
-    expected_threshold = np.sqrt(2.0) * erfcinv(2.0/(x_dim*y_dim*num_ccs)) * 1
-
-    histogram_min              = -12.5
-    histogram_max              = 22.5
-    histogram_step        = (histogram_max - histogram_min) / num_histogram_points
-    temp_float = histogram_min + (histogram_step / 2.0)
-
-    expected_survival_histogram = np.zeros(num_histogram_points, dtype=np.float32)
-    for line_counter in range(num_histogram_points):
-        expected_survival_histogram[line_counter] = (erfc((temp_float + histogram_step * float(line_counter)) / np.sqrt(2.0)) / 2.0) * (x_dim*y_dim*num_ccs)
-    
-    survival_histogram_float  = survival_histogram * (expected_survival_histogram.sum() / survival_histogram.sum())
-    with open(par.output_histogram_file, 'w') as f:
-        f.write(f"# Expected threshold = {expected_threshold:.2f}\n")
-        f.write("#  histogram, expected histogram, survival histogram, expected survival histogram\n")
-        for line_counter in range(num_histogram_points):
-            temp_double_array = [
-                temp_float + histogram_step * float(line_counter),
-                histogram[line_counter],
-                survival_histogram[line_counter],
-                expected_survival_histogram[line_counter]
-            ]
-            f.write(" ".join(str(x) for x in temp_double_array) + "\n")
-    mrcfile.write(par.scaled_mip_output_file, scaled_mip.astype(np.float32), overwrite=True)
+    number_of_trials = x_dim*y_dim*num_ccs
+    expected_threshold = float(statistics.expected_threshold(number_of_trials))
+    statistics.write_histogram(par.output_histogram_file, histogram, number_of_trials, expected_threshold)
+    mrcfile.write(par.scaled_mip_output_file, scaled_mip, overwrite=True)
     if par.mip_output_file != "/dev/null":
-        mrcfile.write(par.mip_output_file, mip.astype(np.float32), overwrite=True)
-    peak_coordinates = peak_local_max(scaled_mip, min_distance=int(par.min_peak_radius), exclude_border=50, threshold_abs=expected_threshold)
-    result = pd.DataFrame({
-        "X_POSITION": peak_coordinates[:,1] * par.pixel_size,
-        "Y_POSITION": peak_coordinates[:,0] * par.pixel_size,
-        "PSI": psi[tuple(peak_coordinates.T)],
-        "THETA": theta[tuple(peak_coordinates.T)],
-        "PHI": phi[tuple(peak_coordinates.T)],
-        "DEFOCUS": defocus[tuple(peak_coordinates.T)],
-        "PEAK_HEIGHT": scaled_mip[tuple(peak_coordinates.T)]
-    })
+        mrcfile.write(par.mip_output_file, np.ascontiguousarray(mip), overwrite=True)
+    if results_store is not None:
+        metadata = {"number_of_ccs": num_ccs, "pixel_size": float(par.pixel_size), "expected_threshold": expected_threshold, "input_search_images_filename": par.input_search_images_filename, "input_reconstruction_filename": par.input_reconstruction_filename}
+        results_store(par, dict(zip(PLANES, planes)), histogram, metadata)
+    peak_coordinates = statistics.find_peaks(scaled_mip, min_distance=int(par.min_peak_radius), threshold=expected_threshold, exclude_border=50)
+    peaks = tuple(peak_coordinates.T)
+    result = _peak_table(peak_coordinates, par.pixel_size, psi[peaks], theta[peaks], phi[peaks], defocus[peaks], scaled_mip[peaks])
     if(write_directly_to_db):
         image_info["THRESHOLD"].iat[result_number] = expected_threshold
-        write_results_to_database(image_info.iloc[result_number]["DATABASE"], parameters, [(result_number, result)], image_info)
-        print("Wrote results to database")
+        # Queued, so that the next result doesn't wait for sqlite
+        write_results_to_database(image_info.iloc[result_number]["DATABASE"], parameters, [(result_number, result)], image_info, writer=database_writer())
     print(f"{par.input_search_images_filename}: {len(result)} peaks found. Median {result['PEAK_HEIGHT'].median()} Max {result['PEAK_HEIGHT'].max()} Threshold {expected_threshold}")
     return(result)
 
+def _peak_table(peak_coordinates, pixel_size, psi, theta, phi, defocus, peak_height):
+    # The values are those at peak_coordinates
+    return pd.DataFrame({
+        "X_POSITION": peak_coordinates[:,1] * pixel_size,
+        "Y_POSITION": peak_coordinates[:,0] * pixel_size,
+        "PSI": psi,
+        "THETA": theta,
+        "PHI": phi,
+        "DEFOCUS": defocus,
+        "PEAK_HEIGHT": peak_height
+    })
+
+def results_store_filename(directory, par: MatchTemplateParameters):
+    return Path(directory) / f"{Path(par.input_search_images_filename).stem}_{Path(par.input_reconstruction_filename).stem}.tmresults"
+
+def _write_results_store(par, planes, histogram, metadata, directory, **options):
+    write_results(results_store_filename(directory, par), planes, histogram, metadata, **options)
+
+def peaks_from_results_store(filename, min_peak_radius=10.0, threshold=None, exclude_border=50):
+    """Pick peaks again from a results store, by default at the threshold of the search."""
+    with ResultsStore(filename) as store:
+        scaled_mip = store.scaled_mip()
+        if threshold is None:
+            threshold = store.metadata["expected_threshold"]
+        peak_coordinates = statistics.find_peaks(scaled_mip, min_distance=int(min_peak_radius), threshold=threshold, exclude_border=exclude_border)
+        angles_and_defocus = [store.values_at(name, peak_coordinates) for name in ("psi", "theta", "phi", "defocus")]
+        return _peak_table(peak_coordinates, store.metadata["pixel_size"], *angles_and_defocus, scaled_mip[tuple(peak_coordinates.T)])
+
 async def handle_job_result_queue(reader, writer, logger):
     #logger.info("Handling results")
     #await reader.read(4)
@@ -296,31 +358,132 @@ async def handle_job_result_queue(reader, writer, logger):
 
 
 
-def run(parameters: Union[MatchTemplateParameters,list[MatchTemplateParameters],pd.DataFrame],write_directly_to_db=False,image_info=None,**kwargs):
-
+def _prepare(parameters, write_directly_to_db, image_info, results_store=None, results_store_options=None, jobs_per_image=1, shards=None):
     if isinstance(parameters, pd.DataFrame):
         image_info = parameters
         parameters = image_info["PARAMETERS"].tolist()
     if not isinstance(parameters, list):
         parameters = [parameters]
 
+    store = None
+    if results_store is not None:
+        store = partial(_write_results_store, directory=results_store, **(results_store_options or {}))
     signal_handlers = {
-        socket_program_defined_result : partial(handle_results, parameters = parameters, write_directly_to_db=write_directly_to_db,image_info=image_info),
+        # Results are processed in the executor of the worker pool, so that
+        # other workers get their next jobs in the meantime. Writing to the
+        # database updates image_info, which needs a thread executor.
+        socket_program_defined_result : cistem_program.SplitHandler(
+            receive_results,
+            partial(process_results, parameters = parameters, write_directly_to_db=write_directly_to_db,image_info=image_info,results_store=store,shards=_SearchShards() if shards is None else shards),
+        ),
         socket_job_result_queue : handle_job_result_queue,
         socket_i_have_info: handle_socket_i_have_info,
     }
     for i, par in enumerate(parameters):
         par.image_number_for_gui = i
-        global_euler_search = EulerSearch()
-        parameter_map = ParameterMap()
-        parameter_map.SetAllTrue( )
-        global_euler_search.InitGrid(par.my_symmetry,par.angular_step, 0.0, 0.0, 360.0, par.in_plane_angular_step, 0.0, 1.0 / 2.0, parameter_map, 10)
-        if par.my_symmetry.startswith("C") and global_euler_search.test_mirror:
-            global_euler_search.theta_max = 180.0
-        global_euler_search.CalculateGridSearchPositions(False)
+        # C symmetries are searched including the mirror
+        theta_max = 180.0 if par.my_symmetry.startswith("C") else None
+        grid = search_grid(par.my_symmetry, par.angular_step, par.in_plane_angular_step, theta_max=theta_max)
         par.first_search_position = 0
-        par.last_search_position = global_euler_search.number_of_search_positions - 1
+        par.last_search_position = len(grid.phi) - 1
+    return parameters, _split_searches(parameters, jobs_per_image), signal_handlers
 
-    results = asyncio.run(cistem_program.run("match_template_gpu", parameters, signal_handlers=signal_handlers,num_threads=parameters[0].max_threads,**kwargs))
 
-    return(results)
+def _split_searches(parameters, jobs_per_image):
+    # Each image is searched by jobs_per_image jobs over consecutive ranges
+    # of orientations. They all send their result as the image's result
+    # number, which is how the partial results are put back together.
+    if jobs_per_image <= 1:
+        return parameters
+    jobs = []
+    for par in parameters:
+        positions = np.arange(par.first_search_position, par.last_search_position + 1)
+        shards = [shard for shard in np.array_split(positions, jobs_per_image) if len(shard) > 0]
+        for shard in shards:
+            jobs.append(replace(par, first_search_position=int(shard[0]), last_search_position=int(shard[-1]), number_of_jobs_per_image_in_gui=len(shards)))
+    return jobs
+
+
+def _check_journal(jobs_per_image, journal=None, resume=None):
+    # The partial results of a split image only exist in memory, so a
+    # resumed run could never complete the images of its journaled jobs
+    if jobs_per_image > 1 and (journal is not None or resume is not None):
+        msg = "journal and resume can't be used with jobs_per_image > 1"
+        raise ValueError(msg)
+
+
+def _image_failures(jobs, failures, shards):
+    # An image whose search was split fails as a whole if any of its jobs
+    # failed, and the partial results of its other jobs are dropped
+    if all(job.number_of_jobs_per_image_in_gui <= 1 for job in jobs):
+        return list(failures)
+    by_image = {}
+    for failure in failures:
+        by_image.setdefault(jobs[failure.parameter_index].image_number_for_gui, []).append(failure)
+    image_failures = []
+    for image_number, failed_jobs in by_image.items():
+        shards.discard(image_number)
+        number_of_jobs = jobs[failed_jobs[0].parameter_index].number_of_jobs_per_image_in_gui
+        reasons = "; ".join(f"job {failure.parameter_index}: {failure.reason}" for failure in failed_jobs)
+        image_failures.append(cistem_program.JobFailure(image_number, max(failure.attempts for failure in failed_jobs), f"{len(failed_jobs)} of {number_of_jobs} jobs failed ({reasons})"))
+    return image_failures
+
+
+def _image_results(jobs, results, shards):
+    # Results of the jobs that completed an image, keyed by the image
+    return cistem_program.RunResults(
+        [(jobs[parameter_index].image_number_for_gui, result) for parameter_index, result in results if result is not None],
+        _image_failures(jobs, results.failures, shards),
+        results.startup_latency,
+    )
+
+
+def run(parameters: Union[MatchTemplateParameters,list[MatchTemplateParameters],pd.DataFrame],write_directly_to_db=False,image_info=None,results_store=None,results_store_options=None,jobs_per_image=1,**kwargs):
+    """Run match_template on each image.
+
+    With ``results_store`` set to a directory, all planes of every result are
+    also kept there (see :func:`results_store_filename`), written with
+    ``results_store_options`` such as ``{"dtype": np.float16, "compression": "zlib"}``.
+
+    With ``jobs_per_image`` > 1 the orientations of each image are split
+    over that many jobs, whose maps are merged before the statistics and
+    peaks are computed. Results and failures are then keyed by image
+    instead of by job, and an image fails if any of its jobs fails. Such
+    runs can't be journaled, as the partial results are only kept in memory.
+    """
+
+    return(asyncio.run(run_async(parameters, write_directly_to_db=write_directly_to_db, image_info=image_info, results_store=results_store, results_store_options=results_store_options, jobs_per_image=jobs_per_image, **kwargs)))
+
+async def run_async(parameters: Union[MatchTemplateParameters,list[MatchTemplateParameters],pd.DataFrame],write_directly_to_db=False,image_info=None,results_store=None,results_store_options=None,jobs_per_image=1,**kwargs):
+
+    _check_journal(jobs_per_image, kwargs.get("journal"), kwargs.get("resume"))
+    shards = _SearchShards()
+    parameters, jobs, signal_handlers = _prepare(parameters, write_directly_to_db, image_info, results_store, results_store_options, jobs_per_image, shards)
+
+    kwargs.setdefault("cost_function", estimate_job_cost)
+    results = await cistem_program.run("match_template_gpu", jobs, signal_handlers=signal_handlers,num_threads=parameters[0].max_threads,**kwargs)
+    if write_directly_to_db:
+        await asyncio.get_running_loop().run_in_executor(None, database_writer().flush)
+
+    return(_image_results(jobs, results, shards))
+
+async def run_iter(parameters: Union[MatchTemplateParameters,list[MatchTemplateParameters],pd.DataFrame],write_directly_to_db=False,image_info=None,results_store=None,results_store_options=None,jobs_per_image=1,**kwargs):
+
+    _check_journal(jobs_per_image, kwargs.get("journal"), kwargs.get("resume"))
+    shards = _SearchShards()
+    parameters, jobs, signal_handlers = _prepare(parameters, write_directly_to_db, image_info, results_store, results_store_options, jobs_per_image, shards)
+
+    kwargs.setdefault("cost_function", estimate_job_cost)
+    # Failures of jobs are passed on as failures of their images
+    failures = kwargs.pop("failures", None)
+    job_failures = []
+    try:
+        async for parameter_index, result in cistem_program.run_iter("match_template_gpu", jobs, signal_handlers=signal_handlers,num_threads=parameters[0].max_threads,failures=job_failures,**kwargs):
+            if result is not None:
+                yield jobs[parameter_index].image_number_for_gui, result
+    finally:
+        image_failures = _image_failures(jobs, job_failures, shards)
+        if failures is not None:
+            failures.extend(image_failures)
+    if write_directly_to_db:
+        await asyncio.get_running_loop().run_in_executor(None, database_writer().flush)
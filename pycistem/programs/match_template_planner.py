@@ -0,0 +1,290 @@
+"""Estimates of the time and memory a match_template run over a project needs.
+
+The work of a search is counted in units of one pixel correlated with one
+orientation, in-plane rotation and defocus/pixel size step. A
+:class:`Throughput` measured on a past run converts units to seconds::
+
+    image_info = match_template.parameters_from_database("project.db", "template.mrc")
+    throughput = Throughput.load("throughput.json")
+    plan = plan_match_template(image_info, num_procs=cluster, throughput=throughput)
+    print(compare_plans(image_info, angular_steps=[2.0, 2.5, 3.0], num_procs=cluster, throughput=throughput))
+    match_template.run(plan.parameters, **plan.run_kwargs())
+"""
+import heapq
+import json
+from dataclasses import dataclass, field, replace
+from itertools import product
+from typing import Optional
+
+import mrcfile
+import numpy as np
+import pandas as pd
+
+from pycistem.programs import cistem_program
+from pycistem.programs import match_template
+from pycistem.programs.run_profile import Cluster, Slot
+from pycistem.pycore import RunProfile, search_grid
+
+# Copies of the (padded) image a worker keeps: the 8 result planes, the
+# image and its complex FFT and the correlation map being searched
+_IMAGE_COPIES = 13
+# The template volume, its FFT and the projection workspace
+_TEMPLATE_COPIES = 3
+_GB = 1024**3
+
+
+def search_positions(par):
+    """Number of orientations match_template searches for ``par``, without in-plane rotations."""
+    # C symmetries are searched including the mirror, as in match_template
+    theta_max = 180.0 if par.my_symmetry.startswith("C") else None
+    return len(search_grid(par.my_symmetry, par.angular_step, theta_max=theta_max).phi)
+
+
+def search_units(par, pixels, positions=None):
+    """Pixels times orientations, in-plane rotations and defocus and pixel size steps of a search."""
+    if positions is None:
+        positions = par.last_search_position - par.first_search_position + 1
+    in_plane_rotations = max(int(360.0 / par.in_plane_angular_step), 1) if par.in_plane_angular_step > 0 else 1
+    defocus_steps = cistem_program._search_steps(par.defocus_search_range, par.defocus_step)
+    pixel_size_steps = cistem_program._search_steps(par.pixel_size_search_range, par.pixel_size_step)
+    return float(pixels) * max(positions, 1) * in_plane_rotations * defocus_steps * pixel_size_steps
+
+
+def _template_box(filename):
+    try:
+        with mrcfile.open(filename, header_only=True, permissive=True) as mrc:
+            return int(mrc.header.nx)
+    except (OSError, ValueError):
+        return None
+
+
+@dataclass
+class Throughput:
+    """Search units one worker of speed 1 gets through per second."""
+    units_per_second: float
+
+    @classmethod
+    def measure(cls, parameters, seconds, image_sizes=None):
+        """From the parameters of the searches a run completed and the worker seconds it took.
+
+        ``image_sizes`` are the numbers of pixels of the images, read from
+        their MRC headers if not given.
+        """
+        parameters = _parameter_list(parameters)
+        if image_sizes is None:
+            image_sizes = [cistem_program._image_size(par.input_search_images_filename) for par in parameters]
+        units = sum(search_units(par, pixels) for par, pixels in zip(parameters, image_sizes))
+        if seconds <= 0:
+            msg = "The run took no time"
+            raise ValueError(msg)
+        return cls(units / seconds)
+
+    @classmethod
+    def from_metrics(cls, parameters, metrics, image_sizes=None):
+        """From a run and the :class:`DispatcherMetrics` of its pool, e.g. ``pool.metrics``.
+
+        Uses the time the workers were busy, so that start-up and idle
+        workers at the end of the run don't count.
+        """
+        snapshot = metrics.snapshot() if hasattr(metrics, "snapshot") else metrics
+        seconds = sum(worker["busy_seconds"] for worker in snapshot["workers"].values())
+        return cls.measure(parameters, seconds, image_sizes)
+
+    def seconds(self, units):
+        return units / self.units_per_second
+
+    def save(self, filename):
+        with open(filename, "w") as fp:
+            json.dump({"units_per_second": self.units_per_second}, fp)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as fp:
+            return cls(json.load(fp)["units_per_second"])
+
+
+def _parameter_list(parameters):
+    if isinstance(parameters, pd.DataFrame):
+        return parameters["PARAMETERS"].tolist()
+    if not isinstance(parameters, list):
+        return [parameters]
+    return parameters
+
+
+def _slots(num_procs):
+    if isinstance(num_procs, RunProfile):
+        num_procs = Cluster.from_run_profile(num_procs)
+    if isinstance(num_procs, Cluster):
+        return num_procs.slots
+    return [Slot("localhost", index=i) for i in range(num_procs)]
+
+
+def simulate_wall_time(job_seconds, num_procs, job_memory=None):
+    """Seconds until the last of the jobs finishes, and the indices of jobs no slot can take.
+
+    ``job_seconds`` are the times of the jobs on a slot of speed 1. Like
+    :class:`~pycistem.programs.cistem_program.JobScheduler`, the most
+    expensive jobs go first, each to the slot with enough memory that would
+    finish it earliest. Slots start after the delays of their run commands.
+    """
+    slots = _slots(num_procs)
+    free_at = []
+    start = 0.0
+    for slot in slots:
+        free_at.append(start)
+        start += slot.delay_time_in_ms / 1000.0
+    order = sorted(range(len(job_seconds)), key=lambda i: -job_seconds[i])
+    unplaceable = []
+    if job_memory is None and len({slot.speed for slot in slots}) == 1:
+        # All slots are the same, the earliest free one is the one to use
+        heap = list(free_at)
+        heapq.heapify(heap)
+        for i in order:
+            heapq.heappush(heap, heapq.heappop(heap) + job_seconds[i] / slots[0].speed)
+        return max(heap, default=0.0), unplaceable
+    for i in order:
+        fitting = [s for s, slot in enumerate(slots) if job_memory is None or slot.memory is None or job_memory[i] <= slot.memory]
+        if not fitting:
+            unplaceable.append(i)
+            continue
+        s = min(fitting, key=lambda s: free_at[s] + job_seconds[i] / slots[s].speed)
+        free_at[s] += job_seconds[i] / slots[s].speed
+    return max(free_at, default=0.0), unplaceable
+
+
+@dataclass
+class Plan:
+    """The estimate for one set of search parameters.
+
+    ``jobs`` has one row per image with its size, search positions, units,
+    seconds on a slot of speed 1 and the memory a worker needs for it.
+    Times are ``None`` without a :class:`Throughput`.
+    """
+    parameters: object
+    jobs: pd.DataFrame
+    num_procs: object
+    jobs_per_image: int = 1
+    worker_hours: Optional[float] = None
+    wall_time_hours: Optional[float] = None
+    peak_memory_gb: float = 0.0
+    unplaceable: list = field(default_factory=list)
+
+    def summary(self):
+        return {
+            "images": len(self.jobs),
+            "search_positions": int(self.jobs["search_positions"].max()) if len(self.jobs) else 0,
+            "units": float(self.jobs["units"].sum()),
+            "worker_hours": self.worker_hours,
+            "wall_time_hours": self.wall_time_hours,
+            "peak_memory_gb": self.peak_memory_gb,
+            "unplaceable": len(self.unplaceable),
+        }
+
+    def run_kwargs(self):
+        """Keyword arguments for ``match_template.run`` with :attr:`parameters`."""
+        memory = dict(zip(self.jobs["filename"], self.jobs["memory_gb"]))
+        return {
+            "num_procs": self.num_procs,
+            "jobs_per_image": self.jobs_per_image,
+            "scheduler": cistem_program.JobScheduler(
+                cost_function=match_template.estimate_job_cost,
+                memory_function=lambda par: memory[par.input_search_images_filename],
+            ),
+        }
+
+    def num_procs_for(self, wall_time_hours, max_procs=1024):
+        """Smallest number of slots of speed 1 that finish within ``wall_time_hours``, ``None`` if none do."""
+        if self.worker_hours is None:
+            msg = "The plan has no throughput to estimate times with"
+            raise ValueError(msg)
+        seconds = _split_seconds(self.jobs["seconds"].tolist(), self.jobs_per_image)
+        low, high = 1, max_procs
+        if simulate_wall_time(seconds, high)[0] > wall_time_hours * 3600:
+            return None
+        while low < high:
+            middle = (low + high) // 2
+            if simulate_wall_time(seconds, middle)[0] <= wall_time_hours * 3600:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+
+def _split_seconds(seconds, jobs_per_image):
+    # The jobs of each image search an equal share of its orientations
+    return [share for s in seconds for share in [s / jobs_per_image] * jobs_per_image]
+
+
+def _image_pixels(parameters, image_info):
+    if image_info is not None and {"X_SIZE", "Y_SIZE"} <= set(image_info.columns):
+        return (image_info["X_SIZE"] * image_info["Y_SIZE"]).astype(float).tolist()
+    return [cistem_program._image_size(par.input_search_images_filename) for par in parameters]
+
+
+def plan_match_template(parameters, num_procs=1, throughput=None, jobs_per_image=1, template_box=None, **search):
+    """Estimate a match_template run over ``parameters``.
+
+    ``parameters`` are :class:`MatchTemplateParameters` or the DataFrame of
+    ``match_template.parameters_from_database``, whose image sizes are
+    taken from the database instead of the image headers. ``num_procs`` is
+    a number of slots, a :class:`Cluster` or a run profile. ``search``
+    overrides fields such as ``angular_step`` or ``defocus_step`` of all
+    parameters, and the plan's ``parameters`` are the ones to run.
+    ``template_box`` is the edge length of the template, read from its
+    header if not given.
+    """
+    image_info = parameters if isinstance(parameters, pd.DataFrame) else None
+    parameter_list = [replace(par, **search) for par in _parameter_list(parameters)]
+    if image_info is not None:
+        planned = image_info.copy()
+        planned["PARAMETERS"] = parameter_list
+    else:
+        planned = parameter_list
+    pixels = _image_pixels(parameter_list, image_info)
+    boxes = {}
+    rows = []
+    for par, image_pixels in zip(parameter_list, pixels):
+        positions = search_positions(par)
+        units = search_units(par, image_pixels, positions)
+        template = par.input_reconstruction_filename
+        if template not in boxes:
+            boxes[template] = template_box or _template_box(template) or 0
+        memory = (image_pixels * par.padding**2 * _IMAGE_COPIES + boxes[template] ** 3 * _TEMPLATE_COPIES) * 4 / _GB
+        rows.append({
+            "filename": par.input_search_images_filename,
+            "pixels": image_pixels,
+            "search_positions": positions,
+            "units": units,
+            "seconds": throughput.seconds(units) if throughput is not None else np.nan,
+            "memory_gb": memory,
+        })
+    jobs = pd.DataFrame(rows, columns=["filename", "pixels", "search_positions", "units", "seconds", "memory_gb"])
+    plan = Plan(planned, jobs, num_procs, jobs_per_image, peak_memory_gb=float(jobs["memory_gb"].max()) if len(jobs) else 0.0)
+    if throughput is not None:
+        seconds = _split_seconds(jobs["seconds"].tolist(), jobs_per_image)
+        memory = [m for m in jobs["memory_gb"] for _ in range(jobs_per_image)]
+        wall_time, unplaceable = simulate_wall_time(seconds, num_procs, memory)
+        plan.worker_hours = float(jobs["seconds"].sum()) / 3600
+        plan.wall_time_hours = wall_time / 3600
+        plan.unplaceable = sorted({i // jobs_per_image for i in unplaceable})
+    return plan
+
+
+def compare_plans(parameters, angular_steps=(None,), in_plane_angular_steps=(None,), defocus_steps=(None,), **kwargs):
+    """One row of :meth:`Plan.summary` for each combination of step sizes.
+
+    ``None`` keeps the step of the parameters, ``kwargs`` go to
+    :func:`plan_match_template`.
+    """
+    rows = []
+    for angular_step, in_plane_angular_step, defocus_step in product(angular_steps, in_plane_angular_steps, defocus_steps):
+        search = {name: value for name, value in (("angular_step", angular_step), ("in_plane_angular_step", in_plane_angular_step), ("defocus_step", defocus_step)) if value is not None}
+        plan = plan_match_template(parameters, **kwargs, **search)
+        first = _parameter_list(plan.parameters)[0] if len(plan.jobs) else None
+        rows.append({
+            "angular_step": getattr(first, "angular_step", angular_step),
+            "in_plane_angular_step": getattr(first, "in_plane_angular_step", in_plane_angular_step),
+            "defocus_step": getattr(first, "defocus_step", defocus_step),
+            **plan.summary(),
+        })
+    return pd.DataFrame(rows)
@@ -0,0 +1,126 @@
+"""Statistics and peak extraction for match_template results.
+
+All functions work on numpy arrays and broadcast over a leading image
+axis, so that the results of several images can be processed at once.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.special import erfc, erfcinv
+
+# Range of the correlation histogram cisTEM accumulates, in standard deviations
+HISTOGRAM_MIN = -12.5
+HISTOGRAM_MAX = 22.5
+
+
+def scale_mip(mip, sum, sum_squares, number_of_ccs):
+    """Turn ``sum`` and ``sum_squares`` into mean and standard deviation in place and return the scaled MIP.
+
+    ``number_of_ccs`` may be an array of shape ``(images, 1, 1)`` for stacked planes.
+    """
+    sum /= number_of_ccs
+    sum_squares /= number_of_ccs
+    sum_squares -= sum**2
+    np.sqrt(sum_squares, out=sum_squares)
+    return np.divide(mip - sum, sum_squares, out=np.zeros(mip.shape, dtype=np.float32), where=sum_squares!=0)
+
+
+def merge_search_results(planes, other):
+    """Merge the planes of a search over other orientations into ``planes`` in place.
+
+    Both are ``(8, y, x)``: the MIP is the maximum of the two, psi, theta,
+    phi, defocus and pixel size are taken from where it came from, and the
+    sums and sums of squares are added.
+    """
+    better = other[0] > planes[0]
+    for index in range(6):
+        np.copyto(planes[index], other[index], where=better)
+    planes[6:] += other[6:]
+    return planes
+
+
+def histogram_bin_centers(num_histogram_points, histogram_min=HISTOGRAM_MIN, histogram_max=HISTOGRAM_MAX):
+    histogram_step = (histogram_max - histogram_min) / num_histogram_points
+    return histogram_min + histogram_step / 2.0 + histogram_step * np.arange(num_histogram_points, dtype=np.float64)
+
+
+def survival_histogram(histogram):
+    """Number of correlation values at or above each bin, along the last axis."""
+    return np.cumsum(histogram[..., ::-1], axis=-1)[..., ::-1].astype(np.float32)
+
+
+def expected_survival_histogram(num_histogram_points, number_of_trials, histogram_min=HISTOGRAM_MIN, histogram_max=HISTOGRAM_MAX):
+    """Survival histogram of ``number_of_trials`` standard normal values.
+
+    ``number_of_trials`` (pixels times correlation maps) may be an array of
+    shape ``(images, 1)``.
+    """
+    centers = histogram_bin_centers(num_histogram_points, histogram_min, histogram_max)
+    return (erfc(centers / np.sqrt(2.0)) / 2.0 * number_of_trials).astype(np.float32)
+
+
+def expected_threshold(number_of_trials, false_positives=1.0):
+    """Score that ``false_positives`` of ``number_of_trials`` standard normal values exceed on average."""
+    return np.sqrt(2.0) * erfcinv(2.0 * false_positives / np.asarray(number_of_trials, dtype=np.float64))
+
+
+def write_histogram(filename, histogram, number_of_trials, threshold, histogram_min=HISTOGRAM_MIN, histogram_max=HISTOGRAM_MAX):
+    """Write the histogram text file cisTEM writes next to the MIP."""
+    num_histogram_points = len(histogram)
+    columns = np.column_stack([
+        histogram_bin_centers(num_histogram_points, histogram_min, histogram_max),
+        histogram,
+        survival_histogram(histogram),
+        expected_survival_histogram(num_histogram_points, number_of_trials, histogram_min, histogram_max),
+    ])
+    header = f"Expected threshold = {threshold:.2f}\n histogram, expected histogram, survival histogram, expected survival histogram"
+    np.savetxt(filename, columns, fmt=["%.9g", "%d", "%.9g", "%.9g"], header=header, comments="# ")
+
+
+def find_peaks(image, min_distance, threshold, exclude_border=0):
+    """Coordinates of the local maxima of ``image`` that are above ``threshold``.
+
+    Gives the same peaks in the same order (highest first) as
+    ``skimage.feature.peak_local_max`` with ``threshold_abs``, but only
+    looks at the pixels above the threshold: a pixel can only be beaten by a
+    higher, and so also above threshold, pixel within ``min_distance``.
+    """
+    min_distance = int(min_distance)
+    above = np.argwhere(image > threshold)
+    values = image[tuple(above.T)]
+    is_peak = np.ones(len(above), dtype=bool)
+    if min_distance >= 1 and len(above) > 1:
+        # Non-maximum suppression among the candidates, within the square
+        # footprint peak_local_max uses
+        pairs = cKDTree(above).query_pairs(min_distance, p=np.inf, output_type="ndarray")
+        first, second = pairs.T
+        is_peak[first[values[first] < values[second]]] = False
+        is_peak[second[values[second] < values[first]]] = False
+    if len(above) == image.size and is_peak.all():
+        # Every pixel is a maximum, peak_local_max calls this trivial
+        return np.empty((0, image.ndim), dtype=above.dtype)
+    if exclude_border:
+        inside = np.all((above >= exclude_border) & (above < np.array(image.shape) - exclude_border), axis=1)
+        is_peak &= inside
+    peaks = above[is_peak]
+    order = np.argsort(-values[is_peak], kind="stable")
+    peaks = peaks[order]
+    if min_distance > 1 and len(peaks) > 1:
+        peaks = _ensure_spacing(peaks, min_distance)
+    return peaks
+
+
+def _ensure_spacing(peaks, min_distance):
+    # Maxima closer than min_distance have the same height (a plateau), and
+    # only the first of them is kept
+    pairs = cKDTree(peaks).query_pairs(min_distance - 1, p=np.inf, output_type="ndarray")
+    if len(pairs) == 0:
+        return peaks
+    neighbors = {}
+    for first, second in pairs:
+        neighbors.setdefault(first, []).append(second)
+        neighbors.setdefault(second, []).append(first)
+    rejected = set()
+    for index in sorted(neighbors):
+        if index not in rejected:
+            rejected.update(neighbor for neighbor in neighbors[index] if neighbor > index)
+    return np.delete(peaks, sorted(rejected), axis=0)
@@ -67,6 +67,10 @@ async def handle_results(reader, writer, logger):
 
 def run(parameters: Union[Reconstruct3dParameters,list[Reconstruct3dParameters]],**kwargs):
 
+    return(asyncio.run(run_async(parameters, **kwargs)))
+
+async def run_async(parameters: Union[Reconstruct3dParameters,list[Reconstruct3dParameters]],**kwargs):
+
     if not isinstance(parameters, list):
         parameters = [parameters]
     signal_handlers = {
@@ -74,6 +78,6 @@ def run(parameters: Union[Reconstruct3dParameters,list[Reconstruct3dParameters]]
         socket_i_have_info: handle_socket_i_have_info,
         socket_send_next_job: handle_results
     }   
-    asyncio.run(cistem_program.run("reconstruct3d", parameters, signal_handlers=signal_handlers,**kwargs))
+    return(await cistem_program.run("reconstruct3d", parameters, signal_handlers=signal_handlers,**kwargs))
     
         
\ No newline at end of file
@@ -94,6 +94,10 @@ async def handle_i_have_an_error(reader, writer, logger):
 
 def run(parameters: Union[RefineCtfParameters,list[RefineCtfParameters]],**kwargs):
 
+    return(asyncio.run(run_async(parameters, **kwargs)))
+
+async def run_async(parameters: Union[RefineCtfParameters,list[RefineCtfParameters]],**kwargs):
+
     if not isinstance(parameters, list):
         parameters = [parameters]
     for i, par in enumerate(parameters):
@@ -103,4 +107,4 @@ def run(parameters: Union[RefineCtfParameters,list[RefineCtfParameters]],**kwarg
         socket_job_result_queue : handle_job_result_queue,
         socket_i_have_an_error: handle_i_have_an_error
     }   
-    byte_results = asyncio.run(cistem_program.run("refine_ctf", parameters, signal_handlers=signal_handlers,**kwargs))
+    return(await cistem_program.run("refine_ctf", parameters, signal_handlers=signal_handlers,**kwargs))
@@ -2,15 +2,17 @@ import asyncio
 import re
 import struct
 from dataclasses import dataclass
+from pathlib import Path
 from pickle import FALSE
 from typing import Union
 
 import pandas as pd
-import starfile
 
 from pycistem.database import get_image_info_from_db, get_tm_info_from_db
 from pycistem.programs import cistem_program
 from pycistem.programs._cistem_constants import socket_template_match_result_ready
+from pycistem.programs.results_store import ResultsStore
+from pycistem.star import write_star
 
 
 @dataclass
@@ -68,13 +70,28 @@ signal_handlers = {
     socket_template_match_result_ready : handle_results
 }
 
-def parameters_from_database(database, image_asset_id, template_match_id, **kwargs):
+def parameters_from_database(database, image_asset_id, template_match_id, results_store=None, **kwargs):
+    """Parameters to refine the result of a template match of one image.
+
+    The input maps are the files recorded in the database, unless a
+    ``results_store`` of the search is given: its planes are then written to
+    MRC files in ``directory_for_results``, one block of rows at a time.
+    """
     image_info = get_image_info_from_db(database, image_asset=image_asset_id)
     if image_info is None:
         return None
     tm_info = get_tm_info_from_db(database,image_asset_id, template_match_id)
     if tm_info is None:
         return(None)
+    if results_store is not None:
+        tm_info = dict(tm_info)
+        directory = Path(kwargs.get("directory_for_results", RefineTemplateParameters.directory_for_results))
+        stem = Path(results_store).stem
+        with ResultsStore(results_store) as store:
+            for plane, column in (("mip", "MIP_OUTPUT_FILE"), ("scaled_mip", "SCALED_MIP_OUTPUT_FILE"), ("defocus", "DEFOCUS_OUTPUT_FILE"), ("psi", "PSI_OUTPUT_FILE"), ("theta", "THETA_OUTPUT_FILE"), ("phi", "PHI_OUTPUT_FILE")):
+                filename = (directory / f"{stem}_{plane}.mrc").as_posix()
+                store.to_mrc(plane, filename, pixel_size=store.metadata.get("pixel_size"))
+                tm_info[column] = filename
     par = RefineTemplateParameters(input_search_image=image_info["FILENAME"],
                              pixel_size=image_info["image_pixel_size"],
                              voltate_kV=image_info["VOLTAGE"],
@@ -92,14 +109,9 @@ def parameters_from_database(database, image_asset_id, template_match_id, **kwar
                              **kwargs)
     return(par)
 
-def run(parameters: Union[RefineTemplateParameters,list[RefineTemplateParameters]],**kwargs):
-
-    if not isinstance(parameters, list):
-        parameters = [parameters]
-
-    byte_results = asyncio.run(cistem_program.run("refine_template", parameters, signal_handlers=signal_handlers,**kwargs))
+def _empty_peaks():
     #File names of original image file name, 3D template file name, energy, Cs, amp. contrast, phase shift, X, Y position, Euler angles, defocus 1 & 2 & angle, pixel size, CC average, CC STD, SNR, scaled SNR
-    result_peaks = pd.DataFrame({
+    return pd.DataFrame({
         "image_filename": pd.Series(dtype="object"),
         "template_filename": pd.Series(dtype="object"),
         "energy": pd.Series(dtype="float"),
@@ -120,38 +132,59 @@ def run(parameters: Union[RefineTemplateParameters,list[RefineTemplateParameters
         "peak_value": pd.Series(dtype="float")
         })
 
-    for parameter_index,byte_result in byte_results:
-        struct.unpack_from("<i",byte_result,offset=0)[0]
-        peak_numbers = struct.unpack_from("<i",byte_result,offset=4)[0]
-        struct.unpack_from("<i",byte_result,offset=8)[0]
-        struct.unpack_from("<f",byte_result,offset=12)[0]
-
-
-        for peak_number in range(peak_numbers):
-            (x, y, psi, theta, phi, defocus, pixel_size, peak_height) = struct.unpack_from("<ffffffff",byte_result,offset=16+peak_number*32)
-            new_peak_series = pd.Series([
-                parameters[parameter_index].input_search_image,
-                parameters[parameter_index].input_reconstruction,
-                parameters[parameter_index].voltate_kV,
-                parameters[parameter_index].spherical_aberration_mm,
-                parameters[parameter_index].amplitude_contrast,
-                parameters[parameter_index].phase_shift,
-                parameters[parameter_index].defocus1,
-                parameters[parameter_index].defocus2,
-                parameters[parameter_index].defocus_angle,
-                int(peak_number),
-                x,
-                y,
-                psi,
-                theta,
-                phi,
-                defocus,
-                pixel_size,
-                peak_height], index = result_peaks.columns)
-            result_peaks.loc[len(result_peaks.index)] = new_peak_series
+def _decode_result(parameters, parameter_index, byte_result):
+    result_peaks = _empty_peaks()
+    struct.unpack_from("<i",byte_result,offset=0)[0]
+    peak_numbers = struct.unpack_from("<i",byte_result,offset=4)[0]
+    struct.unpack_from("<i",byte_result,offset=8)[0]
+    struct.unpack_from("<f",byte_result,offset=12)[0]
 
+    par = parameters[parameter_index]
+    for peak_number in range(peak_numbers):
+        (x, y, psi, theta, phi, defocus, pixel_size, peak_height) = struct.unpack_from("<ffffffff",byte_result,offset=16+peak_number*32)
+        new_peak_series = pd.Series([
+            par.input_search_image,
+            par.input_reconstruction,
+            par.voltate_kV,
+            par.spherical_aberration_mm,
+            par.amplitude_contrast,
+            par.phase_shift,
+            par.defocus1,
+            par.defocus2,
+            par.defocus_angle,
+            int(peak_number),
+            x,
+            y,
+            psi,
+            theta,
+            phi,
+            defocus,
+            pixel_size,
+            peak_height], index = result_peaks.columns)
+        result_peaks.loc[len(result_peaks.index)] = new_peak_series
     return(result_peaks)
 
+def run(parameters: Union[RefineTemplateParameters,list[RefineTemplateParameters]],**kwargs):
+
+    return(asyncio.run(run_async(parameters, **kwargs)))
+
+async def run_async(parameters: Union[RefineTemplateParameters,list[RefineTemplateParameters]],**kwargs):
+
+    if not isinstance(parameters, list):
+        parameters = [parameters]
+
+    byte_results = await cistem_program.run("refine_template", parameters, signal_handlers=signal_handlers,**kwargs)
+    result_peaks = [_decode_result(parameters, parameter_index, byte_result) for parameter_index, byte_result in byte_results]
+    return(byte_results.attach_to(pd.concat([_empty_peaks()] + result_peaks, ignore_index=True)))
+
+async def run_iter(parameters: Union[RefineTemplateParameters,list[RefineTemplateParameters]],**kwargs):
+
+    if not isinstance(parameters, list):
+        parameters = [parameters]
+
+    async for parameter_index, byte_result in cistem_program.run_iter("refine_template", parameters, signal_handlers=signal_handlers,**kwargs):
+        yield parameter_index, _decode_result(parameters, parameter_index, byte_result)
+
 def write_starfile(results,filename, overwrite=True):
     # Write the results dataframe to a star file
-    starfile.write(results, filename=filename, overwrite=overwrite)
+    write_star(results, filename, overwrite=overwrite)
@@ -2,6 +2,7 @@ import asyncio
 import struct
 from dataclasses import dataclass
 from pickle import FALSE
+from typing import Union
 
 import pandas as pd
 
@@ -98,27 +99,31 @@ def parameters_from_database(database, image_asset_id, template_match_id, **kwar
                              **kwargs)
     return(par)
 
-def run(parameters: RefineTemplateParameters):
-    byte_result = asyncio.run(cistem_program.run("refine_template", parameters, signal_handlers=signal_handlers))[0]
-    struct.unpack_from("<i",byte_result,offset=0)[0]
+def _empty_peaks():
+    return pd.DataFrame({"peak_number": pd.Series(dtype="int"),
+                         "x": pd.Series(dtype="float"),
+                         "y": pd.Series(dtype="float"),
+                         "psi": pd.Series(dtype="float"),
+                         "theta": pd.Series(dtype="float"),
+                         "phi": pd.Series(dtype="float"),
+                         "defocus": pd.Series(dtype="float"),
+                         "pixel_size": pd.Series(dtype="float"),
+                         "peak_value": pd.Series(dtype="float")})
+
+def _decode_result(byte_result):
     peak_numbers = struct.unpack_from("<i",byte_result,offset=4)[0]
-    struct.unpack_from("<i",byte_result,offset=8)[0]
-    struct.unpack_from("<f",byte_result,offset=12)[0]
+    peaks = [(peak_number, *struct.unpack_from("<ffffffff",byte_result,offset=16+peak_number*32)) for peak_number in range(peak_numbers)]
+    return(pd.DataFrame(peaks, columns=_empty_peaks().columns))
+
+def run(parameters: Union[RefineTemplateParameters,list[RefineTemplateParameters]],**kwargs):
 
-    result_peaks = pd.DataFrame({"peak_number": pd.Series(dtype="int"),
-                                 "x": pd.Series(dtype="float"),
-                                 "y": pd.Series(dtype="float"),
-                                 "psi": pd.Series(dtype="float"),
-                                 "theta": pd.Series(dtype="float"),
-                                 "phi": pd.Series(dtype="float"),
-                                 "defocus": pd.Series(dtype="float"),
-                                 "pixel_size": pd.Series(dtype="float"),
-                                 "peak_value": pd.Series(dtype="float")})
+    return(asyncio.run(run_async(parameters, **kwargs)))
 
-    for peak_number in range(peak_numbers):
-        (x, y, psi, theta, phi, defocus, pixel_size, peak_height) = struct.unpack_from("<ffffffff",byte_result,offset=16+peak_number*32)
-        a_series = pd.Series([peak_number, x, y, psi, theta, phi, defocus, pixel_size, peak_height], index = result_peaks.columns)
-        result_peaks = result_peaks.append(a_series, ignore_index=True)
+async def run_async(parameters: Union[RefineTemplateParameters,list[RefineTemplateParameters]],**kwargs):
 
-    return(result_peaks)
+    if not isinstance(parameters, list):
+        parameters = [parameters]
 
+    byte_results = await cistem_program.run("refine_template", parameters, signal_handlers=signal_handlers,**kwargs)
+    result_peaks = [_decode_result(byte_result) for _parameter_index, byte_result in byte_results]
+    return(byte_results.attach_to(pd.concat([_empty_peaks()] + result_peaks, ignore_index=True)))
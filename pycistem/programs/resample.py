@@ -22,9 +22,13 @@ class ResampleParameters:
 
 def run(parameters: Union[ResampleParameters,list[ResampleParameters]],**kwargs):
 
+    return(asyncio.run(run_async(parameters, **kwargs)))
+
+async def run_async(parameters: Union[ResampleParameters,list[ResampleParameters]],**kwargs):
+
     if not isinstance(parameters, list):
         parameters = [parameters]
-   
-    asyncio.run(cistem_program.run("resample", parameters, **kwargs))
+
+    return(await cistem_program.run("resample", parameters, **kwargs))
     
         
\ No newline at end of file
@@ -0,0 +1,192 @@
+"""One file per match_template result holding all output planes, the histogram and metadata.
+
+The planes are stored either uncompressed, so that :class:`ResultsStore`
+memory-maps them, or as zlib compressed square tiles, of which only the
+ones overlapping a requested region are read. They can be reduced to
+float16 in either case::
+
+    write_results("image.tmresults", planes, histogram, {"number_of_ccs": 1e6}, compression="zlib")
+    with ResultsStore("image.tmresults") as store:
+        psi = store.read("psi", slice(1000, 1100), slice(2000, 2100))
+"""
+import json
+import struct
+import zlib
+
+import mrcfile
+import numpy as np
+
+# The planes match_template sends, with sum and sum of squares already
+# turned into mean and standard deviation of the correlation
+PLANES = ("mip", "psi", "theta", "phi", "defocus", "pixel_size", "mean", "std")
+
+_MAGIC = b"PYCTMRS1"
+# Magic, then offset and length of the JSON header at the end of the file
+_PREAMBLE = struct.Struct("<8sQQ")
+_ALIGNMENT = 64
+
+
+def _aligned(offset):
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def _tile_slices(shape, tile_size):
+    for y in range(0, shape[0], tile_size):
+        for x in range(0, shape[1], tile_size):
+            yield slice(y, min(y + tile_size, shape[0])), slice(x, min(x + tile_size, shape[1]))
+
+
+def write_results(path, planes, histogram, metadata=None, dtype=np.float32, compression=None, tile_size=512, level=6):
+    """Write the planes (a mapping of names in :data:`PLANES` to 2D arrays) of one image to ``path``.
+
+    ``compression`` is ``None`` or ``"zlib"``, with tiles of ``tile_size``
+    pixels squared compressed at ``level``.
+    """
+    if compression not in (None, "zlib"):
+        msg = f"Unknown compression {compression}"
+        raise ValueError(msg)
+    dtype = np.dtype(dtype)
+    names = [name for name in PLANES if name in planes]
+    shape = np.shape(planes[names[0]])
+    header = {
+        "version": 1,
+        "shape": list(shape),
+        "dtype": dtype.str,
+        "compression": compression,
+        "tile_size": tile_size,
+        "planes": {},
+        "metadata": metadata or {},
+    }
+    with open(path, "wb") as fp:
+        fp.write(_PREAMBLE.pack(_MAGIC, 0, 0))
+        for name in names:
+            plane = np.asarray(planes[name])
+            if plane.shape != shape:
+                msg = f"Plane {name} has shape {plane.shape} instead of {shape}"
+                raise ValueError(msg)
+            offset = _aligned(fp.tell())
+            fp.seek(offset)
+            if compression is None:
+                # Written in blocks of rows, so large planes aren't copied at once
+                for rows, _columns in _tile_slices((shape[0], 1), tile_size):
+                    fp.write(np.ascontiguousarray(plane[rows], dtype=dtype).tobytes())
+                header["planes"][name] = {"offset": offset}
+            else:
+                tiles = []
+                for rows, columns in _tile_slices(shape, tile_size):
+                    data = zlib.compress(np.ascontiguousarray(plane[rows, columns], dtype=dtype).tobytes(), level)
+                    tiles.append([fp.tell(), len(data)])
+                    fp.write(data)
+                header["planes"][name] = {"tiles": tiles}
+        histogram = np.ascontiguousarray(histogram, dtype=np.int64)
+        header["histogram"] = {"offset": fp.tell(), "length": len(histogram)}
+        fp.write(histogram.tobytes())
+        header_bytes = json.dumps(header).encode("utf-8")
+        header_offset = fp.tell()
+        fp.write(header_bytes)
+        fp.seek(0)
+        fp.write(_PREAMBLE.pack(_MAGIC, header_offset, len(header_bytes)))
+
+
+class ResultsStore:
+    """Read access to a file written by :func:`write_results`."""
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, "rb")
+        magic, header_offset, header_length = _PREAMBLE.unpack(self._fp.read(_PREAMBLE.size))
+        if magic != _MAGIC:
+            self._fp.close()
+            msg = f"{path} is not a match_template results file"
+            raise ValueError(msg)
+        self._fp.seek(header_offset)
+        self._header = json.loads(self._fp.read(header_length))
+        self.shape = tuple(self._header["shape"])
+        self.dtype = np.dtype(self._header["dtype"])
+        self.compression = self._header["compression"]
+        self.tile_size = self._header["tile_size"]
+        self.metadata = self._header["metadata"]
+        self.planes = tuple(self._header["planes"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self._fp.close()
+
+    @property
+    def histogram(self):
+        histogram = self._header["histogram"]
+        return np.fromfile(self.path, dtype=np.int64, count=histogram["length"], offset=histogram["offset"])
+
+    def __getitem__(self, name):
+        """The whole plane, memory-mapped if it isn't compressed."""
+        if self.compression is None:
+            return np.memmap(self.path, dtype=self.dtype, mode="r", offset=self._header["planes"][name]["offset"], shape=self.shape)
+        return self.read(name)
+
+    def read(self, name, rows=slice(None), columns=slice(None)):
+        """The region of a plane as a float32 array, reading only the tiles it overlaps."""
+        if name not in self._header["planes"]:
+            msg = f"{self.path} has no plane {name}"
+            raise KeyError(msg)
+        rows = range(*rows.indices(self.shape[0]))
+        columns = range(*columns.indices(self.shape[1]))
+        if rows.step != 1 or columns.step != 1:
+            msg = "Only contiguous regions can be read"
+            raise ValueError(msg)
+        if self.compression is None:
+            return np.array(self[name][rows.start:rows.stop, columns.start:columns.stop], dtype=np.float32)
+        out = np.empty((len(rows), len(columns)), dtype=np.float32)
+        tiles = self._header["planes"][name]["tiles"]
+        tiles_per_row = -(-self.shape[1] // self.tile_size)
+        for tile_row in range(rows.start // self.tile_size, -(-rows.stop // self.tile_size)):
+            for tile_column in range(columns.start // self.tile_size, -(-columns.stop // self.tile_size)):
+                y = tile_row * self.tile_size
+                x = tile_column * self.tile_size
+                tile = self._tile(tiles[tile_row * tiles_per_row + tile_column], min(self.tile_size, self.shape[0] - y), min(self.tile_size, self.shape[1] - x))
+                y0, y1 = max(rows.start, y), min(rows.stop, y + tile.shape[0])
+                x0, x1 = max(columns.start, x), min(columns.stop, x + tile.shape[1])
+                out[y0 - rows.start:y1 - rows.start, x0 - columns.start:x1 - columns.start] = tile[y0 - y:y1 - y, x0 - x:x1 - x]
+        return out
+
+    def values_at(self, name, coordinates):
+        """Values of a plane at ``(y, x)`` coordinates, reading each tile only once."""
+        coordinates = np.asarray(coordinates, dtype=np.int64).reshape(-1, 2)
+        if self.compression is None:
+            return np.asarray(self[name][tuple(coordinates.T)], dtype=np.float32)
+        values = np.empty(len(coordinates), dtype=np.float32)
+        tiles = self._header["planes"][name]["tiles"]
+        tiles_per_row = -(-self.shape[1] // self.tile_size)
+        tile_rows, tile_columns = (coordinates // self.tile_size).T
+        tile_indices = tile_rows * tiles_per_row + tile_columns
+        for tile_index in np.unique(tile_indices):
+            selected = tile_indices == tile_index
+            y = tile_rows[selected][0] * self.tile_size
+            x = tile_columns[selected][0] * self.tile_size
+            tile = self._tile(tiles[tile_index], min(self.tile_size, self.shape[0] - y), min(self.tile_size, self.shape[1] - x))
+            values[selected] = tile[coordinates[selected, 0] - y, coordinates[selected, 1] - x]
+        return values
+
+    def _tile(self, tile, height, width):
+        offset, length = tile
+        self._fp.seek(offset)
+        return np.frombuffer(zlib.decompress(self._fp.read(length)), dtype=self.dtype).reshape(height, width)
+
+    def scaled_mip(self, rows=slice(None), columns=slice(None)):
+        """(mip - mean) / std of a region, 0 where the standard deviation is."""
+        mip = self.read("mip", rows, columns)
+        mean = self.read("mean", rows, columns)
+        std = self.read("std", rows, columns)
+        return np.divide(mip - mean, std, out=np.zeros(mip.shape, dtype=np.float32), where=std!=0)
+
+    def to_mrc(self, name, filename, pixel_size=None):
+        """Write a plane (or ``"scaled_mip"``) to an MRC file one block of rows at a time."""
+        with mrcfile.new_mmap(filename, shape=self.shape, mrc_mode=2, overwrite=True) as mrc:
+            for rows, _columns in _tile_slices((self.shape[0], 1), self.tile_size):
+                mrc.data[rows] = self.scaled_mip(rows) if name == "scaled_mip" else self.read(name, rows)
+            if pixel_size is not None:
+                mrc.voxel_size = pixel_size
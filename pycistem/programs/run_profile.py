@@ -1,3 +1,9 @@
+import shlex
+from dataclasses import dataclass, field
+from typing import Optional
+
+from pycistem.pycore import RunProfile
+
 
 host_gpu_info = {
     "kyiv": 8,
@@ -15,3 +21,114 @@ def generate_gpu_prefix(host_gpu_info):
 
 def generate_num_procs(host_gpu_info):
     return sum(host_gpu_info.values())
+
+
+@dataclass
+class Slot:
+    """One worker process of a :class:`Cluster`.
+
+    ``command`` is run with ``$command`` replaced by the executable and its
+    arguments. ``speed`` is relative to the other slots and ``memory`` (in
+    GB, ``None`` for no limit) is compared to the requirement of each job.
+    """
+    host: str
+    command: str = "$command"
+    speed: float = 1.0
+    memory: Optional[float] = None
+    threads: int = 1
+    delay_time_in_ms: int = 0
+    index: int = 0
+
+    @property
+    def name(self):
+        return f"{self.host}/{self.index}"
+
+
+def _host_of(command):
+    words = shlex.split(command.replace("$command", ""), posix=True) if command else []
+    if len(words) > 1 and words[0] == "ssh":
+        return [word for word in words[1:] if not word.startswith("-")][0]
+    return "localhost"
+
+
+@dataclass
+class Cluster:
+    """The worker slots a :class:`~pycistem.programs.cistem_program.WorkerPool` launches.
+
+    Can be passed as ``num_procs``. Faster slots are handed the more expensive
+    jobs, and jobs are only given to slots with enough memory for them.
+    """
+    slots: list = field(default_factory=list)
+
+    def add_host(self, host, slots, command='ssh {host} "CUDA_VISIBLE_DEVICES={slot} $command"', speed=1.0, memory=None, threads=1, delay_time_in_ms=0):
+        # command may use {host} and {slot}, the index of the slot on this host
+        for slot in range(slots):
+            self.slots.append(Slot(host, command.format(host=host, slot=slot), speed, memory, threads, delay_time_in_ms, slot))
+        return self
+
+    @classmethod
+    def from_host_gpu_info(cls, host_gpu_info, speed={}, memory={}):
+        """One slot per GPU, as :func:`generate_gpu_prefix` launches them.
+
+        ``speed`` and ``memory`` map host names to the values of their GPUs.
+        """
+        cluster = cls()
+        for host, gpus in host_gpu_info.items():
+            cluster.add_host(host, gpus, speed=speed.get(host, 1.0), memory=memory.get(host))
+        return cluster
+
+    @classmethod
+    def from_run_profile(cls, profile, speed=(), memory=()):
+        """One slot per copy of each run command of ``profile``.
+
+        ``speed`` and ``memory`` give the values for the run commands in order.
+        """
+        cluster = cls()
+        for i, rc in enumerate(profile.run_commands):
+            copies = rc.overriden_number_of_copies if rc.override_total_copies else rc.number_of_copies
+            host = _host_of(rc.command_to_run)
+            first = sum(1 for slot in cluster.slots if slot.host == host)
+            for copy in range(copies):
+                cluster.slots.append(Slot(
+                    host,
+                    rc.command_to_run,
+                    speed[i] if i < len(speed) else 1.0,
+                    memory[i] if i < len(memory) else None,
+                    rc.number_of_threads_per_copy,
+                    rc.delay_time_in_ms,
+                    first + copy,
+                ))
+        return cluster
+
+    @classmethod
+    def local(cls, speed, memory=None, command="$command"):
+        """Slots on this machine with the given speeds, e.g. to try out scheduling.
+
+        ``command`` may use ``{speed}`` to throttle each process accordingly.
+        """
+        cluster = cls()
+        for i, slot_speed in enumerate(speed):
+            slot_memory = memory[i] if memory is not None else None
+            cluster.slots.append(Slot("localhost", command.format(speed=slot_speed), slot_speed, slot_memory, 1, 0, i))
+        return cluster
+
+    def to_run_profile(self, name=""):
+        profile = RunProfile()
+        profile.name = name
+        for slot in self.slots:
+            profile.AddCommand(slot.command, 1, slot.threads, False, 0, slot.delay_time_in_ms)
+        return profile
+
+    @property
+    def max_speed(self):
+        return max((slot.speed for slot in self.slots), default=1.0)
+
+    @property
+    def max_memory(self):
+        memories = [slot.memory for slot in self.slots]
+        if not memories or None in memories:
+            return None
+        return max(memories)
+
+    def __len__(self):
+        return len(self.slots)
@@ -1,6 +1,5 @@
 import asyncio
 import datetime
-import sqlite3
 import struct
 from dataclasses import dataclass
 from pathlib import Path
@@ -8,9 +7,8 @@ from typing import List, Union
 import time
 
 import mrcfile
-import pandas as pd
 
-from pycistem.database import datetime_to_msdos, get_movie_info_from_db
+from pycistem.database import datetime_to_msdos, get_movie_info_from_db, insert_rows, run_in_transaction
 from pycistem.programs import cistem_program
 from pycistem.programs._cistem_constants import socket_job_result, socket_send_next_job
 
@@ -83,92 +81,86 @@ def parameters_from_database(database, decolace=False, **kwargs):
     ) for i,movie in movie_info.iterrows()]
     return(par)
 
-def write_results_to_database(database,  parameters, results, change_image_assets=True):
-    conn = sqlite3.connect(database)
-    cur = conn.cursor()
+def write_results_to_database(database,  parameters, results, change_image_assets=True, writer=None):
+    """Add the results as a new alignment job and, with ``change_image_assets``, their sums as images.
+
+    With a :class:`~pycistem.database.DatabaseWriter` as ``writer`` the
+    rows are queued on its thread instead of written before returning.
+    """
     results = sorted(results, key=lambda x: x["parameter_index"])
-    MOVIE_ALIGNMENT_LIST = []
-
-    max_alignment_id= cur.execute("SELECT MAX(ALIGNMENT_ID) FROM MOVIE_ALIGNMENT_LIST").fetchone()[0]
-    if max_alignment_id is None:
-        max_alignment_id = 0
-    alignment_job_id= cur.execute("SELECT MAX(ALIGNMENT_JOB_ID) FROM MOVIE_ALIGNMENT_LIST").fetchone()[0]
-    if alignment_job_id is None:
-        alignment_job_id = 1
-    else:
-        alignment_job_id += 1
-
-    max_image_asset_id= cur.execute("SELECT MAX(IMAGE_ASSET_ID) FROM IMAGE_ASSETS").fetchone()[0]
-    if max_image_asset_id is None:
-        max_image_asset_id = 0
+    sizes = []
     for result in results:
-        movie_info = cur.execute("SELECT X_SIZE, Y_SIZE, MOVIE_ASSET_ID, NAME, PROTEIN_IS_WHITE, SPHERICAL_ABERRATION FROM MOVIE_ASSETS WHERE FILENAME = ?", (parameters[result["parameter_index"]].input_filename,)).fetchone()
-        mrc = mrcfile.open(parameters[result["parameter_index"]].output_filename)
-        xsize = mrc.header.nx
-        ysize = mrc.header.ny
-        if result["orig_x"] > 0:
-            x_bin_factor       = movie_info[0] / result["orig_x"]
-            y_bin_factor       = movie_info[1] / result["orig_y"]
+        with mrcfile.open(parameters[result["parameter_index"]].output_filename, header_only=True) as mrc:
+            sizes.append((int(mrc.header.nx), int(mrc.header.ny)))
+    now = datetime_to_msdos(datetime.datetime.now())
+
+    def write(conn):
+        cur = conn.cursor()
+        MOVIE_ALIGNMENT_LIST = []
+        IMAGE_ASSETS = []
+
+        max_alignment_id= cur.execute("SELECT MAX(ALIGNMENT_ID) FROM MOVIE_ALIGNMENT_LIST").fetchone()[0]
+        if max_alignment_id is None:
+            max_alignment_id = 0
+        alignment_job_id= cur.execute("SELECT MAX(ALIGNMENT_JOB_ID) FROM MOVIE_ALIGNMENT_LIST").fetchone()[0]
+        if alignment_job_id is None:
+            alignment_job_id = 1
         else:
-            x_bin_factor       = movie_info[0] / xsize
-            y_bin_factor       = movie_info[1] / ysize
-        average_bin_factor = (x_bin_factor + y_bin_factor) / 2.0
-        actual_pixel_size = parameters[result["parameter_index"]].pixel_size * average_bin_factor
-        MOVIE_ALIGNMENT_LIST.append({
-                    "ALIGNMENT_ID" : max_alignment_id + 1,
-                    "DATETIME_OF_RUN" : datetime_to_msdos(datetime.datetime.now()),
-                    "ALIGNMENT_JOB_ID": alignment_job_id,
-                    "MOVIE_ASSET_ID": movie_info[2],
-                    "OUTPUT_FILE": parameters[result["parameter_index"]].output_filename,
-                    "VOLTAGE": parameters[result["parameter_index"]].acceleration_voltage,
-                    "PIXEL_SIZE": actual_pixel_size,
-                    "EXPOSURE_PER_FRAME": parameters[result["parameter_index"]].exposure_per_frame,
-                    "PRE_EXPOSURE_AMOUNT": parameters[result["parameter_index"]].pre_exposure_amount,
-                    "MIN_SHIFT": parameters[result["parameter_index"]].minimum_shift_in_angstroms,
-                    "MAX_SHIFT": parameters[result["parameter_index"]].maximum_shift_in_angstroms,
-                    "SHOULD_DOSE_FILTER": parameters[result["parameter_index"]].should_dose_filter,
-                    "SHOULD_RESTORE_POWER": parameters[result["parameter_index"]].should_restore_power,
-                    "TERMINATION_THRESHOLD": parameters[result["parameter_index"]].termination_threshold_in_angstroms,
-                    "MAX_ITERATIONS": parameters[result["parameter_index"]].max_iterations ,
-                    "BFACTOR": parameters[result["parameter_index"]].bfactor_in_angstroms,
-                    "SHOULD_MASK_CENTRAL_CROSS": parameters[result["parameter_index"]].should_mask_central_cross,
-                    "HORIZONTAL_MASK": parameters[result["parameter_index"]].horizontal_mask_size,
-                    "VERTICAL_MASK": parameters[result["parameter_index"]].vertical_mask_size,
-                    "SHOULD_INCLUDE_ALL_FRAMES_IN_SUM": True,
-                    "FIRST_FRAME_TO_SUM": parameters[result["parameter_index"]].first_frame,
-                    "LAST_FRAME_TO_SUM": parameters[result["parameter_index"]].last_frame,
-                    "ORIGINAL_X_SIZE": result["orig_x"],
-                    "ORIGINAL_Y_SIZE": result["orig_y"],
-                    "CROP_CENTER_X": result["crop_x"],
-                    "CROP_CENTER_Y": result["crop_y"],
-                    })
-        # Check if there is existing image asset
-
-        #existing_image_asset = cur.execute("SELECT IMAGE_ASSET_ID FROM IMAGE_ASSETS WHERE PARENT_MOVIE_ID = ?",(movie_info[2],)).fetchone()
-        #if existing_image_asset is None:
-        max_image_asset_id += 1
-        image_asset_id = max_image_asset_id
-        #else:
-        #    image_asset_id = existing_image_asset[0]
-
+            alignment_job_id += 1
+
+        max_image_asset_id= cur.execute("SELECT MAX(IMAGE_ASSET_ID) FROM IMAGE_ASSETS").fetchone()[0]
+        if max_image_asset_id is None:
+            max_image_asset_id = 0
+        for result, (xsize, ysize) in zip(results, sizes):
+            par = parameters[result["parameter_index"]]
+            movie_info = cur.execute("SELECT X_SIZE, Y_SIZE, MOVIE_ASSET_ID, NAME, PROTEIN_IS_WHITE, SPHERICAL_ABERRATION FROM MOVIE_ASSETS WHERE FILENAME = ?", (par.input_filename,)).fetchone()
+            if result["orig_x"] > 0:
+                x_bin_factor       = movie_info[0] / result["orig_x"]
+                y_bin_factor       = movie_info[1] / result["orig_y"]
+            else:
+                x_bin_factor       = movie_info[0] / xsize
+                y_bin_factor       = movie_info[1] / ysize
+            average_bin_factor = (x_bin_factor + y_bin_factor) / 2.0
+            actual_pixel_size = par.pixel_size * average_bin_factor
+            max_alignment_id += 1
+            MOVIE_ALIGNMENT_LIST.append({
+                        "ALIGNMENT_ID" : max_alignment_id,
+                        "DATETIME_OF_RUN" : now,
+                        "ALIGNMENT_JOB_ID": alignment_job_id,
+                        "MOVIE_ASSET_ID": movie_info[2],
+                        "OUTPUT_FILE": par.output_filename,
+                        "VOLTAGE": par.acceleration_voltage,
+                        "PIXEL_SIZE": actual_pixel_size,
+                        "EXPOSURE_PER_FRAME": par.exposure_per_frame,
+                        "PRE_EXPOSURE_AMOUNT": par.pre_exposure_amount,
+                        "MIN_SHIFT": par.minimum_shift_in_angstroms,
+                        "MAX_SHIFT": par.maximum_shift_in_angstroms,
+                        "SHOULD_DOSE_FILTER": par.should_dose_filter,
+                        "SHOULD_RESTORE_POWER": par.should_restore_power,
+                        "TERMINATION_THRESHOLD": par.termination_threshold_in_angstroms,
+                        "MAX_ITERATIONS": par.max_iterations ,
+                        "BFACTOR": par.bfactor_in_angstroms,
+                        "SHOULD_MASK_CENTRAL_CROSS": par.should_mask_central_cross,
+                        "HORIZONTAL_MASK": par.horizontal_mask_size,
+                        "VERTICAL_MASK": par.vertical_mask_size,
+                        "SHOULD_INCLUDE_ALL_FRAMES_IN_SUM": True,
+                        "FIRST_FRAME_TO_SUM": par.first_frame,
+                        "LAST_FRAME_TO_SUM": par.last_frame,
+                        "ORIGINAL_X_SIZE": result["orig_x"],
+                        "ORIGINAL_Y_SIZE": result["orig_y"],
+                        "CROP_CENTER_X": result["crop_x"],
+                        "CROP_CENTER_Y": result["crop_y"],
+                        })
+            max_image_asset_id += 1
+            IMAGE_ASSETS.append((max_image_asset_id, movie_info[3], par.output_filename, 1,movie_info[2],max_alignment_id, -1, xsize, ysize, actual_pixel_size, par.acceleration_voltage, movie_info[5], movie_info[4],result["orig_x"],result["orig_y"],result["crop_x"],result["crop_y"]))
+            cur.execute(f"CREATE TABLE MOVIE_ALIGNMENT_PARAMETERS_{max_alignment_id} (FRAME_NUMBER INTEGER, X_SHIFT REAL, Y_SHIFT REAL)")
+            cur.executemany(f"INSERT INTO MOVIE_ALIGNMENT_PARAMETERS_{max_alignment_id} (FRAME_NUMBER, X_SHIFT, Y_SHIFT) VALUES (?,?,?)",
+                zip(range(1,len(result["x_shifts"])+1), result["x_shifts"], result["y_shifts"]))
         if change_image_assets:
-            cur.execute("REPLACE INTO IMAGE_ASSETS (IMAGE_ASSET_ID, NAME, FILENAME, POSITION_IN_STACK, PARENT_MOVIE_ID, ALIGNMENT_ID, CTF_ESTIMATION_ID, X_SIZE, Y_SIZE, PIXEL_SIZE, VOLTAGE, SPHERICAL_ABERRATION, PROTEIN_IS_WHITE, ORIGINAL_X_SIZE, ORIGINAL_Y_SIZE, CROP_CENTER_X, CROP_CENTER_Y) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
-                (image_asset_id, movie_info[3], parameters[result["parameter_index"]].output_filename, 1,movie_info[2],max_alignment_id+1, -1, int(xsize), int(ysize), actual_pixel_size, parameters[result["parameter_index"]].acceleration_voltage, movie_info[5], movie_info[4],result["orig_x"],result["orig_y"],result["crop_x"],result["crop_y"]))
-        MOVIE_ALIGNMENT_PARAMETERS = {
-            "FRAME_NUMBER": range(1,len(result["x_shifts"])+1),
-            "X_SHIFT": result["x_shifts"],
-            "Y_SHIFT": result["y_shifts"],
-        }
-        conn.commit()
-        MOVIE_ALIGNMENT_PARAMETERS = pd.DataFrame(MOVIE_ALIGNMENT_PARAMETERS)
-        MOVIE_ALIGNMENT_PARAMETERS.to_sql(f"MOVIE_ALIGNMENT_PARAMETERS_{max_alignment_id+1}", conn, if_exists="fail", index=False)
-        max_alignment_id += 1
-    MOVIE_ALIGNMENT_LIST = pd.DataFrame(MOVIE_ALIGNMENT_LIST)
-    MOVIE_ALIGNMENT_LIST.to_sql("MOVIE_ALIGNMENT_LIST", conn, if_exists="append", index=False)
-    conn.close()
-
-
+            cur.executemany("REPLACE INTO IMAGE_ASSETS (IMAGE_ASSET_ID, NAME, FILENAME, POSITION_IN_STACK, PARENT_MOVIE_ID, ALIGNMENT_ID, CTF_ESTIMATION_ID, X_SIZE, Y_SIZE, PIXEL_SIZE, VOLTAGE, SPHERICAL_ABERRATION, PROTEIN_IS_WHITE, ORIGINAL_X_SIZE, ORIGINAL_Y_SIZE, CROP_CENTER_X, CROP_CENTER_Y) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", IMAGE_ASSETS)
+        insert_rows(conn, "MOVIE_ALIGNMENT_LIST", MOVIE_ALIGNMENT_LIST)
 
+    run_in_transaction(database, write, writer)
 
 
 async def handle_results(reader, writer, logger):
@@ -183,65 +175,49 @@ signal_handlers = {
     socket_send_next_job : handle_results
 }
 
+def _decode_result(parameter_index, byte_result):
+    number_of_images = int(((len(byte_result) /4 ) - 4 ) /2)
+    x_shifts = []
+    for offset in range(number_of_images):
+        x_shifts.append(struct.unpack_from("<f",byte_result,offset=offset*4)[0])
+    y_shifts = []
+    for offset in range(number_of_images):
+        y_shifts.append(struct.unpack_from("<f",byte_result,offset=offset*4+number_of_images*4)[0])
+    orig_x = int(struct.unpack_from("<f",byte_result,offset=2*4*number_of_images)[0])
+    orig_y = int(struct.unpack_from("<f",byte_result,offset=2*4*number_of_images+4)[0])
+    crop_x = int(struct.unpack_from("<f",byte_result,offset=2*4*number_of_images+8)[0])
+    crop_y = int(struct.unpack_from("<f",byte_result,offset=2*4*number_of_images+12)[0])
+    return({
+        "parameter_index": parameter_index,
+        "x_shifts": x_shifts,
+        "y_shifts": y_shifts,
+        "orig_x": orig_x,
+        "orig_y": orig_y,
+        "crop_x": crop_x,
+        "crop_y": crop_y
+    })
+
 def run(parameters: Union[UnblurParameters,list[UnblurParameters]],**kwargs):
 
     if not isinstance(parameters, list):
         parameters = [parameters]
     
     byte_results = asyncio.run(cistem_program.run("unblur", parameters, signal_handlers=signal_handlers,**kwargs))
-    result_shifts = []
-
-    for parameter_index,byte_result in byte_results:
-        number_of_images = int(((len(byte_result) /4 ) - 4 ) /2)
-        x_shifts = []
-        for offset in range(number_of_images):
-            x_shifts.append(struct.unpack_from("<f",byte_result,offset=offset*4)[0])
-        y_shifts = []
-        for offset in range(number_of_images):
-            y_shifts.append(struct.unpack_from("<f",byte_result,offset=offset*4+number_of_images*4)[0])
-        orig_x = int(struct.unpack_from("<f",byte_result,offset=2*4*number_of_images)[0])
-        orig_y = int(struct.unpack_from("<f",byte_result,offset=2*4*number_of_images+4)[0])
-        crop_x = int(struct.unpack_from("<f",byte_result,offset=2*4*number_of_images+8)[0])
-        crop_y = int(struct.unpack_from("<f",byte_result,offset=2*4*number_of_images+12)[0])
-        result_shifts.append({
-            "parameter_index": parameter_index,
-            "x_shifts": x_shifts,
-            "y_shifts": y_shifts,
-            "orig_x": orig_x,
-            "orig_y": orig_y,
-            "crop_x": crop_x,
-            "crop_y": crop_y
-        })
-
-    return(result_shifts)
+
+    return(byte_results.with_results([_decode_result(parameter_index, byte_result) for parameter_index, byte_result in byte_results]))
 
 async def run_async(parameters: Union[UnblurParameters,list[UnblurParameters]],**kwargs):
 
     if not isinstance(parameters, list):
         parameters = [parameters]
     byte_results = await cistem_program.run("unblur", parameters, signal_handlers=signal_handlers,**kwargs)
-    result_shifts = []
-
-    for parameter_index,byte_result in byte_results:
-        number_of_images = int(((len(byte_result) /4 ) - 4 ) /2)
-        x_shifts = []
-        for offset in range(number_of_images):
-            x_shifts.append(struct.unpack_from("<f",byte_result,offset=offset*4)[0])
-        y_shifts = []
-        for offset in range(number_of_images):
-            y_shifts.append(struct.unpack_from("<f",byte_result,offset=offset*4+number_of_images*4)[0])
-        orig_x = int(struct.unpack_from("<f",byte_result,offset=2*4*number_of_images)[0])
-        orig_y = int(struct.unpack_from("<f",byte_result,offset=2*4*number_of_images+4)[0])
-        crop_x = int(struct.unpack_from("<f",byte_result,offset=2*4*number_of_images+8)[0])
-        crop_y = int(struct.unpack_from("<f",byte_result,offset=2*4*number_of_images+12)[0])
-        result_shifts.append({
-            "parameter_index": parameter_index,
-            "x_shifts": x_shifts,
-            "y_shifts": y_shifts,
-            "orig_x": orig_x,
-            "orig_y": orig_y,
-            "crop_x": crop_x,
-            "crop_y": crop_y
-        })
-
-    return(result_shifts)
+
+    return(byte_results.with_results([_decode_result(parameter_index, byte_result) for parameter_index, byte_result in byte_results]))
+
+async def run_iter(parameters: Union[UnblurParameters,list[UnblurParameters]],**kwargs):
+
+    if not isinstance(parameters, list):
+        parameters = [parameters]
+
+    async for parameter_index, byte_result in cistem_program.run_iter("unblur", parameters, signal_handlers=signal_handlers,**kwargs):
+        yield parameter_index, _decode_result(parameter_index, byte_result)
@@ -201,7 +201,7 @@ def run(parameters: Union[UnblurPatchParameters,list[UnblurPatchParameters]], un
         })
 
 
-    return(result_shifts)
+    return(byte_results.with_results(result_shifts))
 
 async def run_async(parameters: Union[UnblurPatchParameters,list[UnblurPatchParameters]], unblur_command: str="unblur", **kwargs):
 
@@ -232,4 +232,4 @@ async def run_async(parameters: Union[UnblurPatchParameters,list[UnblurPatchPara
             "crop_y": 0
         })
 
-    return(result_shifts)
\ No newline at end of file
+    return(byte_results.with_results(result_shifts))
\ No newline at end of file
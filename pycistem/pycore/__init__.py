@@ -5,7 +5,7 @@ package has no dependency on the compiled pycistem.core C++ extension.
 """
 
 from pycistem.pycore._database import Database
-from pycistem.pycore._euler_search import EulerSearch, ParameterMap
+from pycistem.pycore._euler_search import EulerSearch, ParameterMap, SearchGrid, search_grid
 from pycistem.pycore._project import Project
 from pycistem.pycore._run_profiles import RunCommand, RunProfile, RunProfileManager
 
@@ -17,4 +17,6 @@ __all__ = [
     "RunCommand",
     "RunProfile",
     "RunProfileManager",
+    "SearchGrid",
+    "search_grid",
 ]
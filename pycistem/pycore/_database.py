@@ -10,10 +10,12 @@ by dumping `.schema` from a project created by the compiled extension
 the C++ CreateXTable() methods by hand.
 """
 
+import logging
 import os
-import sqlite3
 from pathlib import Path
 
+log = logging.getLogger(__name__)
+
 # Captured via `sqlite3 <db created by pycistem.core.Project.CreateNewProject> .schema`
 SCHEMA_SQL = [
     "CREATE TABLE MASTER_SETTINGS(NUMBER INTEGER PRIMARY KEY, PROJECT_DIRECTORY TEXT, PROJECT_NAME TEXT, CURRENT_VERSION INTEGER, TOTAL_CPU_HOURS REAL, TOTAL_JOBS_RUN INTEGER, CISTEM_VERSION_TEXT TEXT, CURRENT_WORKFLOW INTEGER )",
@@ -49,6 +51,13 @@ INTEGER_DATABASE_VERSION = 2
 CISTEM_VERSION_TEXT = "pycore"
 
 
+def _connect(path):
+    # Imported here, as pycistem.database itself imports pycore
+    from pycistem.database._connection import connect
+
+    return connect(path, isolation_level=None)
+
+
 class Database:
     def __init__(self):
         self.is_open = False
@@ -65,7 +74,7 @@ class Database:
         if path.exists():
             raise RuntimeError("Attempting to create a new database, but the file already exists")
         path = path.absolute()
-        self.connection = sqlite3.connect(str(path), isolation_level=None)
+        self.connection = _connect(path)
         self.database_file = path
         self.is_open = True
         return True
@@ -76,14 +85,25 @@ class Database:
         path = Path(file_to_open)
         if not path.exists():
             raise RuntimeError("Attempting to open a new database, but the file does not exist")
-        self.connection = sqlite3.connect(str(path), isolation_level=None)
+        self.connection = _connect(path)
         self.database_file = path
         self.is_open = True
+        if not disable_locking:
+            from pycistem.database._connection import acquire_process_lock, process_lock_holder
+
+            if not acquire_process_lock(self.connection):
+                # Both can work on the project, the busy timeout of the
+                # connections keeps their writes apart
+                pid, host = process_lock_holder(self.connection)
+                log.warning(f"{path} is also open in process {pid} on {host}")
         return True
 
     def CreateAllTables(self):
+        from pycistem.database._queries import ensure_indexes
+
         for statement in SCHEMA_SQL:
             self.ExecuteSQL(statement)
+        ensure_indexes(self.connection)
         return True
 
     def DeleteTable(self, table_name):
@@ -8,6 +8,8 @@ is not implemented here.
 """
 
 import math
+from collections import namedtuple
+from functools import lru_cache
 
 import numpy as np
 
@@ -58,7 +60,8 @@ class EulerSearch:
         self.test_mirror = False
         self.for_mt = False
         self.symmetry_symbol = ""
-        self.list_of_search_parameters = []
+        # (phi, theta) of every search position as float32
+        self.search_positions = np.empty((0, 2), dtype=_f32)
 
     def Init(self, wanted_resolution_limit, wanted_parameter_map, wanted_parameters_to_keep):
         self.parameter_map = wanted_parameter_map
@@ -96,66 +99,22 @@ class EulerSearch:
             self.best_parameters_to_keep = self.number_of_search_positions
 
     def CalculateGridSearchPositions(self, random_start_angle=True):
-        # cisTEM declares all of these as C++ `float` (32-bit); the exact
-        # positions of the `theta < theta_max_local + theta_step / 2.0` and
-        # `phi < phi_max` loop boundaries are precision-sensitive (an
-        # off-by-one there changes number_of_search_positions), so the
-        # arithmetic below is done in float32 throughout to match.
-        angular_step_size = _f32(self.angular_step_size)
-        phi_max = _f32(self.phi_max)
-        theta_max = _f32(self.theta_max)
-        theta_start = _f32(self.theta_start)
-        phi_start = _f32(self.phi_start)
-
-        phi_step = _f32(360.0)
-        theta_step = _f32(360.0)
-        theta_max_local = theta_max
-        phi_start_local = phi_start
-        theta_start_local = theta_start
-
-        if self.parameter_map.phi:
-            theta_step = theta_max_local / _f32(int(theta_max_local / angular_step_size + _f32(0.5)))
-            if random_start_angle:
-                theta_start_local = abs(theta_step / _f32(2.0) * _f32(_uniform_random()))
-            else:
-                theta_start_local = _f32(0.0)
-            if self.for_mt:
-                theta_start_local = theta_start
+        args = (self.angular_step_size, self.phi_max, self.theta_max, self.theta_start, self.phi_start, bool(self.parameter_map.phi), self.for_mt)
+        if random_start_angle:
+            positions = _grid_positions(*args, random_start_angle=True)
         else:
-            theta_start_local = theta_start
-            theta_max_local = theta_start
-
-        self.list_of_search_parameters = []
-        theta = theta_start_local
-        while theta < theta_max_local + theta_step / _f32(2.0):
-            if self.parameter_map.phi:
-                if theta == _f32(0.0) or theta == _f32(180.0):
-                    phi_step = phi_max
-                else:
-                    # angular sampling adapted from Spider subroutine VOEA (Paul Penczek)
-                    phi_step = abs(angular_step_size / _f32(math.sin(_deg2rad(theta))))
-                    if phi_step > phi_max:
-                        phi_step = phi_max
-                    phi_step = phi_max / _f32(int(phi_max / phi_step + _f32(0.5)))
-                if theta != _f32(0.0) and theta != _f32(180.0):
-                    if random_start_angle:
-                        phi_start_local = phi_step / _f32(2.0) * _f32(_uniform_random())
-                    else:
-                        phi_start_local = _f32(0.0)
-                    if self.for_mt:
-                        phi_start_local = phi_start
-
-            phi = _f32(0.0)
-            while phi < phi_max:
-                self.list_of_search_parameters.append((float(phi + phi_start_local), float(theta)))
-                phi += phi_step
-            theta += theta_step
-
-        self.number_of_search_positions = len(self.list_of_search_parameters)
+            positions = _cached_grid_positions(*args)
+        self.search_positions = positions
+        self.number_of_search_positions = len(positions)
 
         if not self.parameter_map.psi:
             self.test_mirror = False
 
+    @property
+    def list_of_search_parameters(self):
+        # (phi, theta) of every search position
+        return [tuple(position) for position in self.search_positions.tolist()]
+
     def CalculateRandomSearchPositions(self):
         raise NotImplementedError("EulerSearch.CalculateRandomSearchPositions is not implemented in pycore")
 
@@ -218,6 +177,115 @@ class EulerSearch:
         raise ValueError("Invalid symmetry symbol")
 
 
+def _accumulate(start, step, bound):
+    # start, start + step, (start + step) + step, ... while below bound,
+    # rounded to float32 after every addition like the loops in cisTEM.
+    # add.accumulate adds sequentially, so the values are bit for bit the
+    # same as those of a scalar loop.
+    start, step, bound = _f32(start), np.asarray(step, dtype=_f32), _f32(bound)
+    length = int(np.max((bound - start) / step)) + 2 if step.size else 1
+    while True:
+        values = np.empty(step.shape + (length,), dtype=_f32)
+        values[..., 0] = start
+        values[..., 1:] = step[..., None]
+        np.add.accumulate(values, axis=-1, out=values)
+        if np.all(values[..., -1] >= bound):
+            return values
+        length *= 2
+
+
+def _grid_positions(angular_step_size, phi_max, theta_max, theta_start, phi_start, search_phi, for_mt, random_start_angle=False):
+    # Vectorized EulerSearch::CalculateGridSearchPositions, see the comments
+    # in the loop version in cisTEM/src/core/euler_search.cpp. Everything
+    # is float32 as there, since the loop boundaries are precision-sensitive.
+    angular_step_size = _f32(angular_step_size)
+    phi_max = _f32(phi_max)
+    theta_max_local = _f32(theta_max)
+    theta_start = _f32(theta_start)
+    phi_start = _f32(phi_start)
+
+    if search_phi:
+        theta_step = theta_max_local / _f32(int(theta_max_local / angular_step_size + _f32(0.5)))
+        if random_start_angle:
+            theta_start_local = abs(theta_step / _f32(2.0) * _f32(_uniform_random()))
+        else:
+            theta_start_local = _f32(0.0)
+        if for_mt:
+            theta_start_local = theta_start
+    else:
+        theta_step = _f32(360.0)
+        theta_start_local = theta_start
+        theta_max_local = theta_start
+
+    thetas = _accumulate(theta_start_local, theta_step, theta_max_local + theta_step / _f32(2.0))
+    thetas = thetas[thetas < theta_max_local + theta_step / _f32(2.0)]
+
+    if search_phi:
+        pole = (thetas == _f32(0.0)) | (thetas == _f32(180.0))
+        # math.sin of the float32 angle, as in cisTEM, rather than np.sin,
+        # whose vectorized implementation may differ in the last bit
+        sines = np.array([math.sin(_deg2rad(theta)) for theta in thetas], dtype=np.float64).astype(_f32)
+        with np.errstate(divide="ignore"):
+            phi_steps = np.abs(angular_step_size / np.where(pole, _f32(1.0), sines))
+        phi_steps = np.where(phi_steps > phi_max, phi_max, phi_steps)
+        phi_steps = phi_max / (phi_max / phi_steps + _f32(0.5)).astype(np.int64).astype(_f32)
+        phi_steps = np.where(pole, phi_max, phi_steps)
+        # The phi start of the poles is that of the row before them
+        row_starts = np.full(len(thetas), phi_start if for_mt else _f32(0.0), dtype=_f32)
+        if random_start_angle and not for_mt:
+            row_starts[~pole] = [phi_steps[i] / _f32(2.0) * _f32(_uniform_random()) for i in np.flatnonzero(~pole)]
+        last_row = np.maximum.accumulate(np.where(pole, -1, np.arange(len(thetas))))
+        phi_starts = np.where(last_row >= 0, row_starts[np.maximum(last_row, 0)], phi_start)
+    else:
+        phi_steps = np.full(len(thetas), _f32(360.0))
+        phi_starts = np.full(len(thetas), phi_start)
+
+    phis = _accumulate(_f32(0.0), phi_steps, phi_max)
+    in_range = phis < phi_max
+    positions = np.empty((int(in_range.sum()), 2), dtype=_f32)
+    positions[:, 0] = (phis + phi_starts.astype(_f32)[:, None])[in_range]
+    positions[:, 1] = np.broadcast_to(thetas[:, None], phis.shape)[in_range]
+    return positions
+
+
+@lru_cache(maxsize=128)
+def _cached_grid_positions(*args):
+    positions = _grid_positions(*args)
+    positions.flags.writeable = False
+    return positions
+
+
+SearchGrid = namedtuple("SearchGrid", ["phi", "theta", "psi"])
+
+
+@lru_cache(maxsize=128)
+def search_grid(symmetry_symbol, angular_step_size, psi_step=0.0, for_mt=False, theta_max=None, phi_start=0.0, theta_start=0.0, psi_start=0.0, psi_max=360.0):
+    """The orientations of a grid search, as read-only float32 arrays.
+
+    ``phi`` and ``theta`` are those of the search positions of
+    ``EulerSearch.InitGrid`` (without random start angles), ``theta_max``
+    overrides the limit of the symmetry, as match_template does for C
+    symmetries to include the mirror. ``psi`` are the in-plane angles from
+    ``psi_start`` up to ``psi_max`` in steps of ``psi_step``. Grids are
+    cached, so the same search is only computed once.
+    """
+    limits = EulerSearch()
+    limits.symmetry_symbol = symmetry_symbol
+    limits.SetSymmetryLimits()
+    if theta_max is None:
+        theta_max = limits.theta_max
+    positions = _cached_grid_positions(angular_step_size, limits.phi_max, theta_max, theta_start, phi_start, True, for_mt)
+    if psi_step <= 0:
+        psi = np.array([psi_start], dtype=_f32)
+    else:
+        psi = _accumulate(psi_start, psi_step, np.nextafter(_f32(psi_max), _f32(np.inf)))
+        psi = psi[psi <= _f32(psi_max)]
+    grid = SearchGrid(np.ascontiguousarray(positions[:, 0]), np.ascontiguousarray(positions[:, 1]), psi)
+    for angles in grid:
+        angles.flags.writeable = False
+    return grid
+
+
 def _uniform_random():
     # Only used when random_start_angle=True (not the case for
     # match_template.py's grid-counting usage of InitGrid), so an exact
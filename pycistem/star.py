@@ -0,0 +1,309 @@
+"""Reading and writing STAR files of large particle tables.
+
+The files look like those of ``starfile.write``, and are read like
+``starfile.read`` reads them, so that cisTEM, RELION and ``starfile`` work
+with them alike. Unlike ``starfile``:
+
+- :func:`read_star` reads only the ``columns`` asked for, and keeps the
+  table in a ``.npz`` file next to the STAR file. Reading the unchanged
+  file again loads the columns from there.
+- :func:`iter_star` reads a table in chunks.
+- :func:`write_star` and :class:`StarFileWriter` format all rows of a
+  chunk with a single ``%`` operation instead of value by value.
+"""
+import datetime
+import io
+import itertools
+import json
+import logging
+import mmap
+import os
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+FLOAT_FORMAT = "%.6f"
+NA_REP = "<NA>"
+CHUNK_SIZE = 100000
+# Bumped when the layout of the .npz files changes
+_CACHE_VERSION = 1
+
+
+def _quoted(column):
+    # Like starfile, strings with spaces and empty strings are put in quotes
+    if column.dtype != object and not pd.api.types.is_string_dtype(column):
+        return column
+    text = column.str
+    needs_quotes = (text.contains(" ", regex=False) | (text.len() == 0)).fillna(False).astype(bool)
+    if not needs_quotes.any():
+        return column
+    return column.mask(needs_quotes, '"' + column.astype(str) + '"')
+
+
+def _column_values(column, float_format):
+    # The conversion of a column and the values to format with it
+    missing = column.isna()
+    if not missing.any():
+        if column.dtype.kind == "f":
+            return float_format, column.tolist()
+        if column.dtype.kind in "iu":
+            return "%d", column.tolist()
+    values = column.tolist() if column.dtype.kind == "f" else _quoted(column).tolist()
+    if column.dtype.kind == "f":
+        values = [NA_REP if is_missing else float_format % value for value, is_missing in zip(values, missing.tolist())]
+    else:
+        values = [NA_REP if is_missing else value for value, is_missing in zip(values, missing.tolist())]
+    return "%s", values
+
+
+def format_rows(df, float_format=FLOAT_FORMAT):
+    """The rows of ``df`` as the lines of a STAR loop block."""
+    if len(df) == 0:
+        return ""
+    conversions, columns = zip(*(_column_values(df[name], float_format) for name in df.columns))
+    row = "\t".join(conversions) + "\n"
+    return (row * len(df)) % tuple(itertools.chain.from_iterable(zip(*columns)))
+
+
+class StarFileWriter:
+    """Writes a table to the loop block of a STAR file, a chunk at a time.
+
+    Only one chunk of the table has to be in memory::
+
+        with StarFileWriter("particles.star", columns) as star:
+            for chunk in chunks:
+                star.write(chunk)
+
+    The rows go to a temporary file, which replaces ``filename`` on
+    :meth:`close`. If the ``with`` block raises, the temporary file is
+    removed and ``filename`` is left as it was.
+    """
+
+    def __init__(self, filename, columns, block_name="", overwrite=True, float_format=FLOAT_FORMAT):
+        self.filename = Path(filename)
+        if self.filename.exists() and not overwrite:
+            msg = f"{self.filename} already exists"
+            raise FileExistsError(msg)
+        self.columns = list(columns)
+        self.float_format = float_format
+        self.rows = 0
+        self._temporary = self.filename.with_name(f"{self.filename.name}.{os.getpid()}.tmp")
+        self._file = open(self._temporary, "w")
+        now = datetime.datetime.now()
+        self._file.write(f"# Created by pycistem at {now:%H:%M:%S} on {now:%d/%m/%Y}\n\n\n")
+        self._file.write(f"data_{block_name}\n\nloop_\n")
+        self._file.write("".join(f"_{column} #{number}\n" for number, column in enumerate(self.columns, 1)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, df):
+        """Append the rows of ``df``, which needs all :attr:`columns`."""
+        self._file.write(format_rows(df[self.columns], self.float_format))
+        self.rows += len(df)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.write("\n\n")
+        self._file.close()
+        os.replace(self._temporary, self.filename)
+
+    def abort(self):
+        """Throw away the rows written so far."""
+        if self._file.closed:
+            return
+        self._file.close()
+        self._temporary.unlink(missing_ok=True)
+
+
+def write_star(df, filename, overwrite=True, block_name="", float_format=FLOAT_FORMAT, chunksize=CHUNK_SIZE):
+    """Write ``df`` to a STAR file, as ``starfile.write`` would."""
+    with StarFileWriter(filename, df.columns, block_name=block_name, overwrite=overwrite, float_format=float_format) as star:
+        for start in range(0, len(df), chunksize):
+            star.write(df.iloc[start:start + chunksize])
+
+
+class _LoopData(io.RawIOBase):
+    # The bytes of a loop block, with ' turned into " as starfile does, so
+    # that pandas takes both for quotes
+    def __init__(self, file, start, end):
+        self._file = file
+        self._file.seek(start)
+        self._remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._file.read(min(len(buffer), self._remaining)).replace(b"'", b'"')
+        self._remaining -= len(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def _loop_block(file, block):
+    # (column names, start, end) of the rows of the first loop block, or of
+    # data_{block}
+    names = None
+    block_name = None
+    in_loop = False
+    while True:
+        line = file.readline()
+        if not line:
+            if names is not None:
+                return names, file.tell(), file.tell()
+            msg = f"No loop block{'' if block is None else f' data_{block}'} in {file.name}"
+            raise ValueError(msg)
+        text = line.strip()
+        if names is not None and not text.startswith(b"_"):
+            start = file.tell() - len(line)
+            break
+        if text.startswith(b"data_"):
+            block_name = text[5:].decode()
+            in_loop = False
+        elif text.startswith(b"loop_"):
+            in_loop = block is None or block_name == block
+        elif in_loop and text.startswith(b"_"):
+            names = names or []
+            names.append(text.split()[0][1:].decode())
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        end = data.find(b"\ndata_", start)
+        end = len(data) if end < 0 else end + 1
+    return names, start, end
+
+
+def _check_columns(filename, columns, names):
+    missing = [column for column in columns or () if column not in names]
+    if missing:
+        msg = f"{filename} has no columns {', '.join(missing)}"
+        raise KeyError(msg)
+
+
+def _read_loop(filename, columns, block, chunksize):
+    file = open(filename, "rb")
+    try:
+        names, start, end = _loop_block(file, block)
+        _check_columns(filename, columns, names)
+    except BaseException:
+        file.close()
+        raise
+    usecols = None if columns is None else list(columns)
+    stream = io.TextIOWrapper(io.BufferedReader(_LoopData(file, start, end)), encoding="utf-8")
+    reader = pd.read_csv(
+        stream,
+        sep=r"\s+",
+        header=None,
+        names=names,
+        index_col=False,
+        usecols=usecols,
+        comment="#",
+        quotechar='"',
+        keep_default_na=False,
+        na_values=["nan", "NaN", NA_REP],
+        engine="c",
+        chunksize=chunksize,
+    )
+    if chunksize is None:
+        with stream:
+            return [reader[usecols or names]]
+
+    def chunks():
+        with stream, reader:
+            for chunk in reader:
+                yield chunk[usecols or names]
+
+    return chunks()
+
+
+def iter_star(filename, columns=None, block=None, chunksize=CHUNK_SIZE):
+    """The rows of the first loop block of a STAR file, or of ``data_{block}``, in DataFrames of ``chunksize`` rows.
+
+    ``columns`` names the columns to read, by default all.
+    """
+    yield from _read_loop(filename, columns, block, chunksize)
+
+
+def cache_filename(filename, block=None):
+    """The ``.npz`` file :func:`read_star` keeps the table of ``filename`` in."""
+    filename = Path(filename)
+    return filename.with_name(f"{filename.name}{'' if block is None else f'.{block}'}.npz")
+
+
+def _source(filename, block):
+    stat = os.stat(filename)
+    return {"version": _CACHE_VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "block": block}
+
+
+def _read_cache(filename, columns, block):
+    cache = cache_filename(filename, block)
+    if not cache.exists():
+        return None
+    try:
+        arrays = np.load(cache, allow_pickle=False)
+        metadata = json.loads(str(arrays["metadata"]))
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        log.debug(f"Could not read {cache}", exc_info=True)
+        return None
+    with arrays:
+        if metadata["source"] != _source(filename, block):
+            return None
+        keys = dict(zip(metadata["columns"], metadata["keys"]))
+        _check_columns(filename, columns, keys)
+        return pd.DataFrame({column: arrays[keys[column]] for column in columns or metadata["columns"]})
+
+
+def _write_cache(filename, df, block, source):
+    arrays = {}
+    for number, column in enumerate(df.columns):
+        values = df[column]
+        if isinstance(values.dtype, np.dtype) and values.dtype.kind in "biuf":
+            arrays[f"column_{number}"] = values.to_numpy()
+        elif all(isinstance(value, str) for value in values):
+            arrays[f"column_{number}"] = values.to_numpy(dtype=str)
+        else:
+            # Only str and numeric columns load without pickle
+            return
+    metadata = {"source": source, "columns": list(df.columns), "keys": list(arrays)}
+    cache = cache_filename(filename, block)
+    temporary = cache.with_name(f"{cache.name}.{os.getpid()}.tmp")
+    try:
+        with open(temporary, "wb") as file:
+            np.savez(file, metadata=np.array(json.dumps(metadata)), **arrays)
+        os.replace(temporary, cache)
+    except OSError:
+        log.debug(f"Could not write {cache}", exc_info=True)
+        temporary.unlink(missing_ok=True)
+
+
+def read_star(filename, columns=None, block=None, cache=True):
+    """The first loop block of a STAR file, or ``data_{block}``, as a DataFrame.
+
+    ``columns`` names the columns to read, by default all. With ``cache``,
+    the whole table is also written to :func:`cache_filename`, from where
+    the next read of the unchanged file loads it.
+    """
+    if cache:
+        df = _read_cache(filename, columns, block)
+        if df is not None:
+            return df
+        source = _source(filename, block)
+        df = _read_loop(filename, None, block, None)[0]
+        _write_cache(filename, df, block, source)
+        _check_columns(filename, columns, df.columns)
+        return df if columns is None else df[list(columns)]
+    return _read_loop(filename, columns, block, None)[0]
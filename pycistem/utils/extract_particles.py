@@ -7,11 +7,11 @@ def extract_particles(starfile_filename: Path, stack_filename: Path, box_size: i
         starfile_filename (str): The filename of the star file.
         box_size (int, optional): The size of the extracted particles. Defaults to 256.
     """
-    import starfile
+    from pycistem.star import read_star
     import mrcfile
     import numpy as np
     from itertools import groupby
-    particle_info = starfile.read(starfile_filename)
+    particle_info = read_star(starfile_filename, columns=["cisTEMOriginalImageFilename", "cisTEMOriginalXPosition", "cisTEMOriginalYPosition", "cisTEMPixelSize", "cisTEMPositionInStack"])
     mrc = mrcfile.new_mmap(stack_filename, (len(particle_info), box_size, box_size), mrc_mode=2, overwrite=True)
     # Iterate over groupby cisTEMOriginalImageFilename
 
@@ -4,7 +4,8 @@ import sqlite3
 import typer
 from pathlib import Path
 from typing_extensions import Annotated
-import starfile
+
+from pycistem.star import read_star, write_star
 
 app = typer.Typer()
 
@@ -22,13 +23,13 @@ def plot(database: Annotated[Path, typer.Argument(...,help="The database file to
     refinment_result = pd.read_sql_query(f"SELECT * FROM REFINEMENT_RESULT_{refinement_id}_{class_id}", db)
     refinment_package_info = pd.read_sql_query(f"SELECT * FROM REFINEMENT_PACKAGE_CONTAINED_PARTICLES_{refinment_info['REFINEMENT_PACKAGE_ASSET_ID']}", db)
     
-    starfile_info = starfile.read(input_star_file)
+    starfile_info = read_star(input_star_file)
 
     original_ids = refinment_package_info["ORIGINAL_PARTICLE_POSITION_ASSET_ID"].to_list()
     subset_starfile_info = starfile_info.iloc[original_ids].copy()
     subset_starfile_info["cisTEMOccupancy"] = refinment_result["OCCUPANCY"].to_list()
     subset_starfile_info["cisTEMScore"] = refinment_result["SCORE"].to_list()
-    starfile.write(subset_starfile_info, output_star_file)
+    write_star(subset_starfile_info, output_star_file)
 
 if __name__ == "__main__":
     app()
@@ -0,0 +1,51 @@
+import typer
+from pathlib import Path
+from typing import List, Optional
+from typing_extensions import Annotated
+import pandas as pd
+
+from pycistem.programs import match_template
+from pycistem.programs.match_template_planner import Throughput, compare_plans, plan_match_template
+from pycistem.pycore import RunProfileManager
+
+app = typer.Typer()
+
+
+@app.command()
+def plan(database: Annotated[Path, typer.Argument(...,help="The database file of the project")],
+        template: Annotated[Path, typer.Argument(...,help="The template to search with")],
+        throughput: Annotated[Optional[Path], typer.Option(help="JSON file with the throughput measured on a past run")] = None,
+        angular_step: Annotated[Optional[List[float]], typer.Option(help="Out-of-plane angular steps to compare")] = None,
+        in_plane_angular_step: Annotated[Optional[List[float]], typer.Option(help="In-plane angular steps to compare")] = None,
+        defocus_step: Annotated[Optional[List[float]], typer.Option(help="Defocus steps to compare")] = None,
+        defocus_search_range: Annotated[Optional[float], typer.Option(help="Defocus search range")] = None,
+        num_procs: Annotated[int, typer.Option(help="Number of workers, if no run profile is given")] = 1,
+        run_profile: Annotated[Optional[Path], typer.Option(help="File with cisTEM run profiles")] = None,
+        profile: Annotated[int, typer.Option(help="Number of the run profile in the file")] = 0,
+        jobs_per_image: Annotated[int, typer.Option(help="Jobs each image is split into")] = 1,
+        wall_time: Annotated[Optional[float], typer.Option(help="Target wall time in hours, to find the number of workers needed")] = None):
+    image_info = match_template.parameters_from_database(database, template.as_posix())
+    if len(image_info) == 0:
+        print("No images with CTF estimates in the database")
+        raise typer.Exit(1)
+    procs = num_procs
+    if run_profile is not None:
+        manager = RunProfileManager()
+        manager.ImportRunProfilesFromDisk(run_profile)
+        procs = manager.ReturnProfilePointer(profile)
+    measured = Throughput.load(throughput) if throughput is not None else None
+    search = {}
+    if defocus_search_range is not None:
+        search["defocus_search_range"] = defocus_search_range
+    table = compare_plans(image_info, angular_steps=angular_step or [None], in_plane_angular_steps=in_plane_angular_step or [None], defocus_steps=defocus_step or [None], num_procs=procs, throughput=measured, jobs_per_image=jobs_per_image, **search)
+    if wall_time is not None and measured is not None:
+        table["num_procs_for_wall_time"] = [
+            plan_match_template(image_info, num_procs=procs, throughput=measured, jobs_per_image=jobs_per_image, angular_step=row.angular_step, in_plane_angular_step=row.in_plane_angular_step, defocus_step=row.defocus_step, **search).num_procs_for(wall_time)
+            for row in table.itertuples()
+        ]
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(table)
+
+
+if __name__ == "__main__":
+    app()
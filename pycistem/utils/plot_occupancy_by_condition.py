@@ -1,7 +1,6 @@
 import pandas as pd
 from typing import Union
 import sqlite3
-import starfile
 import typer
 from pathlib import Path
 from typing_extensions import Annotated
@@ -9,6 +8,9 @@ from collections import defaultdict
 import matplotlib.pyplot as plt
 import numpy as np
 import matplotlib.colors as mcolors
+
+from pycistem.star import read_star
+
 app = typer.Typer()
 
 
@@ -31,7 +33,7 @@ def plot(database: Annotated[Path, typer.Argument(...,help="The database file to
         start_refinement: Annotated[int, typer.Argument(...,help="The refinement to start from")],
         starfile_filename: Annotated[Path, typer.Argument(...,help="The starfile to use")]):
     db = sqlite3.connect(database)
-    tmp = starfile.read(starfile_filename)
+    tmp = read_star(starfile_filename, columns=["cisTEMOriginalImageFilename"])
     counts_in_cond = defaultdict(defaultdict[lambda: 0])
     refinment_info = pd.read_sql_query(f"SELECT * FROM REFINEMENT_LIST WHERE REFINEMENT_ID = {start_refinement}", db)
     number_per_class = return_num_part_per_cond_with_occ_higher_than(refinment_info.iloc[0], db, 0.9, tmp)
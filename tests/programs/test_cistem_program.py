@@ -0,0 +1,348 @@
+import asyncio
+import threading
+import time
+from dataclasses import dataclass
+
+import mrcfile
+import numpy as np
+import pandas as pd
+
+from pycistem.programs._cistem_constants import socket_send_next_job, socket_time_to_die, socket_you_are_connected
+from pycistem.programs._metrics import DispatcherMetrics
+from pycistem.programs.cistem_program import JobFailure, JobScheduler, RunResults, SplitHandler, WorkerPool, default_job_cost
+from pycistem.programs.run_profile import Cluster
+
+
+@dataclass
+class _SearchParameters:
+    input_search_images_filename: str
+    first_search_position: int = 0
+    last_search_position: int = 9
+    defocus_search_range: float = 0.0
+    defocus_step: float = 0.0
+
+
+def _write_image(path, shape):
+    mrcfile.write(path, np.zeros(shape, dtype=np.float32), overwrite=True)
+    return str(path)
+
+
+def test_default_job_cost_uses_image_size_positions_and_defocus(tmp_path):
+    image = _write_image(tmp_path / "image.mrc", (20, 10))
+    par = _SearchParameters(image, last_search_position=4, defocus_search_range=1000.0, defocus_step=500.0)
+    assert default_job_cost(par) == 200 * 5 * 5
+
+
+def test_scheduler_hands_out_longest_job_first(tmp_path):
+    small = _write_image(tmp_path / "small.mrc", (8, 8))
+    large = _write_image(tmp_path / "large.mrc", (64, 64))
+    parameters = [_SearchParameters(small), _SearchParameters(small), _SearchParameters(large)]
+
+    scheduler = JobScheduler()
+    for i, par in enumerate(parameters):
+        scheduler.submit(i, par, b"")
+
+    assert [scheduler.pop()[0] for _ in range(len(scheduler))] == [2, 0, 1]
+
+
+def test_scheduler_without_cost_function_is_fifo():
+    scheduler = JobScheduler(cost_function=None)
+    for i in range(5):
+        scheduler.submit(i, None, bytes([i]))
+
+    assert [scheduler.pop() for _ in range(len(scheduler))] == [(i, bytes([i])) for i in range(5)]
+
+
+def test_scheduler_custom_cost_function():
+    scheduler = JobScheduler(cost_function=lambda par: par)
+    for i, cost in enumerate([1.0, 5.0, 3.0]):
+        scheduler.submit(i, cost, b"")
+
+    assert [scheduler.pop()[0] for _ in range(len(scheduler))] == [1, 2, 0]
+
+
+async def _leader_worker(port, die_on_job=False):
+    # Minimal worker side of the leader protocol: answers every job with its
+    # parameter buffer length as the result, or drops the connection.
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    assert await reader.readexactly(16) == socket_you_are_connected
+    writer.write(socket_send_next_job + bytes(8))
+    await writer.drain()
+    while True:
+        signal = await reader.readexactly(16)
+        if signal == socket_time_to_die:
+            writer.close()
+            return
+        length = int.from_bytes(await reader.readexactly(8), "little")
+        await reader.readexactly(length)
+        if die_on_job:
+            writer.close()
+            return
+        writer.write(socket_send_next_job + length.to_bytes(8, "little"))
+        await writer.drain()
+
+
+async def _read_result(reader, writer, logger):
+    return await reader.readexactly(8)
+
+
+@dataclass
+class _Job:
+    value: int
+
+
+async def _run_in_pool(workers, batches, **run_kwargs):
+    # Runs each list of jobs in batches through one pool served by
+    # in-process workers connected straight to the leader
+    pool = WorkerPool("fake")
+    await pool.start_servers()
+    worker_tasks = [asyncio.ensure_future(_leader_worker(pool.port_leader, die_on_job=die)) for die in workers]
+    results = []
+    for jobs in batches:
+        results.append(
+            await pool.run(jobs, signal_handlers={socket_send_next_job: _read_result}, cost_function=None, **run_kwargs)
+        )
+    await pool.close()
+    await asyncio.gather(*worker_tasks)
+    return results
+
+
+def test_jobs_of_dead_worker_are_requeued():
+    (results,) = asyncio.run(_run_in_pool([True, False], [[_Job(i) for i in range(5)]]))
+    assert sorted(index for index, _result in results) == list(range(5))
+    assert results.failures == []
+
+
+def test_job_fails_after_retry_budget():
+    (results,) = asyncio.run(_run_in_pool([True, True], [[_Job(0)]], max_retries=1))
+    assert list(results) == []
+    assert results.failures == [JobFailure(0, 2, results.failures[0].reason)]
+    assert "disconnected" in results.failures[0].reason
+
+
+def test_decoded_results_keep_the_failures():
+    results = RunResults([(0, b"result")], [JobFailure(1, 3, "worker disconnected")], startup_latency=0.5)
+
+    decoded = results.with_results([{"parameter_index": 0}])
+    assert decoded == [{"parameter_index": 0}]
+    assert decoded.failures == results.failures
+    assert decoded.startup_latency == 0.5
+
+    df = results.attach_to(pd.DataFrame({"parameter_index": [0]}))
+    assert df.attrs["failures"] == [JobFailure(1, 3, "worker disconnected")]
+    assert df.attrs["startup_latency"] == 0.5
+
+
+def test_pool_reuses_workers_between_runs():
+    first, second = asyncio.run(_run_in_pool([False], [[_Job(i) for i in range(3)], [_Job(7)]]))
+    assert sorted(index for index, _result in first) == [0, 1, 2]
+    assert [index for index, _result in second] == [0]
+
+
+def test_run_iter_yields_each_result():
+    async def main():
+        pool = WorkerPool("fake")
+        await pool.start_servers()
+        workers = [asyncio.ensure_future(_leader_worker(pool.port_leader)) for _ in range(2)]
+        failures = []
+        streamed = []
+        async for item in pool.run_iter(
+            [_Job(i) for i in range(4)], signal_handlers={socket_send_next_job: _read_result}, failures=failures
+        ):
+            streamed.append(item)
+        await pool.close()
+        await asyncio.gather(*workers)
+        return streamed, failures
+
+    streamed, failures = asyncio.run(main())
+    assert sorted(index for index, _result in streamed) == [0, 1, 2, 3]
+    assert failures == []
+
+
+async def _pump(pool, command):
+    process = await asyncio.create_subprocess_shell(
+        command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+    )
+    await pool._pump_output(0, process)
+    await process.wait()
+
+
+def test_worker_output_is_passed_to_sink_line_by_line():
+    lines = []
+    pool = WorkerPool("fake", output_sink=lambda i, line: lines.append((i, line)))
+    asyncio.run(_pump(pool, "echo first; echo second 1>&2"))
+    assert lines == [(0, "first"), (0, "second")]
+
+
+def test_saved_worker_output_is_rotated(tmp_path):
+    pool = WorkerPool("fake", save_output=True, save_output_path=str(tmp_path / "worker"), max_log_bytes=100, log_backup_count=2)
+    asyncio.run(_pump(pool, "for i in $(seq 100); do echo line $i; done"))
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["worker_0.txt", "worker_0.txt.1", "worker_0.txt.2"]
+    assert (tmp_path / "worker_0.txt").read_text().splitlines()[-1] == "line 100"
+
+
+def test_run_profile_commands_are_expanded_with_their_delays():
+    from pycistem.pycore import RunProfile
+
+    profile = RunProfile()
+    profile.AddCommand("ssh node1 $command", 2, 4, False, 0, 500)
+    profile.AddCommand("ssh node2 $command", 1, 8, True, 3, 0)
+    pool = WorkerPool("match_template", num_procs=profile)
+    pool.port_manager = 3001
+    pool.identity = "x" * 16
+
+    commands = pool._worker_commands()
+
+    assert [delay for _command, delay in commands] == [0.5, 0.5, 0.0, 0.0, 0.0]
+    assert commands[0][0].startswith("ssh node1 ") and commands[0][0].endswith(" 4")
+    identity = commands[0][0].split()[-2]
+    assert commands[0][0].split()[-3] == "3001"
+    assert pool.slot_identities[identity].name == "node1/0"
+    assert commands[2][0].startswith("ssh node2 ") and commands[2][0].endswith(" 8")
+    assert profile.run_commands[0].command_to_run == "ssh node1 $command"
+
+
+def test_workers_are_launched_without_blocking_the_loop():
+    async def launch():
+        pool = WorkerPool("match_template", num_procs=3, cmd_prefix="echo ", sleep_time=0.3)
+        await pool.start_servers()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await pool.launch_workers()
+        launched = loop.time() - start
+        await asyncio.gather(*pool._watchers)
+        total = loop.time() - start
+        await pool.close()
+        return launched, total
+
+    launched, total = asyncio.run(launch())
+    assert launched < 0.1
+    assert total >= 0.6
+
+
+def test_metrics_track_jobs_bytes_and_utilization():
+    now = [0.0]
+    metrics = DispatcherMetrics(clock=lambda: now[0])
+    metrics.worker_connected("w1")
+    metrics.job_dispatched("w1")
+    now[0] = 3.0
+    metrics.handler_finished(0.5, 128)
+    metrics.job_completed("w1")
+    metrics.job_dispatched("w1")
+    metrics.job_failed("w1", requeued=True)
+    now[0] = 6.0
+
+    snapshot = metrics.snapshot()
+    assert snapshot["jobs_dispatched"] == 2
+    assert snapshot["jobs_completed"] == 1
+    assert snapshot["jobs_requeued"] == 1
+    assert snapshot["result_bytes"] == 128
+    assert snapshot["job_latency_seconds"]["count"] == 1
+    assert snapshot["workers"]["w1"]["utilization"] == 0.5
+    text = metrics.to_prometheus()
+    assert 'pycistem_job_latency_seconds_bucket{le="5.0"} 1' in text
+    assert 'pycistem_worker_busy_seconds_total{worker="w1"} 3.0' in text
+
+
+def test_pool_serves_metrics_over_http():
+    async def main():
+        pool = WorkerPool("fake", metrics_port=0)
+        await pool.start_servers()
+        worker = asyncio.ensure_future(_leader_worker(pool.port_leader))
+        await pool.run([_Job(i) for i in range(4)], signal_handlers={socket_send_next_job: _read_result})
+        port = pool._servers[-1].sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = (await reader.read()).decode()
+        writer.close()
+        await pool.close()
+        await worker
+        return response, pool.metrics.snapshot()
+
+    response, snapshot = asyncio.run(main())
+    assert response.startswith("HTTP/1.1 200 OK")
+    assert "pycistem_jobs_completed_total 4" in response
+    assert snapshot["jobs_queued"] == 0
+    assert snapshot["result_bytes"] == 4 * 8
+    (worker,) = snapshot["workers"].values()
+    assert worker["jobs"] == 4 and not worker["connected"]
+
+
+def test_slower_slots_get_cheaper_jobs():
+    scheduler = JobScheduler(cost_function=lambda par: par)
+    for i, cost in enumerate([10.0, 8.0, 4.0, 2.0, 1.0]):
+        scheduler.submit(i, cost, b"")
+
+    assert scheduler.pop(speed=0.5)[0] == 2
+    assert scheduler.pop(speed=1.0)[0] == 0
+    assert scheduler.pop(speed=0.1)[0] == 4
+
+
+def test_slots_only_get_jobs_that_fit_their_memory():
+    scheduler = JobScheduler(cost_function=lambda par: par[0], memory_function=lambda par: par[1])
+    for i, par in enumerate([(10.0, 32.0), (5.0, 8.0), (1.0, 4.0)]):
+        scheduler.submit(i, par, b"")
+
+    assert not scheduler.has_job(memory=2.0)
+    assert scheduler.pop(memory=16.0)[0] == 1
+    assert scheduler.remove_larger_than(16.0) == [0]
+    assert scheduler.pop(memory=16.0)[0] == 2
+
+
+def test_jobs_of_different_memory_are_handed_out_in_cost_order():
+    scheduler = JobScheduler(cost_function=lambda par: par[0], memory_function=lambda par: par[1])
+    for i, par in enumerate([(3.0, 4.0), (5.0, 8.0), (3.0, 8.0), (1.0, 4.0), (5.0, 32.0)]):
+        scheduler.submit(i, par, b"")
+    index, buffer = scheduler.pop(memory=16.0)
+    scheduler.requeue(index, buffer)
+
+    assert len(scheduler) == 5
+    assert [scheduler.pop(memory=16.0)[0] for _ in range(4)] == [1, 0, 2, 3]
+    assert not scheduler.has_job(memory=16.0)
+    assert scheduler.has_job()
+    assert scheduler.pop(speed=0.1)[0] == 4
+    assert len(scheduler) == 0
+def test_cluster_from_host_gpu_info_and_run_profile():
+    cluster = Cluster.from_host_gpu_info({"kyiv": 2, "warsaw": 1}, speed={"warsaw": 2.0}, memory={"kyiv": 24})
+    assert [slot.name for slot in cluster.slots] == ["kyiv/0", "kyiv/1", "warsaw/0"]
+    assert cluster.slots[1].command == 'ssh kyiv "CUDA_VISIBLE_DEVICES=1 $command"'
+    assert cluster.max_speed == 2.0
+    assert cluster.max_memory is None
+
+    again = Cluster.from_run_profile(cluster.to_run_profile(), speed=[1.0, 1.0, 2.0])
+    assert [(slot.name, slot.command, slot.speed) for slot in again.slots] == [(slot.name, slot.command, slot.speed) for slot in cluster.slots]
+
+
+def test_split_handlers_process_results_in_executor_with_backpressure():
+    lock = threading.Lock()
+    running = [0, 0]
+    calls = []
+
+    def process(payload):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+            calls.append(payload)
+            call = len(calls)
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        if call == 1:
+            raise ValueError("bad result")
+        return threading.current_thread().name
+
+    async def main():
+        pool = WorkerPool("fake", max_pending_results=2)
+        await pool.start_servers()
+        workers = [asyncio.ensure_future(_leader_worker(pool.port_leader)) for _ in range(4)]
+        handlers = {socket_send_next_job: SplitHandler(_read_result, process)}
+        results = await pool.run([_Job(i) for i in range(12)], signal_handlers=handlers, cost_function=None)
+        await pool.close()
+        await asyncio.gather(*workers)
+        return results
+
+    results = asyncio.run(main())
+    assert len(results) == 11
+    assert "bad result" in results.failures[0].reason
+    assert all(name != threading.main_thread().name for _index, name in results)
+    assert running[1] <= 2
@@ -0,0 +1,83 @@
+import struct
+from dataclasses import astuple, dataclass, fields, is_dataclass
+
+import pandas as pd
+import pytest
+
+from pycistem.programs import apply_ctf, ctffind, estimate_beamtilt, match_template, reconstruct3d, refine_ctf, refine_template, resample, unblur
+from pycistem.programs._codecs import codec_for
+
+
+def _reference_encode(parameters):
+    # The per-field encoder the codecs replaced
+    buffer = b""
+    buffer += int(1).to_bytes(4,"little")
+    buffer += len(fields(parameters)).to_bytes(4,"little")
+    parameterstuple = astuple(parameters)
+    for i,argument in enumerate(fields(parameters)):
+        if argument.type == float:
+            buffer += int(3).to_bytes(1,"little")
+            buffer += struct.pack("<f", parameterstuple[i])
+        if argument.type == bool:
+            buffer += int(4).to_bytes(1,"little")
+            buffer += parameterstuple[i].to_bytes(1,"little")
+        if argument.type == str:
+            buffer += int(1).to_bytes(1,"little")
+            bb = parameterstuple[i].encode("utf-8")
+            buffer += len(bb).to_bytes(4,"little")
+            buffer += bb
+        if argument.type == int:
+            buffer += int(2).to_bytes(1,"little")
+            buffer += struct.pack("<i", parameterstuple[i])
+    return buffer
+
+
+def _parameter_classes():
+    modules = [apply_ctf, ctffind, estimate_beamtilt, match_template, reconstruct3d, refine_ctf, refine_template, resample, unblur]
+    return [
+        cls for module in modules for name, cls in vars(module).items()
+        if name.endswith("Parameters") and is_dataclass(cls) and cls.__module__ == module.__name__
+    ]
+
+
+def _example(cls, i=0):
+    values = {}
+    for field in fields(cls):
+        if field.type == str:
+            values[field.name] = f"{field.name}_{i}_ü.mrc"
+        elif field.type == bool:
+            values[field.name] = bool(i % 2)
+        elif field.type == int:
+            values[field.name] = -3 + i
+        else:
+            values[field.name] = 0.1 * (i + 1)
+    return cls(**values)
+
+
+@pytest.mark.parametrize("cls", _parameter_classes(), ids=lambda cls: cls.__name__)
+def test_codec_matches_reference_encoder(cls):
+    for i in range(3):
+        parameters = _example(cls, i)
+        assert codec_for(cls).encode(parameters) == _reference_encode(parameters)
+
+
+@pytest.mark.parametrize("cls", _parameter_classes(), ids=lambda cls: cls.__name__)
+def test_encode_columns_matches_per_object_encoding(cls):
+    rows = [_example(cls, i) for i in range(5)]
+    table = pd.DataFrame([{field.name: getattr(row, field.name) for field in fields(cls)} for row in rows])
+    assert codec_for(cls).encode_columns(table) == [_reference_encode(row) for row in rows]
+
+
+def test_encode_columns_fills_in_defaults():
+    table = {"input_filename": ["a.mrc", "b.mrc"], "box_size": [256, 128]}
+    expected = [ctffind.CtffindParameters(input_filename="a.mrc", box_size=256), ctffind.CtffindParameters(input_filename="b.mrc", box_size=128)]
+    assert codec_for(ctffind.CtffindParameters).encode_columns(table) == [_reference_encode(par) for par in expected]
+
+
+def test_unsupported_field_type_is_rejected():
+    @dataclass
+    class _Parameters:
+        values: list
+
+    with pytest.raises(TypeError):
+        codec_for(_Parameters)
@@ -0,0 +1,171 @@
+import asyncio
+import struct
+from dataclasses import fields
+import sys
+
+from pycistem.programs import cistem_program, ctffind, reconstruct3d
+from pycistem.programs._cistem_constants import socket_i_have_info, socket_job_result_queue, socket_program_defined_result
+from pycistem.programs.cistem_program import _encode_parameters
+from pycistem.programs.fake_worker import decode_arguments
+from pycistem.programs.run_profile import Cluster
+
+FAKE_WORKER = f"{sys.executable} -m pycistem.programs.fake_worker "
+
+
+def test_decode_arguments_inverts_encoding():
+    parameters = ctffind.CtffindParameters(input_filename="movie.mrc", pixel_size_of_input_image=1.5, number_of_frames_to_average=7)
+    arguments = decode_arguments(_encode_parameters(parameters))
+    assert arguments[0] == "movie.mrc"
+    assert arguments[2] == 7
+    assert arguments[4] == 1.5
+    assert len(arguments) == len(fields(parameters))
+
+
+def test_ctffind_results_from_fake_workers():
+    parameters = [ctffind.CtffindParameters(input_filename=f"{i}.mrc") for i in range(6)]
+    results = asyncio.run(
+        cistem_program.run("ctffind", parameters, signal_handlers=ctffind.signal_handlers, num_procs=2, sleep_time=0.0, cmd_prefix=FAKE_WORKER + "--payload-floats 3 ")
+    )
+    assert sorted(index for index, _result in results) == list(range(6))
+    assert all(struct.unpack("<3f", result) == (0.0, 1.0, 2.0) for _index, result in results)
+    assert results.failures == []
+
+
+def test_program_defined_results_with_queue_and_info_messages():
+    seen = []
+
+    async def handle_result(reader, writer, logger):
+        size, result_number, _expected = struct.unpack("<iii", await reader.readexactly(12))
+        await reader.readexactly(size * 4)
+        return result_number
+
+    async def handle_message(reader, writer, logger):
+        length = int.from_bytes(await reader.readexactly(4), "little")
+        seen.append(await reader.readexactly(length))
+
+    handlers = {
+        socket_program_defined_result: handle_result,
+        socket_job_result_queue: handle_message,
+        socket_i_have_info: handle_message,
+    }
+    parameters = [ctffind.CtffindParameters(input_filename=f"{i}.mrc", number_of_frames_to_average=10 + i) for i in range(4)]
+    prefix = FAKE_WORKER + "--result-signal program_defined --result-number-argument 2 --payload-floats 5 --queue-results --send-info "
+    results = asyncio.run(cistem_program.run("ctffind", parameters, signal_handlers=handlers, num_procs=2, sleep_time=0.0, cmd_prefix=prefix))
+    assert sorted(results) == [(i, 10 + i) for i in range(4)]
+    assert len(seen) == 8
+
+
+def test_crashing_fake_workers_are_reported():
+    parameters = [ctffind.CtffindParameters(input_filename=f"{i}.mrc") for i in range(3)]
+    results = asyncio.run(
+        cistem_program.run("ctffind", parameters, signal_handlers=ctffind.signal_handlers, num_procs=1, sleep_time=0.0, cmd_prefix=FAKE_WORKER + "--crash-after 1 ")
+    )
+    assert len(results) == 1
+    assert len(results.failures) == 2
+
+
+def test_program_wrappers_report_failed_jobs():
+    parameters = [ctffind.CtffindParameters(input_filename=f"{i}.mrc") for i in range(3)]
+    results = ctffind.run(parameters, num_procs=1, sleep_time=0.0, cmd_prefix=FAKE_WORKER + "--payload-floats 11 --crash-after 1 ")
+    assert len(results) == 1
+    assert results[0]["defocus2"] == 1.0
+    assert len(results.failures) == 2
+    assert results.startup_latency is not None
+    assert {failure.parameter_index for failure in results.failures} | {results[0]["parameter_index"]} == {0, 1, 2}
+
+
+def test_programs_without_decoded_results_report_failed_jobs():
+    parameters = [reconstruct3d.Reconstruct3dParameters(f"{i}.mrc", f"{i}.star") for i in range(3)]
+    results = reconstruct3d.run(parameters, num_procs=1, sleep_time=0.0, cmd_prefix=FAKE_WORKER + "--payload-floats 2 --crash-after 1 ")
+    assert len(results) == 1
+    assert len(results.failures) == 2
+
+
+def test_unexpected_signals_fail_the_job():
+    # ctffind has no handler for program defined results
+    parameters = [ctffind.CtffindParameters(input_filename=f"{i}.mrc") for i in range(2)]
+    results = asyncio.run(
+        cistem_program.run("ctffind", parameters, signal_handlers=ctffind.signal_handlers, num_procs=1, sleep_time=0.0, max_retries=0, cmd_prefix=FAKE_WORKER + "--result-signal program_defined ")
+    )
+    assert len(results) == 0
+    assert sorted(failure.parameter_index for failure in results.failures) == [0, 1]
+    assert any("unexpected signal" in failure.reason for failure in results.failures)
+def test_cluster_slots_get_jobs_by_memory_and_speed():
+    # Two simulated hosts: a fast one with little memory and a slow one
+    # with plenty. The large jobs can only run on the slow one.
+    cluster = Cluster.local(speed=[1.0, 0.5], memory=[8.0, 32.0], command=FAKE_WORKER + "--speed {speed} --duration 0.01 --duration-argument 2 $command")
+    parameters = [ctffind.CtffindParameters(input_filename=f"{i}.mrc", number_of_frames_to_average=i % 4 + 1) for i in range(12)]
+    scheduler = cistem_program.JobScheduler(
+        cost_function=lambda par: par.number_of_frames_to_average,
+        memory_function=lambda par: 16.0 if par.number_of_frames_to_average == 4 else 1.0,
+    )
+
+    async def main():
+        async with cistem_program.WorkerPool("ctffind", num_procs=cluster) as pool:
+            results = await pool.run(parameters, signal_handlers=ctffind.signal_handlers, scheduler=scheduler)
+            return results, pool.metrics.snapshot()
+
+    results, metrics = asyncio.run(main())
+    assert sorted(index for index, _result in results) == list(range(12))
+    assert set(metrics["workers"]) == {"localhost/0", "localhost/1"}
+    assert metrics["workers"]["localhost/1"]["jobs"] >= 3
+
+
+def test_jobs_larger_than_every_slot_fail():
+    cluster = Cluster.local(speed=[1.0], memory=[8.0], command=FAKE_WORKER + "$command")
+    parameters = [ctffind.CtffindParameters(input_filename=f"{i}.mrc") for i in range(2)]
+    scheduler = cistem_program.JobScheduler(memory_function=lambda par: 16.0 if par.input_filename == "1.mrc" else 1.0)
+    results = asyncio.run(cistem_program.run("ctffind", parameters, signal_handlers=ctffind.signal_handlers, num_procs=cluster, scheduler=scheduler))
+    assert [index for index, _result in results] == [0]
+    assert [failure.parameter_index for failure in results.failures] == [1]
+
+
+def test_resume_replays_journaled_results(tmp_path):
+    journal = tmp_path / "run.journal"
+    parameters = [ctffind.CtffindParameters(input_filename=f"{i}.mrc") for i in range(4)]
+    kwargs = {"signal_handlers": ctffind.signal_handlers, "sleep_time": 0.0, "cmd_prefix": FAKE_WORKER + "--payload-floats 2 "}
+
+    # The first run dies after two jobs, leaving the others unfinished
+    first = asyncio.run(cistem_program.run("ctffind", parameters, journal=journal, max_retries=0, **{**kwargs, "cmd_prefix": kwargs["cmd_prefix"] + "--crash-after 2 "}))
+    assert len(first) == 2
+
+    # One parameter set changed since, so its stored result must not be used
+    done = {index for index, _result in first}
+    changed = min(done)
+    parameters[changed] = ctffind.CtffindParameters(input_filename="other.mrc")
+    second = asyncio.run(cistem_program.run("ctffind", parameters, resume=journal, cmd_prefix=kwargs["cmd_prefix"] + "--crash-after 3 ", signal_handlers=ctffind.signal_handlers, sleep_time=0.0))
+
+    assert sorted(index for index, _result in second) == [0, 1, 2, 3]
+    assert second.failures == []
+    assert dict(second)[max(done)] == dict(first)[max(done)]
+
+    replay = asyncio.run(cistem_program.run("ctffind", parameters, resume=journal, cmd_prefix=kwargs["cmd_prefix"] + "--crash-after 0 ", signal_handlers=ctffind.signal_handlers, sleep_time=0.0))
+    assert sorted(replay) == sorted(second)
+
+
+def test_pools_of_two_programs_share_a_dispatcher():
+    async def handle_result(reader, writer, logger):
+        size, result_number, _expected = struct.unpack("<iii", await reader.readexactly(12))
+        await reader.readexactly(size * 4)
+        return result_number
+
+    ctffind_parameters = [ctffind.CtffindParameters(input_filename=f"{i}.mrc") for i in range(6)]
+    other_parameters = [ctffind.CtffindParameters(input_filename=f"{i}.mrc", number_of_frames_to_average=10 + i) for i in range(6)]
+
+    async def main():
+        async with cistem_program.Dispatcher() as dispatcher:
+            ctffind_pool = cistem_program.WorkerPool("ctffind", num_procs=2, sleep_time=0.0, cmd_prefix=FAKE_WORKER + "--duration 0.02 --payload-floats 3 ", dispatcher=dispatcher)
+            other_pool = cistem_program.WorkerPool("match_template_gpu", num_procs=2, sleep_time=0.0, cmd_prefix=FAKE_WORKER + "--duration 0.02 --result-signal program_defined --result-number-argument 2 --payload-floats 5 ", dispatcher=dispatcher)
+            async with ctffind_pool, other_pool:
+                assert ctffind_pool.port_leader == other_pool.port_leader == dispatcher.port_leader
+                results = await asyncio.gather(
+                    ctffind_pool.run(ctffind_parameters, signal_handlers=ctffind.signal_handlers),
+                    cistem_program.run("match_template_gpu", other_parameters, signal_handlers={socket_program_defined_result: handle_result}, pool=other_pool),
+                )
+            assert dispatcher.pools == []
+            return results
+
+    ctffind_results, other_results = asyncio.run(main())
+    assert sorted(index for index, _result in ctffind_results) == list(range(6))
+    assert all(struct.unpack("<3f", result) == (0.0, 1.0, 2.0) for _index, result in ctffind_results)
+    assert sorted(other_results) == [(i, 10 + i) for i in range(6)]
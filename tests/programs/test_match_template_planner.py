@@ -0,0 +1,94 @@
+from dataclasses import replace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pycistem.programs import match_template
+from pycistem.programs import match_template_planner as planner
+from pycistem.programs.run_profile import Cluster
+
+
+def _image_info(sizes):
+    parameters = [match_template.MatchTemplateParameters(f"image_{i}.mrc", "template.mrc", defocus_search_range=0.0) for i in range(len(sizes))]
+    return pd.DataFrame({"X_SIZE": [x for x, _ in sizes], "Y_SIZE": [y for _, y in sizes], "PARAMETERS": parameters})
+
+
+def _units(par, pixels):
+    par = replace(par, angular_step=10.0)
+    return planner.search_units(par, pixels, planner.search_positions(par))
+
+
+def test_units_match_the_search_positions_of_prepared_parameters():
+    par = match_template.MatchTemplateParameters("image.mrc", "template.mrc", angular_step=10.0)
+    parameters, _jobs, _handlers = match_template._prepare([par], False, None)
+
+    positions = planner.search_positions(par)
+
+    assert positions == parameters[0].last_search_position + 1
+    assert planner.search_units(par, 100 * 200) == 100 * 200 * positions * 180 * 11
+
+
+def test_plan_uses_database_image_sizes_and_throughput():
+    image_info = _image_info([(100, 100), (200, 100), (100, 100)])
+    throughput = planner.Throughput(_units(image_info["PARAMETERS"][0], 100 * 100))
+
+    plan = planner.plan_match_template(image_info, num_procs=2, throughput=throughput, angular_step=10.0, template_box=64)
+
+    assert plan.jobs["seconds"].tolist() == pytest.approx([1.0, 2.0, 1.0])
+    assert plan.worker_hours == pytest.approx(4.0 / 3600)
+    # The 2 s image on one slot, both 1 s images on the other
+    assert plan.wall_time_hours == pytest.approx(2.0 / 3600)
+    assert plan.peak_memory_gb > 0
+    assert all(par.angular_step == 10.0 for par in plan.parameters["PARAMETERS"])
+    assert all(par.angular_step == 3.0 for par in image_info["PARAMETERS"])
+
+
+def test_wall_time_respects_speed_delay_and_memory():
+    cluster = Cluster().add_host("fast", 1, speed=2.0, memory=4.0).add_host("slow", 1, speed=1.0, memory=1.0)
+
+    wall_time, unplaceable = planner.simulate_wall_time([4.0, 1.0, 1.0, 1.0], cluster, job_memory=[2.0, 0.5, 0.5, 8.0])
+
+    # The large job needs the fast slot (2 s), the slow slot takes the small ones
+    assert wall_time == pytest.approx(2.0)
+    assert unplaceable == [3]
+
+    delayed = Cluster().add_host("a", 2, delay_time_in_ms=500)
+    assert planner.simulate_wall_time([1.0, 1.0], delayed)[0] == pytest.approx(1.5)
+
+
+def test_num_procs_for_and_run_kwargs():
+    image_info = _image_info([(100, 100)] * 8)
+    throughput = planner.Throughput(_units(image_info["PARAMETERS"][0], 100 * 100) / 3600)
+    plan = planner.plan_match_template(image_info, num_procs=1, throughput=throughput, jobs_per_image=2, angular_step=10.0, template_box=64)
+
+    assert plan.wall_time_hours == pytest.approx(8.0)
+    assert plan.num_procs_for(2.0) == 4
+    assert plan.num_procs_for(0.1, max_procs=8) is None
+
+    kwargs = plan.run_kwargs()
+    assert kwargs["num_procs"] == 1
+    assert kwargs["jobs_per_image"] == 2
+    assert kwargs["scheduler"].memory_function(plan.parameters["PARAMETERS"][0]) == pytest.approx(plan.peak_memory_gb)
+
+
+def test_compare_plans_and_throughput_round_trip(tmp_path):
+    image_info = _image_info([(100, 100)])
+    throughput = planner.Throughput(1e9)
+    throughput.save(tmp_path / "throughput.json")
+    assert planner.Throughput.load(tmp_path / "throughput.json") == throughput
+
+    table = planner.compare_plans(image_info, angular_steps=[5.0, 10.0], in_plane_angular_steps=[1.5, 3.0], throughput=throughput, template_box=64)
+
+    assert table[["angular_step", "in_plane_angular_step"]].values.tolist() == [[5.0, 1.5], [5.0, 3.0], [10.0, 1.5], [10.0, 3.0]]
+    assert np.all(np.diff(table["worker_hours"].to_numpy()[[0, 2]]) < 0)
+    assert table["units"][0] == pytest.approx(2 * table["units"][1])
+
+
+def test_throughput_from_metrics():
+    par = match_template.MatchTemplateParameters("image.mrc", "template.mrc", first_search_position=0, last_search_position=9, defocus_search_range=0.0)
+    metrics = {"workers": {"a": {"busy_seconds": 3.0}, "b": {"busy_seconds": 1.0}}}
+
+    throughput = planner.Throughput.from_metrics([par], metrics, image_sizes=[400])
+
+    assert throughput.units_per_second == pytest.approx(400 * 10 * 180 / 4.0)
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import struct
+from functools import partial
+
+import mrcfile
+import numpy as np
+import pandas as pd
+import pytest
+
+from pycistem.programs import cistem_program, match_template
+from pycistem.programs._receive import BufferPool, readinto
+from pycistem.programs.cistem_program import JobFailure
+from pycistem.programs.results_store import ResultsStore
+
+
+def _result_payload(x_dim, y_dim, padded_x, num_ccs, rng):
+    num_pixels = y_dim * padded_x
+    planes = rng.random((8, y_dim, padded_x), dtype=np.float32)
+    planes[6] = (planes[6] - 0.5) * num_ccs * 0.1
+    planes[7] = (1 + planes[7]) * num_ccs + planes[6] ** 2 / num_ccs
+    planes[0, 60, 70] = 50.0
+    header = np.array([x_dim, y_dim, num_pixels, num_ccs, 512, 0, 0], dtype=np.float32)
+    histogram = rng.integers(0, 1000, 512).astype(np.int64)
+    payload = header.tobytes() + planes.tobytes() + histogram.tobytes()
+    return payload, planes[:, :, :x_dim].copy()
+
+
+def _stream(data):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+def test_readinto_fills_buffer_in_chunks():
+    data = bytes(range(256)) * 10000
+
+    async def main():
+        buffer = bytearray(len(data))
+        await readinto(_stream(data), buffer)
+        return buffer
+
+    assert asyncio.run(main()) == data
+
+
+def test_buffer_pool_reuses_released_buffers(tmp_path):
+    for pool in (BufferPool(), BufferPool(directory=tmp_path)):
+        with pool.borrow(1000) as first:
+            first[:] = 1
+        with pool.borrow(500) as second:
+            assert len(second) == 500
+            assert np.shares_memory(first, second)
+
+
+def test_handle_results_uses_views_of_the_received_planes(tmp_path):
+    rng = np.random.default_rng(0)
+    x_dim, y_dim, num_ccs = 128, 120, 1000.0
+    payload, planes = _result_payload(x_dim, y_dim, x_dim + 2, num_ccs, rng)
+    par = match_template.MatchTemplateParameters(
+        input_search_images_filename="image.mrc",
+        input_reconstruction_filename="template.mrc",
+        mip_output_file=str(tmp_path / "mip.mrc"),
+        scaled_mip_output_file=str(tmp_path / "scaled_mip.mrc"),
+        output_histogram_file=str(tmp_path / "histogram.txt"),
+    )
+    message = struct.pack("<iii", len(payload) // 4, 0, 1) + payload
+
+    async def main():
+        return await match_template.handle_results(_stream(message), None, logging.getLogger(__name__), [par], False, None)
+
+    result = asyncio.run(main())
+
+    mean = planes[6] / np.float32(num_ccs)
+    std = np.sqrt(planes[7] / np.float32(num_ccs) - mean**2)
+    scaled_mip = np.divide(planes[0] - mean, std, out=np.zeros_like(planes[0]), where=std != 0)
+    np.testing.assert_array_equal(mrcfile.read(par.scaled_mip_output_file), scaled_mip)
+    np.testing.assert_array_equal(mrcfile.read(par.mip_output_file), planes[0])
+    assert list(result["X_POSITION"]) == [70.0]
+    assert list(result["Y_POSITION"]) == [60.0]
+    assert list(result["PSI"]) == [planes[1, 60, 70]]
+
+
+def test_results_store_keeps_all_planes_for_repicking(tmp_path):
+    rng = np.random.default_rng(0)
+    x_dim, y_dim, num_ccs = 128, 120, 1000.0
+    payload, planes = _result_payload(x_dim, y_dim, x_dim + 2, num_ccs, rng)
+    par = match_template.MatchTemplateParameters(
+        input_search_images_filename="image.mrc",
+        input_reconstruction_filename="template.mrc",
+        scaled_mip_output_file=str(tmp_path / "scaled_mip.mrc"),
+        output_histogram_file=str(tmp_path / "histogram.txt"),
+    )
+    received = np.frombuffer(payload, dtype=np.uint8).copy()
+    store = partial(match_template._write_results_store, directory=tmp_path, compression="zlib")
+
+    result = match_template._process_results(received, 0, 1, len(payload) // 4, [par], False, None, store)
+
+    filename = match_template.results_store_filename(tmp_path, par)
+    with ResultsStore(filename) as results:
+        np.testing.assert_array_equal(results.read("psi"), planes[1])
+        assert len(results.histogram) == 512
+    repicked = match_template.peaks_from_results_store(filename)
+    pd.testing.assert_frame_equal(repicked, result)
+
+
+def _payload_from_planes(planes, num_ccs, histogram):
+    y_dim, x_dim = planes.shape[1:]
+    header = np.array([x_dim, y_dim, x_dim * y_dim, num_ccs, len(histogram), 0, 0], dtype=np.float32)
+    return np.frombuffer(header.tobytes() + planes.tobytes() + histogram.tobytes(), dtype=np.uint8).copy()
+
+
+def test_split_searches_are_merged_before_the_statistics(tmp_path):
+    rng = np.random.default_rng(2)
+    y_dim, x_dim, num_ccs = 120, 128, 1000.0
+    shards = []
+    for shard in range(3):
+        planes = rng.random((8, y_dim, x_dim), dtype=np.float32)
+        planes[6] = (planes[6] - 0.5) * num_ccs * 0.1
+        planes[7] = (1 + planes[7]) * num_ccs + planes[6] ** 2 / num_ccs
+        planes[0, 60 + shard, 70] = 50.0 + shard
+        shards.append((planes, rng.integers(0, 1000, 512).astype(np.int64)))
+    merged = shards[0][0].copy()
+    better = np.maximum(shards[1][0][0], shards[2][0][0]) > merged[0]
+    from_second = shards[1][0][0] >= shards[2][0][0]
+    for index in range(6):
+        other = np.where(from_second, shards[1][0][index], shards[2][0][index])
+        merged[index] = np.where(better, other, merged[index])
+    merged[6:] = sum(planes[6:] for planes, _histogram in shards)
+    histogram = sum(histogram for _planes, histogram in shards)
+
+    def parameters(name):
+        return [match_template.MatchTemplateParameters(
+            input_search_images_filename="image.mrc",
+            input_reconstruction_filename="template.mrc",
+            scaled_mip_output_file=str(tmp_path / f"{name}_scaled_mip.mrc"),
+            output_histogram_file=str(tmp_path / f"{name}_histogram.txt"),
+        )]
+
+    whole = _payload_from_planes(merged, 3 * num_ccs, histogram)
+    expected = match_template._process_results(whole, 0, 1, len(whole) // 4, parameters("whole"), False, None)
+    search_shards = match_template._SearchShards()
+    results = [
+        match_template._process_results(_payload_from_planes(planes, num_ccs, shard_histogram), 0, 3, len(whole) // 4, parameters("split"), False, None, shards=search_shards)
+        for planes, shard_histogram in shards
+    ]
+
+    assert results[:2] == [None, None]
+    pd.testing.assert_frame_equal(results[2], expected)
+    assert len(expected) == 1
+    np.testing.assert_array_equal(mrcfile.read(tmp_path / "split_scaled_mip.mrc"), mrcfile.read(tmp_path / "whole_scaled_mip.mrc"))
+    assert (tmp_path / "split_histogram.txt").read_text() == (tmp_path / "whole_histogram.txt").read_text()
+
+
+def test_searches_are_split_into_consecutive_ranges():
+    par = match_template.MatchTemplateParameters(input_search_images_filename="image.mrc", input_reconstruction_filename="template.mrc", first_search_position=0, last_search_position=9)
+    jobs = match_template._split_searches([par], 4)
+    assert [(job.first_search_position, job.last_search_position) for job in jobs] == [(0, 2), (3, 5), (6, 7), (8, 9)]
+    assert {job.number_of_jobs_per_image_in_gui for job in jobs} == {4}
+    assert match_template._split_searches([par], 1) == [par]
+
+
+def test_failed_job_fails_the_whole_split_image():
+    parameters = [match_template.MatchTemplateParameters(input_search_images_filename=f"{i}.mrc", input_reconstruction_filename="template.mrc", image_number_for_gui=i, last_search_position=9) for i in range(2)]
+    jobs = match_template._split_searches(parameters, 2)
+    search_shards = match_template._SearchShards()
+    planes = np.zeros((8, 4, 4), dtype=np.float32)
+    assert search_shards.add(0, 2, planes, np.zeros(4, dtype=np.int64), 1.0) is None
+    peaks = pd.DataFrame({"PEAK_HEIGHT": [9.0]})
+    results = cistem_program.RunResults([(0, None), (3, peaks)], [JobFailure(1, 3, "worker disconnected")], startup_latency=1.0)
+
+    image_results = match_template._image_results(jobs, results, search_shards)
+
+    assert image_results == [(1, peaks)]
+    assert [(failure.parameter_index, failure.attempts) for failure in image_results.failures] == [(0, 3)]
+    assert "1 of 2 jobs failed" in image_results.failures[0].reason
+    assert "worker disconnected" in image_results.failures[0].reason
+    assert search_shards._images == {}
+    assert image_results.startup_latency == 1.0
+
+
+def test_split_searches_cant_be_journaled(tmp_path):
+    par = match_template.MatchTemplateParameters(input_search_images_filename="image.mrc", input_reconstruction_filename="template.mrc")
+    for kwargs in ({"journal": tmp_path / "run.journal"}, {"resume": tmp_path / "run.journal"}):
+        with pytest.raises(ValueError, match="jobs_per_image"):
+            asyncio.run(match_template.run_async([par], jobs_per_image=2, **kwargs))
+    assert not (tmp_path / "run.journal").exists()
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from scipy.special import erfc
+from skimage.feature import peak_local_max
+
+from pycistem.programs import match_template_statistics as statistics
+
+
+def _scaled_mip(shape, peaks, rng):
+    image = rng.normal(size=shape).astype(np.float32)
+    for y, x, height in peaks:
+        image[y, x] = height
+    return ndimage.gaussian_filter(image, 1.0) * 3
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("min_distance", [1, 2, 10])
+def test_find_peaks_matches_peak_local_max(seed, min_distance):
+    rng = np.random.default_rng(seed)
+    peaks = [(rng.integers(0, 300), rng.integers(0, 400), rng.uniform(20, 60)) for _ in range(40)]
+    image = _scaled_mip((300, 400), peaks, rng)
+    threshold = 1.5
+
+    expected = peak_local_max(image, min_distance=min_distance, exclude_border=50, threshold_abs=threshold)
+    found = statistics.find_peaks(image, min_distance, threshold, exclude_border=50)
+
+    np.testing.assert_array_equal(found, expected)
+
+
+def test_find_peaks_keeps_one_maximum_of_a_plateau():
+    image = np.zeros((120, 120), dtype=np.float32)
+    image[60, 60:63] = 5.0
+    image[20, 20] = 7.0
+    image[22, 90] = 7.0
+    image[24, 92] = 7.0
+
+    for min_distance in (1, 3, 10):
+        expected = peak_local_max(image, min_distance=min_distance, exclude_border=5, threshold_abs=1.0)
+        found = statistics.find_peaks(image, min_distance, 1.0, exclude_border=5)
+        np.testing.assert_array_equal(found, expected)
+
+
+def test_find_peaks_of_constant_image():
+    image = np.full((60, 60), 3.0, dtype=np.float32)
+    assert len(statistics.find_peaks(image, 5, 1.0)) == len(peak_local_max(image, min_distance=5, threshold_abs=1.0)) == 0
+
+
+def test_histograms_match_the_loops_they_replace():
+    rng = np.random.default_rng(1)
+    histograms = rng.integers(0, 10000, (3, 512)).astype(np.int64)
+    number_of_trials = np.array([[1e9], [2e9], [3e9]])
+
+    survival = statistics.survival_histogram(histograms)
+    expected_survival = statistics.expected_survival_histogram(512, number_of_trials)
+
+    step = 35.0 / 512
+    for histogram, trials, got, got_expected in zip(histograms, number_of_trials[:, 0], survival, expected_survival):
+        loop = np.zeros(512, dtype=np.float32)
+        loop[-1] = histogram[-1]
+        for i in range(510, -1, -1):
+            loop[i] = loop[i + 1] + histogram[i]
+        np.testing.assert_array_equal(got, loop)
+        loop_expected = np.array([erfc((-12.5 + step / 2 + step * i) / np.sqrt(2.0)) / 2.0 * trials for i in range(512)], dtype=np.float32)
+        np.testing.assert_allclose(got_expected, loop_expected, rtol=1e-6)
+
+
+def test_write_histogram(tmp_path):
+    histogram = np.arange(512, dtype=np.int64)
+    filename = tmp_path / "histogram.txt"
+    threshold = float(statistics.expected_threshold(1e9))
+
+    statistics.write_histogram(filename, histogram, 1e9, threshold)
+
+    assert filename.read_text().startswith(f"# Expected threshold = {threshold:.2f}\n#  histogram")
+    columns = np.loadtxt(filename)
+    assert columns.shape == (512, 4)
+    np.testing.assert_array_equal(columns[:, 1], histogram)
+    np.testing.assert_allclose(columns[:, 0], statistics.histogram_bin_centers(512))
@@ -0,0 +1,60 @@
+import mrcfile
+import numpy as np
+import pytest
+
+from pycistem.programs.results_store import PLANES, ResultsStore, write_results
+
+
+@pytest.fixture
+def planes():
+    rng = np.random.default_rng(0)
+    return {name: rng.random((300, 450), dtype=np.float32) for name in PLANES}
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+@pytest.mark.parametrize("dtype", [np.float32, np.float16])
+def test_regions_of_planes_are_read_back(tmp_path, planes, compression, dtype):
+    path = tmp_path / "image.tmresults"
+    write_results(path, planes, np.arange(512), {"number_of_ccs": 1000.0}, dtype=dtype, compression=compression, tile_size=128)
+
+    with ResultsStore(path) as store:
+        assert store.planes == PLANES
+        assert store.shape == (300, 450)
+        assert store.metadata == {"number_of_ccs": 1000.0}
+        np.testing.assert_array_equal(store.histogram, np.arange(512))
+        expected = planes["psi"].astype(dtype).astype(np.float32)
+        np.testing.assert_array_equal(store.read("psi", slice(100, 290), slice(120, 400)), expected[100:290, 120:400])
+        np.testing.assert_array_equal(store.read("psi"), expected)
+        coordinates = np.array([[0, 0], [299, 449], [130, 5], [131, 6]])
+        np.testing.assert_array_equal(store.values_at("psi", coordinates), expected[tuple(coordinates.T)])
+
+
+def test_uncompressed_planes_are_memory_mapped(tmp_path, planes):
+    path = tmp_path / "image.tmresults"
+    write_results(path, planes, np.zeros(512))
+
+    with ResultsStore(path) as store:
+        mip = store["mip"]
+        assert isinstance(mip, np.memmap)
+        np.testing.assert_array_equal(mip, planes["mip"])
+
+
+def test_planes_are_exported_to_mrc(tmp_path, planes):
+    path = tmp_path / "image.tmresults"
+    write_results(path, planes, np.zeros(512), compression="zlib", tile_size=64)
+
+    with ResultsStore(path) as store:
+        store.to_mrc("theta", tmp_path / "theta.mrc", pixel_size=1.5)
+        store.to_mrc("scaled_mip", tmp_path / "scaled_mip.mrc")
+        scaled_mip = store.scaled_mip()
+
+    np.testing.assert_array_equal(mrcfile.read(tmp_path / "theta.mrc"), planes["theta"])
+    np.testing.assert_array_equal(mrcfile.read(tmp_path / "scaled_mip.mrc"), scaled_mip)
+    np.testing.assert_allclose(scaled_mip, (planes["mip"] - planes["mean"]) / planes["std"], rtol=1e-6)
+
+
+def test_other_files_are_rejected(tmp_path):
+    path = tmp_path / "image.mrc"
+    path.write_bytes(bytes(100))
+    with pytest.raises(ValueError):
+        ResultsStore(path)
@@ -0,0 +1,77 @@
+import pytest
+
+from pycistem.pycore import EulerSearch as PyEulerSearch
+from pycistem.pycore import ParameterMap as PyParameterMap
+
+
+def _loop_grid_positions(angular_step_size, phi_max, theta_max, search_phi=True, for_mt=False, phi_start=0.0, theta_start=0.0):
+    # The scalar loops of EulerSearch::CalculateGridSearchPositions without
+    # random start angles, which the vectorized version has to reproduce
+    import math
+
+    import numpy as np
+
+    from pycistem.pycore._euler_search import _deg2rad
+
+    f32 = np.float32
+    angular_step_size, phi_max, theta_max_local = f32(angular_step_size), f32(phi_max), f32(theta_max)
+    phi_step = theta_step = f32(360.0)
+    phi_start_local = f32(phi_start)
+    if search_phi:
+        theta_step = theta_max_local / f32(int(theta_max_local / angular_step_size + f32(0.5)))
+        theta_start_local = f32(theta_start) if for_mt else f32(0.0)
+    else:
+        theta_start_local = theta_max_local = f32(theta_start)
+    positions = []
+    theta = theta_start_local
+    while theta < theta_max_local + theta_step / f32(2.0):
+        if search_phi:
+            if theta == f32(0.0) or theta == f32(180.0):
+                phi_step = phi_max
+            else:
+                phi_step = min(abs(angular_step_size / f32(math.sin(_deg2rad(theta)))), phi_max)
+                phi_step = phi_max / f32(int(phi_max / phi_step + f32(0.5)))
+                phi_start_local = f32(phi_start) if for_mt else f32(0.0)
+        phi = f32(0.0)
+        while phi < phi_max:
+            positions.append((float(phi + phi_start_local), float(theta)))
+            phi += phi_step
+        theta += theta_step
+    return positions
+
+
+@pytest.mark.parametrize("angular_step", [0.7, 1.0, 2.5, 3.0, 7.3, 13.0])
+@pytest.mark.parametrize("phi_max,theta_max", [(360.0, 180.0), (360.0, 90.0), (72.0, 90.0), (90.0, 54.7), (180.0, 31.7)])
+@pytest.mark.parametrize("for_mt", [False, True])
+def test_vectorized_grid_matches_the_loops(angular_step, phi_max, theta_max, for_mt):
+    from pycistem.pycore._euler_search import _grid_positions
+
+    positions = _grid_positions(angular_step, phi_max, theta_max, 3.0, 1.5, True, for_mt)
+
+    assert positions.tolist() == [list(p) for p in _loop_grid_positions(angular_step, phi_max, theta_max, for_mt=for_mt, phi_start=1.5, theta_start=3.0)]
+
+
+def test_grid_without_phi_search_is_the_start_position():
+    search = PyEulerSearch()
+    parameter_map = PyParameterMap()
+    parameter_map.psi = True
+    search.InitGrid("D2", 4.0, 7.0, 3.0, 360.0, 2.0, 0.0, 0.5, parameter_map, 10)
+    assert search.list_of_search_parameters == [(7.0, 3.0)]
+
+
+def test_search_grid_is_cached_and_matches_euler_search():
+    from pycistem.pycore import search_grid
+
+    search = PyEulerSearch()
+    parameter_map = PyParameterMap()
+    parameter_map.SetAllTrue()
+    search.InitGrid("C1", 2.5, 0.0, 0.0, 360.0, 1.5, 0.0, 0.5, parameter_map, 10)
+    search.theta_max = 180.0
+    search.CalculateGridSearchPositions(False)
+
+    grid = search_grid("C1", 2.5, 1.5, theta_max=180.0)
+
+    assert grid is search_grid("C1", 2.5, 1.5, theta_max=180.0)
+    assert list(zip(grid.phi.tolist(), grid.theta.tolist())) == search.list_of_search_parameters
+    assert not grid.phi.flags.writeable
+    assert grid.psi[0] == 0.0 and grid.psi[-1] == 360.0 and len(grid.psi) == 241
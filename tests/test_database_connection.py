@@ -0,0 +1,119 @@
+import os
+import socket
+import sqlite3
+import subprocess
+import threading
+
+import pytest
+
+from pycistem.database import _connection, project_connection, retry_when_locked, run_in_transaction
+from pycistem.pycore import Database, Project
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = tmp_path / "project.db"
+    with project_connection(database) as con:
+        con.execute("CREATE TABLE ITEMS (ID INTEGER)")
+        con.execute("CREATE TABLE PROCESS_LOCK(NUMBER INTEGER PRIMARY KEY, ACTIVE_PROCESS INTEGER, ACTIVE_HOST TEXT )")
+    return database
+
+
+def test_connections_use_wal_and_a_busy_timeout(database):
+    con = _connection.connect(database)
+    assert con.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert con.execute("PRAGMA busy_timeout").fetchone()[0] == 30000
+    assert con.execute("PRAGMA synchronous").fetchone()[0] == 1
+    con.close()
+
+
+def test_connections_are_shared_within_a_thread(database):
+    first = _connection.thread_connection(database)
+    assert _connection.thread_connection(str(database)) is first
+    other = []
+    thread = threading.Thread(target=lambda: other.append(_connection.thread_connection(database)))
+    thread.start()
+    thread.join()
+    assert other[0] is not first
+
+
+def test_project_connection_commits_and_rolls_back(database):
+    with project_connection(database) as con:
+        con.execute("INSERT INTO ITEMS (ID) VALUES (1)")
+    with pytest.raises(RuntimeError):
+        with project_connection(database) as con:
+            con.execute("INSERT INTO ITEMS (ID) VALUES (2)")
+            raise RuntimeError
+    with sqlite3.connect(database) as con:
+        assert con.execute("SELECT ID FROM ITEMS").fetchall() == [(1,)]
+
+
+def test_writers_wait_for_each_other(database):
+    blocker = sqlite3.connect(database, isolation_level=None, check_same_thread=False)
+    blocker.execute("BEGIN IMMEDIATE")
+    blocker.execute("INSERT INTO ITEMS (ID) VALUES (1)")
+    threading.Timer(0.3, lambda: blocker.execute("COMMIT")).start()
+
+    run_in_transaction(database, lambda con: con.execute("INSERT INTO ITEMS (ID) VALUES (2)"))
+
+    with sqlite3.connect(database) as con:
+        assert con.execute("SELECT ID FROM ITEMS ORDER BY ID").fetchall() == [(1,), (2,)]
+    blocker.close()
+
+
+def test_retry_when_locked(monkeypatch):
+    monkeypatch.setattr(_connection, "settings", _connection.ConnectionSettings(retries=2, retry_delay=0.0))
+    calls = []
+
+    @retry_when_locked
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise sqlite3.OperationalError("database is locked")
+        return "done"
+
+    assert flaky() == "done"
+    assert len(calls) == 3
+
+    @retry_when_locked
+    def broken():
+        calls.append(1)
+        raise sqlite3.OperationalError("no such table: MISSING")
+
+    with pytest.raises(sqlite3.OperationalError):
+        broken()
+    assert len(calls) == 4
+
+
+def test_process_lock(database):
+    con = _connection.connect(database)
+    host = socket.gethostname()
+
+    con.execute("INSERT INTO PROCESS_LOCK VALUES (1, ?, ?)", (os.getppid(), host))
+    con.commit()
+    assert not _connection.acquire_process_lock(con)
+    assert _connection.process_lock_holder(con) == (os.getppid(), host)
+
+    # A process that has exited no longer holds the project
+    process = subprocess.Popen(["true"])
+    process.wait()
+    con.execute("UPDATE PROCESS_LOCK SET ACTIVE_PROCESS = ?", (process.pid,))
+    con.commit()
+    assert _connection.acquire_process_lock(con)
+    assert _connection.process_lock_holder(con) == (os.getpid(), host)
+    con.close()
+
+
+def test_pycore_database_holds_the_process_lock_while_open(tmp_path):
+    project = Project()
+    project.CreateNewProject(str(tmp_path / "project.db"), str(tmp_path), "project")
+    project.Close(True, True)
+
+    database = Database()
+    database.Open(tmp_path / "project.db")
+    assert database.connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert _connection.process_lock_holder(database.connection) == (os.getpid(), socket.gethostname())
+    database.Close(True)
+
+    with sqlite3.connect(tmp_path / "project.db") as con:
+        assert _connection.process_lock_holder(con) is None
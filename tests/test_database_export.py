@@ -0,0 +1,116 @@
+import contextlib
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+import starfile
+
+from pycistem.database import _export, build_peak_table, create_peak_lists, insert_rows, write_match_template_jobs_to_starfiles, write_match_template_to_starfile
+from pycistem.pycore import Project
+
+
+@pytest.fixture
+def database(tmp_path):
+    project = Project()
+    project.CreateNewProject(str(tmp_path / "project.db"), str(tmp_path), "project")
+    project.Close(True, True)
+    database = tmp_path / "project.db"
+    with contextlib.closing(sqlite3.connect(database)) as con:
+        con.execute("INSERT INTO IMAGE_ASSETS (IMAGE_ASSET_ID, FILENAME) VALUES (1, '/data/image_1.mrc'), (2, '/data/image_2.mrc')")
+        con.execute("INSERT INTO VOLUME_ASSETS (VOLUME_ASSET_ID, FILENAME) VALUES (1, '/data/template.mrc')")
+        for template_match_id, job_id, image_asset_id, num_peaks in [(1, 1, 1, 2), (2, 2, 1, 1), (3, 1, 2, 0), (4, 1, 2, 3)]:
+            con.execute(
+                "INSERT INTO TEMPLATE_MATCH_LIST (TEMPLATE_MATCH_ID, TEMPLATE_MATCH_JOB_ID, IMAGE_ASSET_ID, REFERENCE_VOLUME_ASSET_ID, USED_VOLTAGE, USED_SPHERICAL_ABERRATION, USED_AMPLITUDE_CONTRAST, USED_PHASE_SHIFT, USED_DEFOCUS1, USED_DEFOCUS2, USED_DEFOCUS_ANGLE, USED_PIXEL_SIZE) "
+                "VALUES (?, ?, ?, 1, 300.0, 2.7, 0.07, 0.0, 10000.0, 9500.0, 45.0, 1.5)",
+                (template_match_id, job_id, image_asset_id),
+            )
+            create_peak_lists(con, template_match_id, commit=False)
+            insert_rows(con, f"TEMPLATE_MATCH_PEAK_LIST_{template_match_id}", pd.DataFrame({
+                "X_POSITION": 10.0 * template_match_id + np.arange(num_peaks),
+                "Y_POSITION": 5.0,
+                "PSI": 1.0,
+                "THETA": 2.0,
+                "PHI": 3.0,
+                "DEFOCUS": 100.0 * np.arange(num_peaks),
+                "PEAK_HEIGHT": 8.0 + np.arange(num_peaks),
+            }))
+        con.commit()
+    return database
+
+
+def test_export_joins_peaks_with_their_match(database, tmp_path):
+    assert write_match_template_to_starfile(database, 1, tmp_path / "job1.star", chunk_size=2) == 5
+
+    star = starfile.read(tmp_path / "job1.star")
+    assert star["cisTEMOriginalXPosition"].tolist() == [10.0, 11.0, 40.0, 41.0, 42.0]
+    assert star["cisTEMPositionInStack"].tolist() == [1, 2, 1, 2, 3]
+    assert star["cisTEMOriginalImageFilename"].tolist() == ["/data/image_1.mrc"] * 2 + ["/data/image_2.mrc"] * 3
+    assert star["cisTEMReference3DFilename"].unique().tolist() == ["/data/template.mrc"]
+    assert star["cisTEMDefocus1"].tolist() == [10000.0, 10100.0, 10000.0, 10100.0, 10200.0]
+    assert star["cisTEMDefocus2"].tolist() == [9500.0, 9600.0, 9500.0, 9600.0, 9700.0]
+    assert star["cisTEMScore"].tolist() == [8.0, 9.0, 8.0, 9.0, 10.0]
+    assert (star["cisTEMAnglePsi"] == 1.0).all()
+    assert (star["cisTEMAnglePhi"] == 3.0).all()
+    assert (star["cisTEMPixelSize"] == 1.5).all()
+
+    write_match_template_to_starfile(database, 1, tmp_path / "switched.star", switch_phi_psi=True)
+    switched = starfile.read(tmp_path / "switched.star")
+    assert (switched["cisTEMAnglePsi"] == 3.0).all()
+    assert (switched["cisTEMAnglePhi"] == 1.0).all()
+
+    with pytest.raises(FileExistsError):
+        write_match_template_to_starfile(database, 1, tmp_path / "job1.star", overwrite=False)
+
+
+def test_export_from_the_peak_table_is_the_same(database, tmp_path):
+    write_match_template_to_starfile(database, 1, tmp_path / "from_peak_lists.star")
+    build_peak_table(database)
+    write_match_template_to_starfile(database, 1, tmp_path / "from_peak_table.star", chunk_size=1)
+
+    # Apart from the time in the first line
+    assert (tmp_path / "from_peak_lists.star").read_text().split("\n")[1:] == (tmp_path / "from_peak_table.star").read_text().split("\n")[1:]
+
+
+def test_export_of_many_matches(tmp_path, monkeypatch):
+    monkeypatch.setattr("pycistem.database._export.MATCHES_PER_QUERY", 2)
+    project = Project()
+    project.CreateNewProject(str(tmp_path / "many.db"), str(tmp_path), "many")
+    project.Close(True, True)
+    with contextlib.closing(sqlite3.connect(tmp_path / "many.db")) as con:
+        for template_match_id in range(1, 6):
+            con.execute("INSERT INTO TEMPLATE_MATCH_LIST (TEMPLATE_MATCH_ID, TEMPLATE_MATCH_JOB_ID, IMAGE_ASSET_ID, USED_DEFOCUS1, USED_DEFOCUS2) VALUES (?, 1, 1, 0.0, 0.0)", (template_match_id,))
+            create_peak_lists(con, template_match_id, commit=False)
+            con.execute(f"INSERT INTO TEMPLATE_MATCH_PEAK_LIST_{template_match_id} (X_POSITION, DEFOCUS, PEAK_HEIGHT) VALUES (?, 0.0, 7.0)", (float(template_match_id),))
+        con.commit()
+
+    assert write_match_template_to_starfile(tmp_path / "many.db", 1, tmp_path / "many.star") == 5
+    assert starfile.read(tmp_path / "many.star")["cisTEMOriginalXPosition"].tolist() == [1.0, 2.0, 3.0, 4.0, 5.0]
+
+
+def test_export_stopped_by_a_lock_leaves_no_file(database, tmp_path, monkeypatch):
+    chunks = []
+    star_rows = _export.star_rows
+
+    def locked_on_second_chunk(peaks, switch_phi_psi=False):
+        chunks.append(len(peaks))
+        if len(chunks) == 2:
+            msg = "database is locked"
+            raise sqlite3.OperationalError(msg)
+        return star_rows(peaks, switch_phi_psi)
+
+    monkeypatch.setattr(_export, "star_rows", locked_on_second_chunk)
+    with pytest.raises(sqlite3.OperationalError, match="locked"):
+        write_match_template_to_starfile(database, 1, tmp_path / "job1.star", overwrite=False, chunk_size=2)
+
+    # Not retried, and no partial file that a retry would trip over
+    assert chunks == [2, 2]
+    assert not list(tmp_path.glob("job1.star*"))
+
+
+def test_export_of_several_jobs_in_processes(database, tmp_path):
+    jobs = {1: tmp_path / "job1.star", 2: tmp_path / "job2.star", 3: tmp_path / "job3.star"}
+
+    assert write_match_template_jobs_to_starfiles(database, jobs, processes=2) == {1: 5, 2: 1, 3: 0}
+    assert len(starfile.read(jobs[2])) == 1
+    assert "data_" in jobs[3].read_text()
@@ -0,0 +1,77 @@
+import contextlib
+import sqlite3
+
+import mrcfile
+import numpy as np
+import pandas as pd
+import pytest
+
+from pycistem.database import build_peak_table, create_peak_lists, get_num_matches, insert_rows, select_peaks
+from pycistem.database._peaks import SUMMARY_TABLE
+from pycistem.programs import match_template
+from pycistem.pycore import Project
+
+
+def _peaks(heights):
+    return pd.DataFrame({"X_POSITION": np.arange(len(heights), dtype=float), "Y_POSITION": 0.0, "PSI": 0.0, "THETA": 0.0, "PHI": 0.0, "DEFOCUS": 0.0, "PEAK_HEIGHT": heights})
+
+
+def _add_match(database, template_match_id, job_id, image_asset_id, heights):
+    # The way cisTEM adds a template match, without the peak table
+    with contextlib.closing(sqlite3.connect(database)) as con:
+        con.execute("INSERT INTO TEMPLATE_MATCH_LIST (TEMPLATE_MATCH_ID, TEMPLATE_MATCH_JOB_ID, IMAGE_ASSET_ID) VALUES (?, ?, ?)", (template_match_id, job_id, image_asset_id))
+        create_peak_lists(con, template_match_id, commit=False)
+        insert_rows(con, f"TEMPLATE_MATCH_PEAK_LIST_{template_match_id}", _peaks(heights))
+        con.commit()
+
+
+@pytest.fixture
+def database(tmp_path):
+    project = Project()
+    project.CreateNewProject(str(tmp_path / "project.db"), str(tmp_path), "project")
+    project.Close(True, True)
+    database = tmp_path / "project.db"
+    _add_match(database, 1, 1, 1, [8.0, 7.5])
+    _add_match(database, 2, 1, 2, [9.0, 7.1, 7.0])
+    _add_match(database, 3, 2, 1, [12.0])
+    return database
+
+
+def test_peak_table_gives_the_same_answers(database):
+    num_matches = get_num_matches(database, 1)
+    peaks = select_peaks(database, 1, min_height=7.2)
+
+    build_peak_table(database)
+
+    assert get_num_matches(database, 1) == num_matches == 5
+    assert get_num_matches(database, 2) == 1
+    from_table = select_peaks(database, 1, min_height=7.2)
+    pd.testing.assert_frame_equal(from_table[peaks.columns], peaks, check_dtype=False)
+    assert from_table["PEAK_HEIGHT"].tolist() == [9.0, 8.0, 7.5]
+    assert from_table["IMAGE_ASSET_ID"].tolist() == [2, 1, 1]
+    assert from_table["PEAK_NUMBER"].tolist() == [1, 1, 2]
+
+
+def test_peak_table_follows_matches_added_by_cistem(database):
+    build_peak_table(database)
+    _add_match(database, 4, 2, 2, [10.0, 11.0])
+
+    assert get_num_matches(database, 2) == 3
+    assert select_peaks(database, 2)["PEAK_HEIGHT"].tolist() == [12.0, 11.0, 10.0]
+
+
+def test_written_results_are_added_to_the_peak_table(database, tmp_path):
+    build_peak_table(database)
+    template = tmp_path / "template.mrc"
+    with mrcfile.new(template) as mrc:
+        mrc.set_data(np.zeros((4, 4, 4), dtype=np.float32))
+    parameters = [match_template.MatchTemplateParameters("image.mrc", template.as_posix())]
+    image_info = pd.DataFrame({"MATCH_TEMPLATE_JOB_ID": [2], "IMAGE_ASSET_ID": [3]})
+
+    match_template.write_results_to_database(database, parameters, [(0, _peaks(np.array([13.0, 6.0], dtype=np.float32)))], image_info)
+
+    with contextlib.closing(sqlite3.connect(database)) as con:
+        assert con.execute(f"SELECT NUMBER_OF_MATCHES, NUMBER_OF_PEAKS, MAX_PEAK_HEIGHT FROM {SUMMARY_TABLE} WHERE TEMPLATE_MATCH_JOB_ID = 2").fetchone() == (2, 3, 13.0)
+    peaks = select_peaks(database, 2, min_height=6.5)
+    assert peaks["PEAK_HEIGHT"].tolist() == [13.0, 12.0]
+    assert peaks["TEMPLATE_MATCH_ID"].tolist() == [4, 3]
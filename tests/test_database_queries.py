@@ -0,0 +1,75 @@
+import contextlib
+import sqlite3
+
+import mrcfile
+import numpy as np
+import pytest
+
+from pycistem.database import _connection, ensure_indexes, get_image_info_from_db, get_tm_info_from_db, project_connection, volume_asset_id
+from pycistem.database._queries import INDEXES
+from pycistem.pycore import Project
+
+
+@pytest.fixture
+def database(tmp_path):
+    project = Project()
+    project.CreateNewProject(str(tmp_path / "project.db"), str(tmp_path), "project")
+    project.Close(True, True)
+    database = tmp_path / "project.db"
+    with contextlib.closing(sqlite3.connect(database)) as con:
+        con.execute("INSERT INTO MOVIE_ASSETS (MOVIE_ASSET_ID, FILENAME, PIXEL_SIZE) VALUES (1, 'movie.tif', 0.5)")
+        con.execute("INSERT INTO IMAGE_ASSETS (IMAGE_ASSET_ID, FILENAME, PARENT_MOVIE_ID, CTF_ESTIMATION_ID, PIXEL_SIZE) VALUES (1, 'image.mrc', 1, 2, 1.0)")
+        con.execute("INSERT INTO ESTIMATED_CTF_PARAMETERS (CTF_ESTIMATION_ID, DEFOCUS1) VALUES (1, 5000.0)")
+        con.execute("INSERT INTO ESTIMATED_CTF_PARAMETERS (CTF_ESTIMATION_ID, DEFOCUS1) VALUES (2, 8000.0)")
+        con.execute("INSERT INTO TEMPLATE_MATCH_LIST (TEMPLATE_MATCH_ID, TEMPLATE_MATCH_JOB_ID, IMAGE_ASSET_ID) VALUES (1, 1, 1)")
+        con.execute("INSERT INTO TEMPLATE_MATCH_LIST (TEMPLATE_MATCH_ID, TEMPLATE_MATCH_JOB_ID, IMAGE_ASSET_ID) VALUES (2, 2, 1)")
+        con.commit()
+    return database
+
+
+def _indexes(database):
+    with contextlib.closing(sqlite3.connect(database)) as con:
+        return {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'PYCISTEM_%'")}
+
+
+def test_new_projects_have_the_lookup_indexes(database):
+    assert _indexes(database) == set(INDEXES)
+    with contextlib.closing(sqlite3.connect(database)) as con:
+        plan = con.execute("EXPLAIN QUERY PLAN SELECT * FROM VOLUME_ASSETS WHERE FILENAME = ?", ("template.mrc",)).fetchall()
+    assert "PYCISTEM_VOLUME_ASSETS_FILENAME" in plan[0][-1]
+
+
+def test_indexes_are_added_to_existing_projects(database):
+    with contextlib.closing(sqlite3.connect(database)) as con:
+        for name in INDEXES:
+            con.execute(f"DROP INDEX {name}")
+        con.commit()
+    assert _indexes(database) == set()
+    _connection.close_thread_connections()
+    get_tm_info_from_db(database, 1)
+    assert _indexes(database) == set(INDEXES)
+
+
+def test_ensure_indexes_skips_missing_tables(tmp_path):
+    with contextlib.closing(sqlite3.connect(tmp_path / "other.db")) as con:
+        con.execute("CREATE TABLE VOLUME_ASSETS (VOLUME_ASSET_ID INTEGER PRIMARY KEY, FILENAME TEXT)")
+        assert ensure_indexes(con) == ["PYCISTEM_VOLUME_ASSETS_FILENAME"]
+        assert ensure_indexes(con) == []
+
+
+def test_lookups_bind_their_values(database, tmp_path):
+    image = get_image_info_from_db(database, np.int64(1))
+    assert image["DEFOCUS1"] == 8000.0
+    assert image["movie_filename"] == "movie.tif"
+    assert get_image_info_from_db(database, 2) is None
+    assert get_tm_info_from_db(database, np.int64(1), np.int64(2))["TEMPLATE_MATCH_ID"] == 2
+    assert len(get_tm_info_from_db(database, 1)) == 2
+
+    template = tmp_path / "it's a template.mrc"
+    with mrcfile.new(template) as mrc:
+        mrc.set_data(np.zeros((4, 4, 4), dtype=np.float32))
+    with project_connection(database) as con:
+        first = volume_asset_id(con, template, 1.5)
+    with project_connection(database) as con:
+        assert volume_asset_id(con, str(template), 1.5) == first == 1
+        assert con.execute("SELECT NAME, X_SIZE FROM VOLUME_ASSETS").fetchall() == [("it's a template", 4)]
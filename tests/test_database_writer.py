@@ -0,0 +1,81 @@
+import contextlib
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pycistem.database import DatabaseWriter, insert_rows, run_in_transaction
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = tmp_path / "project.db"
+    with contextlib.closing(sqlite3.connect(database)) as con:
+        con.execute("CREATE TABLE ITEMS (ID INTEGER, VALUE REAL)")
+        con.commit()
+    return database
+
+
+def _rows(database):
+    with contextlib.closing(sqlite3.connect(database)) as con:
+        return con.execute("SELECT ID, VALUE FROM ITEMS ORDER BY ID").fetchall()
+
+
+def test_writes_are_committed_on_flush(database):
+    with DatabaseWriter(max_delay=60.0) as writer:
+        for i in range(100):
+            writer.execute(database, "INSERT INTO ITEMS (ID, VALUE) VALUES (?, ?)", [(i, i / 2)])
+        time.sleep(0.1)
+        assert _rows(database) == []
+        writer.flush()
+        assert _rows(database) == [(i, i / 2) for i in range(100)]
+
+
+def test_writes_are_committed_after_max_delay_and_max_rows(database):
+    with DatabaseWriter(max_rows=10, max_delay=60.0) as writer:
+        writer.execute(database, "INSERT INTO ITEMS (ID, VALUE) VALUES (?, ?)", [(i, 0.0) for i in range(10)])
+        deadline = time.monotonic() + 5.0
+        while len(_rows(database)) < 10 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(_rows(database)) == 10
+
+    with DatabaseWriter(max_delay=0.05) as writer:
+        writer.execute(database, "INSERT INTO ITEMS (ID, VALUE) VALUES (?, ?)", [(10, 0.0)])
+        deadline = time.monotonic() + 5.0
+        while len(_rows(database)) < 11 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(_rows(database)) == 11
+
+
+def test_calls_see_the_writes_queued_before_them(database):
+    def add_next(con):
+        next_id = con.execute("SELECT COALESCE(MAX(ID), 0) + 1 FROM ITEMS").fetchone()[0]
+        con.execute("INSERT INTO ITEMS (ID, VALUE) VALUES (?, ?)", (next_id, 1.0))
+
+    with DatabaseWriter(max_delay=60.0) as writer:
+        writer.execute(database, "INSERT INTO ITEMS (ID, VALUE) VALUES (?, ?)", [(1, 0.0)])
+        for _ in range(3):
+            run_in_transaction(database, add_next, writer)
+    assert [row[0] for row in _rows(database)] == [1, 2, 3, 4]
+
+
+def test_a_failing_write_does_not_lose_the_others(database):
+    def fail(con):
+        con.execute("INSERT INTO MISSING (ID) VALUES (1)")
+
+    writer = DatabaseWriter(max_delay=60.0)
+    writer.execute(database, "INSERT INTO ITEMS (ID, VALUE) VALUES (?, ?)", [(1, 0.0)])
+    writer.call(database, fail)
+    writer.execute(database, "INSERT INTO ITEMS (ID, VALUE) VALUES (?, ?)", [(2, 0.0)])
+    with pytest.raises(sqlite3.OperationalError):
+        writer.flush()
+    writer.close()
+    assert [row[0] for row in _rows(database)] == [1, 2]
+
+
+def test_insert_rows_binds_numpy_values(database):
+    run_in_transaction(database, lambda con: insert_rows(con, "ITEMS", [{"ID": np.int64(1), "VALUE": np.float32(0.5)}]))
+    run_in_transaction(database, lambda con: insert_rows(con, "ITEMS", pd.DataFrame({"ID": [2, 3], "VALUE": np.array([1.5, 2.5], dtype=np.float32)})))
+    assert _rows(database) == [(1, 0.5), (2, 1.5), (3, 2.5)]
@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import starfile
+
+from pycistem.star import StarFileWriter, cache_filename, iter_star, read_star, write_star
+
+
+@pytest.fixture
+def particles():
+    return pd.DataFrame({
+        "cisTEMOriginalImageFilename": ["/data/image_1.mrc", "/data/image 2.mrc", ""],
+        "cisTEMPositionInStack": [1, 2, 3],
+        "cisTEMOriginalXPosition": [10.5, 20.25, 1 / 3],
+        "cisTEMScore": [8.0, np.nan, 9.5],
+    })
+
+
+def test_written_files_are_those_of_starfile(particles, tmp_path):
+    write_star(particles, tmp_path / "pycistem.star", chunksize=2)
+    starfile.write(particles, tmp_path / "starfile.star")
+
+    # Apart from the time in the first line
+    assert (tmp_path / "pycistem.star").read_text().split("\n")[1:] == (tmp_path / "starfile.star").read_text().split("\n")[1:]
+
+    with pytest.raises(FileExistsError):
+        write_star(particles, tmp_path / "pycistem.star", overwrite=False)
+
+
+def test_read_like_starfile(particles, tmp_path):
+    write_star(particles, tmp_path / "particles.star")
+    expected = starfile.read(tmp_path / "particles.star")
+
+    read = read_star(tmp_path / "particles.star", cache=False)
+    pd.testing.assert_frame_equal(read, expected, check_dtype=False)
+    assert read["cisTEMOriginalImageFilename"].tolist() == ["/data/image_1.mrc", "/data/image 2.mrc", ""]
+    assert np.isnan(read["cisTEMScore"][1])
+
+    projected = read_star(tmp_path / "particles.star", columns=["cisTEMScore", "cisTEMPositionInStack"], cache=False)
+    assert projected.columns.tolist() == ["cisTEMScore", "cisTEMPositionInStack"]
+    assert projected["cisTEMPositionInStack"].tolist() == [1, 2, 3]
+
+    chunks = list(iter_star(tmp_path / "particles.star", chunksize=2))
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), read)
+
+    with pytest.raises(KeyError):
+        read_star(tmp_path / "particles.star", columns=["cisTEMAnglePsi"], cache=False)
+
+
+def test_read_a_block_of_several(particles, tmp_path):
+    starfile.write({"optics": pd.DataFrame({"rlnVoltage": [300.0]}), "particles": particles}, tmp_path / "blocks.star")
+
+    assert read_star(tmp_path / "blocks.star", cache=False).columns.tolist() == ["rlnVoltage"]
+    particles_block = read_star(tmp_path / "blocks.star", block="particles")
+    pd.testing.assert_frame_equal(particles_block, starfile.read(tmp_path / "blocks.star")["particles"], check_dtype=False)
+    assert cache_filename(tmp_path / "blocks.star", "particles").exists()
+
+
+def test_cache_is_used_until_the_file_changes(particles, tmp_path):
+    filename = tmp_path / "particles.star"
+    write_star(particles, filename)
+
+    read = read_star(filename)
+    assert cache_filename(filename).exists()
+    pd.testing.assert_frame_equal(read_star(filename), read, check_dtype=False)
+    assert read_star(filename, columns=["cisTEMOriginalXPosition"])["cisTEMOriginalXPosition"].tolist() == read["cisTEMOriginalXPosition"].tolist()
+
+    with StarFileWriter(filename, particles.columns) as star:
+        star.write(particles.iloc[:1])
+    # Also when the time of the change can't be told apart
+    stat = cache_filename(filename).stat()
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert len(read_star(filename)) == 1
+
+
+def test_failed_write_leaves_the_file_alone(particles, tmp_path):
+    filename = tmp_path / "particles.star"
+    write_star(particles, filename)
+    before = filename.read_text()
+
+    with pytest.raises(RuntimeError), StarFileWriter(filename, particles.columns) as star:
+        star.write(particles)
+        raise RuntimeError
+
+    assert filename.read_text() == before
+    assert [path.name for path in tmp_path.iterdir()] == ["particles.star"]